@@ -0,0 +1,191 @@
+"""Build each site's ALS reference (ground, canopy, slope, top height) once into a memory-mapped float32 array"""
+
+import os
+import json
+import time
+import argparse
+from glob import glob
+import numpy as np
+from numpy.lib.format import open_memmap
+import lasBounds
+import commands
+from interpretMetric import read_text_file, read_hdf_file, create_geo_array
+
+# Bands in the order returned by DtmCreation.als_arrays
+BANDS = ["ground", "canopy", "slope", "t_height"]
+
+
+def cubeCommands():
+    """
+    Read commandline arguments
+    """
+    p = argparse.ArgumentParser(
+        description=("Script to build memory-mapped ALS reference arrays for each site")
+    )
+    commands.cube_arguments(p)
+
+    cmdargs = p.parse_args()
+    return cmdargs
+
+
+def cube_name(folder):
+    """Array and index file names of a site's ALS cube"""
+    root = f"data/{folder}/als_cube/{folder}_als"
+    return f"{root}.npy", f"{root}.json"
+
+
+def build_cube(folder, als_source="text"):
+    """Grid every ALS tile of a site and pack them into one memory-mapped array
+
+    gediRat grids start at each tile's own bounds, so tiles do not share a 30 m lattice.
+    Each tile is kept on its own grid, as a window of a (bands, pixels) array.
+
+    Args:
+        folder (str): study site
+        als_source (str): 'text' for gediMetric files, 'hdf' for gediRat waveforms
+
+    Returns:
+        str: index file name
+    """
+    if als_source == "hdf":
+        als_list, read_als, extension = (
+            glob(f"data/{folder}/sim_waves/*.h5"),
+            read_hdf_file,
+            ".h5",
+        )
+    else:
+        als_list, read_als, extension = (
+            glob(f"data/{folder}/pts_metric/*.txt"),
+            read_text_file,
+            ".txt",
+        )
+    als_list = [file for file in sorted(als_list) if lasBounds.tileKey(file)]
+
+    # Grid tiles, they are small at 30 m so all are held until the array is sized
+    tiles = {}
+    for idx, als_file in enumerate(als_list):
+        tile = lasBounds.tileKey(als_file)
+        print(f"reading {folder} {idx + 1} of {len(als_list)}: {tile}")
+        coordinates, *values = read_als(als_file)
+        if len(coordinates) == 0:
+            print(f"{lasBounds.clipNames(als_file, extension)} has no waveforms")
+            continue
+        # Same band order as als_arrays: ground, canopy, slope, top height
+        ground, canopy, slope, top_height = values
+        grids = []
+        for band_values in (ground, canopy, slope, top_height):
+            raster_data, bounds = create_geo_array(coordinates, band_values)
+            grids.append(raster_data)
+        tiles[tile] = (np.stack(grids), [float(bound) for bound in bounds])
+
+    array_file, index_file = cube_name(folder)
+    os.makedirs(os.path.dirname(array_file), exist_ok=True)
+    n_pixels = sum(grids.shape[1] * grids.shape[2] for grids, _ in tiles.values())
+    cube = open_memmap(
+        array_file, mode="w+", dtype="float32", shape=(len(BANDS), n_pixels)
+    )
+
+    index = {"bands": BANDS, "resolution": 30, "tiles": {}}
+    offset = 0
+    for tile, (grids, bounds) in tiles.items():
+        size = grids.shape[1] * grids.shape[2]
+        cube[:, offset : offset + size] = grids.reshape(len(BANDS), size)
+        index["tiles"][tile] = {
+            "offset": offset,
+            "shape": list(grids.shape[1:]),
+            "bounds": bounds,
+        }
+        offset += size
+    cube.flush()
+    del cube
+
+    with open(index_file, "w") as file:
+        json.dump(index, file, indent=1)
+    print(f"{len(tiles)} tiles written to {array_file}")
+    return index_file
+
+
+class AlsCube(object):
+    """
+    Read-only view of a site's ALS cube, tiles are returned as views without copying
+    """
+
+    def __init__(self, folder):
+        array_file, index_file = cube_name(folder)
+        with open(index_file) as file:
+            index = json.load(file)
+        self.bands = index["bands"]
+        self.resolution = index["resolution"]
+        self.tiles = index["tiles"]
+        self.cube = np.load(array_file, mmap_mode="r")
+
+    def __contains__(self, tile):
+        return tile in self.tiles
+
+    def band(self, tile, band):
+        """One band of a tile
+
+        Args:
+            tile (str): tile coordinates (x_y)
+            band (str): 'ground', 'canopy', 'slope' or 't_height'
+
+        Returns:
+            array: read-only view of the tile's grid
+        """
+        window = self.tiles[tile]
+        size = window["shape"][0] * window["shape"][1]
+        start = window["offset"]
+        return self.cube[self.bands.index(band), start : start + size].reshape(
+            window["shape"]
+        )
+
+    def tile(self, tile):
+        """All bands of a tile, in the order returned by DtmCreation.als_arrays
+
+        Args:
+            tile (str): tile coordinates (x_y)
+
+        Returns:
+            tuple: ground, canopy, slope and top height views
+        """
+        return tuple(self.band(tile, band) for band in self.bands)
+
+
+def cube_exists(folder):
+    """Whether a site's ALS cube has been built"""
+    return all(os.path.exists(file) for file in cube_name(folder))
+
+
+def main(cmdargs):
+    """Build ALS cubes from parsed command line arguments
+
+    Args:
+        cmdargs (Namespace): arguments from cubeCommands
+    """
+    t = time.perf_counter()
+
+    study_area = cmdargs.studyArea
+    if study_area == "all":
+        study_sites = [
+            "Bonaly",
+            "hubbard_brook",
+            "la_selva",
+            "nouragues",
+            "oak_ridge",
+            "paracou",
+            "robson_creek",
+            "wind_river",
+        ]
+        print(f"working on all sites ({study_sites})")
+    else:
+        study_sites = [study_area]
+
+    for site in study_sites:
+        build_cube(site, cmdargs.alsSource)
+
+    t = time.perf_counter() - t
+    print("time taken: ", t, " seconds")
+
+
+if __name__ == "__main__":
+    main(cubeCommands())
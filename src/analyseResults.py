@@ -6,9 +6,10 @@ from glob import glob
 import pandas as pd
 import seaborn as sns
 from sklearn.linear_model import LinearRegression
-from lasBounds import append_results
+from lasBounds import append_results, photonModel, NATIVE_TAG
 from plotting import folder_colour
-from matplotlib.animation import FuncAnimation
+import commands
+import memoryReport
 
 
 def analysisCommands():
@@ -16,51 +17,8 @@ def analysisCommands():
     Read commandline arguments
     """
     p = argparse.ArgumentParser(description=("Script to examine results of dtmShell"))
+    commands.analysis_arguments(p)
 
-    p.add_argument(
-        "--studyarea",
-        dest="studyArea",
-        type=str,
-        default="Bonaly",
-        help=("Study area name"),
-    )
-
-    p.add_argument(
-        "--plottype",
-        dest="plotType",
-        type=int,
-        default="1",
-        help=("Type of plot to produce"),
-    )
-    p.add_argument(
-        "--lassettings",
-        dest="lasSettings",
-        type=str,
-        default="400505",
-        help=("Choose input based on lastools settings applied to find gound"),
-    )
-
-    p.add_argument(
-        "--interpolation",
-        dest="intpSettings",
-        type=str,
-        default="",
-        help=("Choose input based on interpolation settings"),
-    )
-    p.add_argument(
-        "--bs_thresh",
-        dest="bs_thresh",
-        type=float,
-        default=4,
-        help=("Beam sensitivty threshold"),
-    )
-    p.add_argument(
-        "--outliers",
-        dest="bs_outlier",
-        type=int,
-        default=1,
-        help=("Whether to include RMSE values in upper quantile of cc bin in bs calc"),
-    )
     cmdargs = p.parse_args()
     return cmdargs
 
@@ -74,7 +32,97 @@ def filePath(folder, las_settings, interpolation):
     return file_list
 
 
-def read_csv(folder, las_settings, interpolation, bs_limit, tf_outliers, study_sites):
+def load_summaries(study_sites, las_settings, interpolation):
+    """Read the dtmShell summary of each site once into one dataframe
+
+    Args:
+        study_sites (list): site names
+        las_settings (str): lassettings used
+        interpolation (str): interpolation method used
+
+    Returns:
+        dataframe: results of all sites
+    """
+    dfs = [
+        pd.read_csv(filePath(site, las_settings, interpolation)[0])
+        for site in study_sites
+    ]
+    return pd.concat(dfs, ignore_index=True)
+
+
+def bootstrap_bs(group, bs_limit, tf_outliers, n_boot, rng, ci=95):
+    """Bootstrap confidence intervals of beam sensitivity, RMSE and bias by resampling tiles.
+    All resamples are evaluated at once from an index matrix
+
+    Args:
+        group (dataframe): tiles of one photon and noise group, with CC_bin column
+        bs_limit (int): threshold for beam sensitivty calculations
+        tf_outliers (int): include outliers (1) or not (0), as in read_csv
+        n_boot (int): number of resamples
+        rng (Generator): random number generator
+        ci (float): confidence interval (%)
+
+    Returns:
+        dict: lower and upper bounds of each value
+    """
+    rmse_all = group["RMSE"].to_numpy()
+    cc_all = group["Mean_Canopy_cover"].to_numpy()
+    bias_all = group["Bias"].to_numpy()
+    bin_all = group["CC_bin"].cat.codes.to_numpy()
+    n_bins = len(group["CC_bin"].cat.categories)
+
+    # Each row is one resample of the group's tiles
+    idx = rng.integers(0, len(group), size=(n_boot, len(group)))
+    rmse = rmse_all[idx]
+    cc = cc_all[idx]
+
+    # Only resamples where a canopy cover bin has mean RMSE below the limit count
+    flat_bins = (np.arange(n_boot)[:, None] * n_bins + bin_all[idx]).ravel()
+    bin_count = np.bincount(flat_bins, minlength=n_boot * n_bins)
+    bin_sum = np.bincount(flat_bins, weights=rmse.ravel(), minlength=n_boot * n_bins)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        bin_mean = (bin_sum / bin_count).reshape(n_boot, n_bins)
+    usable = np.any(bin_mean <= bs_limit, axis=1)
+
+    if tf_outliers == 1:
+        above = rmse > bs_limit
+        beam_sens = np.where(
+            above.any(axis=1), np.where(above, cc, np.inf).min(axis=1), 1
+        )
+    else:
+        # RMSE values within lower 3 quartiles of each resample
+        keep = rmse <= np.quantile(rmse, 0.75, axis=1)[:, None]
+        all_below = ~np.any(keep & (rmse > bs_limit), axis=1)
+        beam_sens = np.where(all_below, 1, np.where(keep, cc, np.inf).min(axis=1))
+    beam_sens = np.where(usable, beam_sens, np.nan)
+
+    percentiles = [(100 - ci) / 2, 100 - (100 - ci) / 2]
+    bounds = {}
+    for name, values in (
+        ("beam_sensitivity", beam_sens),
+        ("RMSE", rmse.mean(axis=1)),
+        ("Bias", bias_all[idx].mean(axis=1)),
+    ):
+        if np.all(np.isnan(values)):
+            bounds[f"{name}_lo"], bounds[f"{name}_hi"] = np.nan, np.nan
+        else:
+            lo, hi = np.nanpercentile(values, percentiles)
+            bounds[f"{name}_lo"], bounds[f"{name}_hi"] = lo, hi
+    return bounds
+
+
+def read_csv(
+    folder,
+    las_settings,
+    interpolation,
+    bs_limit,
+    tf_outliers,
+    study_sites,
+    n_boot=0,
+    ci=95,
+    seed=0,
+    summary_df=None,
+):
     """Read results of dtmShell from CSV, group model performace by processing settings, calculate beam sensitivty and make plots
 
     Args:
@@ -84,12 +132,23 @@ def read_csv(folder, las_settings, interpolation, bs_limit, tf_outliers, study_s
         bs_limit (int): threshold for beam sensitivty calculations
         tf_outliers (int): include outliers in box plot (1) or not (0)
         study_sites (lits):list of site names
+        n_boot (int): number of bootstrap resamples for confidence intervals, 0 for none
+        ci (float): bootstrap confidence interval (%)
+        seed (int): random seed for bootstrap resampling
+        summary_df (dataframe): results already loaded by load_summaries, instead of reading csv
 
     Returns:
-        str: name of output csv file
+        dataframe: beam sensitivity results, also written to csv
     """
 
-    if folder == "all":
+    if summary_df is not None:
+        # Sites are taken from the shared dataframe rather than re-read
+        if folder == "all":
+            df = summary_df
+        else:
+            df = summary_df[summary_df["Folder"] == folder]
+
+    elif folder == "all":
         # read all appropriate dataframes and join into 1
         csv_list = []
         for site in study_sites:
@@ -103,15 +162,20 @@ def read_csv(folder, las_settings, interpolation, bs_limit, tf_outliers, study_s
         # new line to read concat csv?
         df = pd.read_csv(csv_file[0], delimiter=",", header=0)
 
+    # Summaries written before the column existed, model is in the file names
+    if "Photon_model" not in df:
+        df = df.assign(Photon_model=df["File"].map(photonModel))
+
     # remove no data rows
     filtered_df = df[df["RMSE"] != -999.0]
 
-    # group by processing settings
-    df_p_n = filtered_df.groupby(["nPhotons", "Noise"])
+    # group by processing settings, native noise levels are not gediMetric's
+    df_p_n = filtered_df.groupby(["Photon_model", "nPhotons", "Noise"])
 
     results = {
         "Folder": [],
         "las_settings": [],
+        "Photon_model": [],
         "nPhotons": [],
         "Noise": [],
         "RMSE": [],
@@ -121,8 +185,14 @@ def read_csv(folder, las_settings, interpolation, bs_limit, tf_outliers, study_s
         "nodata_prop": [],
         "beam_sensitivity": [],
     }
-
-    for (photons, noise), group in df_p_n:
+    if n_boot > 0:
+        rng = np.random.default_rng(seed)
+        for name in ("beam_sensitivity", "RMSE", "Bias"):
+            results[f"{name}_lo"] = []
+            results[f"{name}_hi"] = []
+
+    for (photon_model, photons, noise), group in df_p_n:
+        model_tag = NATIVE_TAG if photon_model == "native" else ""
         sum_pixels = sum(group["Data_count"])
         sum_nodata = sum(group["NoData_count"])
 
@@ -185,6 +255,13 @@ def read_csv(folder, las_settings, interpolation, bs_limit, tf_outliers, study_s
             rmse_mean = np.mean(group["RMSE"])
             bias_mean = np.mean(group["Bias"])
 
+            # Confidence intervals from resampling tiles
+            bounds = (
+                bootstrap_bs(group, bs_limit, tf_outliers, n_boot, rng, ci)
+                if n_boot > 0
+                else {}
+            )
+
             # set plot settings
             plt.rcParams["font.family"] = "Times New Roman"
             plt.rcParams["figure.constrained_layout.use"] = True
@@ -246,7 +323,12 @@ def read_csv(folder, las_settings, interpolation, bs_limit, tf_outliers, study_s
             plt.text(
                 x=1,
                 y=2,
-                s=f"Beam sensitivity: {beam_sens * 100:.2f}%",
+                s=f"Beam sensitivity: {beam_sens * 100:.2f}%"
+                + (
+                    f" ({bounds['beam_sensitivity_lo'] * 100:.2f}-{bounds['beam_sensitivity_hi'] * 100:.2f}%)"
+                    if bounds
+                    else ""
+                ),
                 horizontalalignment="left",
                 verticalalignment="top",
             )
@@ -259,11 +341,11 @@ def read_csv(folder, las_settings, interpolation, bs_limit, tf_outliers, study_s
             plt.ylabel("RMSE (m)")
             plt.legend(loc="upper left")
             plt.title(
-                f"{folder}: {photons} photons and {noise} noise with las settings {las_settings}"
+                f"{folder}: {photons} photons and {noise} {photon_model} noise with las settings {las_settings}"
             )
 
             plt.savefig(
-                f"figures/box_plots/{folder}/bs{bs_limit}_p{photons}_n{noise}_{las_settings}_o{tf_outliers}.png"
+                f"figures/box_plots/{folder}/bs{bs_limit}_p{photons}_n{noise}{model_tag}_{las_settings}_o{tf_outliers}.png"
             )
             plt.close()
 
@@ -271,6 +353,7 @@ def read_csv(folder, las_settings, interpolation, bs_limit, tf_outliers, study_s
                 results,
                 Folder=folder,
                 las_settings=las_settings,
+                Photon_model=photon_model,
                 nPhotons=photons,
                 Noise=noise,
                 beam_sensitivity=beam_sens,
@@ -279,6 +362,7 @@ def read_csv(folder, las_settings, interpolation, bs_limit, tf_outliers, study_s
                 Pixel_count=sum_pixels,
                 nodata_count=sum_nodata,
                 nodata_prop=(sum_nodata / sum_pixels) * 100,
+                **bounds,
             )
 
         else:
@@ -292,15 +376,17 @@ def read_csv(folder, las_settings, interpolation, bs_limit, tf_outliers, study_s
     )
     resultsDf.to_csv(outCsv, index=False)
     print("Results written to: ", outCsv)
-    return outCsv
+    return resultsDf
 
 
-def concat_csv(csv_list, las_settings):
+def concat_csv(csv_list, las_settings, bs_limit, tf_outliers):
     """Join multiple csv files into one dataframe
 
     Args:
-        csv_list (list):  csv file names
+        csv_list (list):  csv file names, or dataframes already in memory
         las_settings (str): lassettigns code in file names
+        bs_limit (int): bs threshold
+        tf_outliers (int): outlier inclusion code
 
     Returns:
         dataframe: merged files as dataframe
@@ -309,7 +395,7 @@ def concat_csv(csv_list, las_settings):
     # file path function
     file_path = f"data/beam_sensitivity/{las_settings}"
 
-    dfs = [pd.read_csv(file) for file in csv_list]
+    dfs = [pd.read_csv(file) if isinstance(file, str) else file for file in csv_list]
 
     # Concatenate all DataFrames into one
     df = pd.concat(dfs, ignore_index=True)
@@ -320,14 +406,19 @@ def concat_csv(csv_list, las_settings):
     return df
 
 
-def bs_subplots(df, bs_limit, tf_outliers):
+def bs_subplots(df, las_settings, bs_limit, tf_outliers):
     """Make line plots of beam sensitivty results agaisnt noise/photons
 
     Args:
         df (dataframe): beam sensitivity results
+        las_settings (str): lassettigns code in file names
         bs_limit (int): bs threshold
         tf_outliers (int): outlier inclusion code
     """
+    # Results written before the column existed are all from gediMetric
+    if "Photon_model" not in df:
+        df = df.assign(Photon_model="gediMetric")
+
     # filter out old results
     filtered_df = df[df["Noise"] != 5]
     filtered_df = filtered_df[filtered_df["nPhotons"] != 400]
@@ -341,8 +432,11 @@ def bs_subplots(df, bs_limit, tf_outliers):
 
     # Iterate over each noise level and corresponding axis
     for (noise, group), ax in zip(noise_groups, axes):
-        for folder in group["Folder"].unique():
-            folder_data = group[group["Folder"] == folder]
+        # Native photon counting is drawn dashed, its noise levels are not gediMetric's
+        for (folder, photon_model), folder_data in group.groupby(
+            ["Folder", "Photon_model"]
+        ):
+            native = photon_model == "native"
 
             # convert dataframe rows to np arrays
             nPhotons = folder_data["nPhotons"].to_numpy()
@@ -351,7 +445,8 @@ def bs_subplots(df, bs_limit, tf_outliers):
                 nPhotons,
                 beam_sensitivity,
                 marker="o",
-                label=folder,
+                linestyle="--" if native else "-",
+                label=f"{folder} (native)" if native else folder,
                 color=folder_colour(folder),
             )
         ax.axhline(y=0.98, color="grey", linestyle="--", linewidth=1)
@@ -381,17 +476,25 @@ def bs_subplots(df, bs_limit, tf_outliers):
     plt.clf()
 
 
-if __name__ == "__main__":
+def main(cmdargs):
+    """Run the results analysis from parsed command line arguments
+
+    Args:
+        cmdargs (Namespace): arguments from analysisCommands or the cli analyse subcommand
+    """
     t = time.perf_counter()
 
-    cmdargs = analysisCommands()
     site = cmdargs.studyArea
     las_settings = cmdargs.lasSettings
     intp_setting = cmdargs.intpSettings
     bs_limit = cmdargs.bs_thresh
     tf_outliers = cmdargs.bs_outlier
+    n_boot = cmdargs.bootstrap
+    ci = cmdargs.ci
+    seed = cmdargs.seed
+    memoryReport.start(cmdargs.memReport)
 
-    csv_paths = []
+    bs_results = []
 
     if site == "all":
         study_sites = [
@@ -405,36 +508,66 @@ if __name__ == "__main__":
             "wind_river",
         ]
         print(f"working on all sites ({study_sites})")
+
+        # Each site summary is read once, shared by per-site and pooled analyses
+        with memoryReport.stage("load_summaries", sites="all"):
+            summary_df = load_summaries(study_sites, las_settings, intp_setting)
         for area in study_sites:
-            csv_paths.append(
-                read_csv(
-                    area,
-                    las_settings,
-                    intp_setting,
-                    bs_limit,
-                    tf_outliers,
-                    study_sites=study_sites,
+            with memoryReport.stage("read_csv", site=area):
+                bs_results.append(
+                    read_csv(
+                        area,
+                        las_settings,
+                        intp_setting,
+                        bs_limit,
+                        tf_outliers,
+                        study_sites=study_sites,
+                        n_boot=n_boot,
+                        ci=ci,
+                        seed=seed,
+                        summary_df=summary_df,
+                    )
                 )
-            )
 
         # merge bs results into one file
-        df = concat_csv(csv_paths, las_settings)
-        bs_subplots(df, bs_limit, tf_outliers)
+        df = concat_csv(bs_results, las_settings, bs_limit, tf_outliers)
+        with memoryReport.stage("bs_subplots", sites="all"):
+            bs_subplots(df, las_settings, bs_limit, tf_outliers)
 
         # all sites on one plot
-        read_csv(
-            folder="all",
-            las_settings=las_settings,
-            interpolation=intp_setting,
-            bs_limit=bs_limit,
-            tf_outliers=tf_outliers,
-            study_sites=study_sites,
-        )
+        with memoryReport.stage("read_csv", site="all"):
+            read_csv(
+                folder="all",
+                las_settings=las_settings,
+                interpolation=intp_setting,
+                bs_limit=bs_limit,
+                tf_outliers=tf_outliers,
+                study_sites=study_sites,
+                n_boot=n_boot,
+                ci=ci,
+                seed=seed,
+                summary_df=summary_df,
+            )
 
     else:
-        read_csv(
-            site, las_settings, intp_setting, bs_limit, tf_outliers, study_sites=site
-        )
+        with memoryReport.stage("read_csv", site=site):
+            read_csv(
+                site,
+                las_settings,
+                intp_setting,
+                bs_limit,
+                tf_outliers,
+                study_sites=site,
+                n_boot=n_boot,
+                ci=ci,
+                seed=seed,
+            )
+
+    memoryReport.finish()
 
     t = time.perf_counter() - t
     print("time taken: ", t, " seconds")
+
+
+if __name__ == "__main__":
+    main(analysisCommands())
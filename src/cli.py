@@ -0,0 +1,101 @@
+"""Single entry point for the processing scripts, parses arguments before importing any heavy dependency"""
+
+import sys
+import argparse
+import importlib
+
+# Subcommand: module run, module and function adding its arguments (light imports only), help
+SUBCOMMANDS = {
+    "simulate": (
+        "testShell",
+        ("commands", "simulate_arguments"),
+        "Simulate waveforms and photon counting from ALS (testShell.py)",
+    ),
+    "dtm": (
+        "dtmShell",
+        ("commands", "dtm_arguments"),
+        "Create DTMs and assess their accuracy (dtmShell.py)",
+    ),
+    "sweep": (
+        "sweepPlanner",
+        ("commands", "sweep_arguments"),
+        "Plan and run a parameter sweep (sweepPlanner.py)",
+    ),
+    "analyse": (
+        "analyseResults",
+        ("commands", "analysis_arguments"),
+        "Beam sensitivity analysis and plots (analyseResults.py)",
+    ),
+    "slope-cc": (
+        "slope_cc_plot",
+        ("commands", "analysis_arguments"),
+        "Compare accuracy with slope and canopy cover (slope_cc_plot.py)",
+    ),
+    "las-stats": (
+        "lasStats",
+        ("commands", "stats_arguments"),
+        "Record statistics of each raw las tile (lasStats.py)",
+    ),
+    "als-cube": (
+        "alsCube",
+        ("commands", "cube_arguments"),
+        "Build memory-mapped ALS reference arrays (alsCube.py)",
+    ),
+    "figures": (
+        "figureShell",
+        ("commands", "figure_arguments"),
+        "Plot elevation differences written by dtmShell (figureShell.py)",
+    ),
+    "error-maps": (
+        "errorMaps",
+        ("commands", "error_arguments"),
+        "Make per-pixel error maps from difference rasters (errorMaps.py)",
+    ),
+    "zonal": (
+        "zonalStats",
+        ("commands", "zonal_arguments"),
+        "Bin elevation error by slope and canopy cover (zonalStats.py)",
+    ),
+    "cost": (
+        "gls_planner.gls_cost",
+        ("gls_planner.gls_cost", "cost_arguments"),
+        "Estimate cost of a global satellite lidar system (gls_cost.py)",
+    ),
+    "coverage": (
+        "gls_planner.gls_coverage",
+        ("gls_planner.gls_coverage", "coverage_arguments"),
+        "Simulate ground track coverage of a lidar constellation (gls_coverage.py)",
+    ),
+}
+
+
+def cliCommands(argv=None):
+    """
+    Read subcommand and its commandline arguments
+    """
+    p = argparse.ArgumentParser(
+        description=("Run a processing step, e.g. 'python3 src/cli.py dtm --help'")
+    )
+    subparsers = p.add_subparsers(dest="command", metavar="command", required=True)
+
+    for name, (_, (arg_module, arg_function), help_text) in SUBCOMMANDS.items():
+        sub = subparsers.add_parser(name, help=help_text, description=help_text)
+        getattr(importlib.import_module(arg_module), arg_function)(sub)
+
+    cmdargs = p.parse_args(argv)
+    return cmdargs
+
+
+def main(argv=None):
+    """Parse arguments, then import and run only the module of the chosen subcommand
+
+    Args:
+        argv (list): arguments, default sys.argv
+    """
+    cmdargs = cliCommands(argv)
+    module = importlib.import_module(SUBCOMMANDS[cmdargs.command][0])
+    module.main(cmdargs)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
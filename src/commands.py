@@ -0,0 +1,589 @@
+"""Command line arguments of each script, free of heavy imports so parsing and --help are instant"""
+
+# lasground_new settings used for sim_ground folders
+LAS_SETTINGS = [
+    "40051",
+    "50051",
+    "60051",
+    "400501",
+    "500501",
+    "600501",
+    "400505",
+    "500505",
+    "600505",
+]
+
+
+def simulate_arguments(p):
+    """Add testShell.py arguments: gediRat, gediMetric and photon counting
+
+    Args:
+        p (ArgumentParser): parser or subcommand parser
+
+    Returns:
+        ArgumentParser: the same parser
+    """
+    p.add_argument(
+        "--studyarea",
+        dest="studyArea",
+        type=str,
+        default="Bonaly",
+        help=("Study area name"),
+    )
+
+    p.add_argument(
+        "--noise",
+        dest="noise",
+        type=int,
+        default="0",
+        help=("Level of noise to be added to waveform. -1 to add a set of options"),
+    )
+
+    p.add_argument(
+        "--pcount",
+        dest="pCount",
+        type=int,
+        default="100",
+        help=("Number of photon in simulated waveform. -1 to add a set of options"),
+    )
+
+    p.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=1,
+        help=(
+            "Number of gediRat jobs, or python photon counting processes, to run at once."
+            " Above 1 all sites run together"
+        ),
+    )
+
+    p.add_argument(
+        "--mem_budget",
+        dest="memBudget",
+        type=float,
+        default=8,
+        help=("Memory (GB) shared by concurrent gediRat jobs"),
+    )
+
+    p.add_argument(
+        "--native",
+        dest="native",
+        type=bool,
+        default=False,
+        help=("Simulate photon counting in python, reading each waveform file once"),
+    )
+
+    p.add_argument(
+        "--seed",
+        dest="seed",
+        type=int,
+        default=0,
+        help=("Random seed for python photon counting"),
+    )
+
+    p.add_argument(
+        "--realizations",
+        dest="realizations",
+        type=int,
+        default=1,
+        help=(
+            "Seeded Monte Carlo realizations of each photon/noise scenario,"
+            " above 1 uses python photon counting and adds _r{k} to file names"
+        ),
+    )
+    p.add_argument(
+        "--realization",
+        dest="realization",
+        type=int,
+        default=0,
+        help=(
+            "Realization simulated by this run, 0 to realizations - 1. Each is scored"
+            " and its files removed by dtmShell.py before the next is simulated"
+        ),
+    )
+
+    p.add_argument(
+        "--als_source",
+        dest="alsSource",
+        type=str,
+        default="text",
+        choices=["text", "hdf"],
+        help=("'hdf' skips gediMetric text files, dtmShell reads gediRat hdf5 instead"),
+    )
+
+    p.add_argument(
+        "--cache",
+        dest="cache",
+        type=str,
+        default=None,
+        help=(
+            "Folder of cached gediRat and gediMetric outputs, reused for unchanged inputs"
+        ),
+    )
+
+    p.add_argument(
+        "--cache_quota",
+        dest="cacheQuota",
+        type=float,
+        default=50,
+        help=("Disk quota (GB) of the cache, least recently used outputs are removed"),
+    )
+    return p
+
+
+def dtm_arguments(p):
+    """Add dtmShell.py arguments: DTM creation and accuracy assessment
+
+    Args:
+        p (ArgumentParser): parser or subcommand parser
+
+    Returns:
+        ArgumentParser: the same parser
+    """
+    p.add_argument(
+        "--studyarea",
+        dest="studyArea",
+        type=str,
+        default="Bonaly",
+        help=("Study area name, for all sites input 'all'"),
+    )
+
+    p.add_argument(
+        "--interpolate",
+        dest="interpolate",
+        type=bool,
+        default=False,
+        help=("Whether to interpolate values of nodata points"),
+    )
+    p.add_argument(
+        "--int_method",
+        dest="intpMethod",
+        type=str,
+        default="linear",
+        help=(
+            "No-data interpolation method; can be 'linear', 'nearest', 'cubic' or 'canopy_middle'."
+            " Comma separate several methods, or 'all', to score them in one pass"
+        ),
+    )
+    p.add_argument(
+        "--lassettings",
+        dest="lasSettings",
+        type=str,
+        default="400505",
+        help=("Choose input based on lastools settings applied to find gound"),
+    )
+    p.add_argument(
+        "--als_source",
+        dest="alsSource",
+        type=str,
+        default="text",
+        choices=["text", "hdf", "cube"],
+        help=(
+            "Read ALS reference from gediMetric text files, gediRat hdf5 files,"
+            " or the site's ALS cube built by alsCube.py"
+        ),
+    )
+    p.add_argument(
+        "--queue",
+        dest="queue",
+        type=str,
+        default=None,
+        help=("Shared directory for a work queue of site, lassettings and tile jobs"),
+    )
+    p.add_argument(
+        "--queue_action",
+        dest="queueAction",
+        type=str,
+        default="work",
+        choices=["init", "work", "merge"],
+        help=("Write the job grid, run a worker, or merge finished results"),
+    )
+    p.add_argument(
+        "--resume",
+        dest="resume",
+        type=bool,
+        default=False,
+        help=("Skip sim files already logged by a previous compareDTM run"),
+    )
+    p.add_argument(
+        "--halo",
+        dest="halo",
+        type=int,
+        default=0,
+        help=(
+            "Interpolate each tile with a halo of this many pixels from neighbouring tiles"
+            " of the same scenario, 0 interpolates tiles in isolation"
+        ),
+    )
+    p.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=1,
+        help=("Processes filling tiles in parallel when using a halo"),
+    )
+    p.add_argument(
+        "--resolutions",
+        dest="resolutions",
+        type=str,
+        default="30",
+        help=(
+            "Comma separated resolutions (m) to score, e.g. '30,60,90,120'. Coarser"
+            " levels are aggregated from the 30 m DTMs and ALS, without re-simulating"
+        ),
+    )
+    p.add_argument(
+        "--store",
+        dest="store",
+        type=bool,
+        default=False,
+        help=(
+            "Write difference rasters into each site's chunked scenario store"
+            " (data/{site}/diff_store.zarr) instead of per-tile tifs"
+        ),
+    )
+    p.add_argument(
+        "--cache",
+        dest="cache",
+        type=str,
+        default=None,
+        help=("Folder of cached mapLidar outputs, reused for unchanged inputs"),
+    )
+    p.add_argument(
+        "--cache_quota",
+        dest="cacheQuota",
+        type=float,
+        default=50,
+        help=("Disk quota (GB) of the cache, least recently used outputs are removed"),
+    )
+    p.add_argument(
+        "--mem_report",
+        dest="memReport",
+        type=str,
+        default=None,
+        help=(
+            "Record python allocation peaks and RSS of each stage and tile, and peak RSS"
+            " of child processes, to this csv (slows the run)"
+        ),
+    )
+    return p
+
+
+def sweep_arguments(p):
+    """Add sweepPlanner.py arguments: sweep spec and job state
+
+    Args:
+        p (ArgumentParser): parser or subcommand parser
+
+    Returns:
+        ArgumentParser: the same parser
+    """
+    p.add_argument(
+        "--spec",
+        dest="spec",
+        type=str,
+        default="sweep.toml",
+        help=("Sweep spec file (.toml, or .yaml if PyYAML is installed)"),
+    )
+    p.add_argument(
+        "--dry_run",
+        dest="dryRun",
+        type=bool,
+        default=False,
+        help=("Only print the job graph"),
+    )
+    p.add_argument(
+        "--state",
+        dest="state",
+        type=str,
+        default="data/sweep_state",
+        help=("Folder recording finished jobs, so reruns skip them"),
+    )
+    return p
+
+
+def analysis_arguments(p):
+    """Add analyseResults.py and slope_cc_plot.py arguments: results analysis
+
+    Args:
+        p (ArgumentParser): parser or subcommand parser
+
+    Returns:
+        ArgumentParser: the same parser
+    """
+    p.add_argument(
+        "--studyarea",
+        dest="studyArea",
+        type=str,
+        default="Bonaly",
+        help=("Study area name"),
+    )
+
+    p.add_argument(
+        "--plottype",
+        dest="plotType",
+        type=int,
+        default="1",
+        help=("Type of plot to produce"),
+    )
+    p.add_argument(
+        "--lassettings",
+        dest="lasSettings",
+        type=str,
+        default="400505",
+        help=("Choose input based on lastools settings applied to find gound"),
+    )
+
+    p.add_argument(
+        "--interpolation",
+        dest="intpSettings",
+        type=str,
+        default="",
+        help=("Choose input based on interpolation settings"),
+    )
+    p.add_argument(
+        "--bs_thresh",
+        dest="bs_thresh",
+        type=float,
+        default=4,
+        help=("Beam sensitivty threshold"),
+    )
+    p.add_argument(
+        "--outliers",
+        dest="bs_outlier",
+        type=int,
+        default=1,
+        help=("Whether to include RMSE values in upper quantile of cc bin in bs calc"),
+    )
+    p.add_argument(
+        "--bootstrap",
+        dest="bootstrap",
+        type=int,
+        default=0,
+        help=(
+            "Number of bootstrap resamples of tiles for confidence intervals, 0 for none"
+        ),
+    )
+    p.add_argument(
+        "--ci",
+        dest="ci",
+        type=float,
+        default=95,
+        help=("Bootstrap confidence interval (%%)"),
+    )
+    p.add_argument(
+        "--seed",
+        dest="seed",
+        type=int,
+        default=0,
+        help=("Random seed for bootstrap resampling"),
+    )
+    p.add_argument(
+        "--mem_report",
+        dest="memReport",
+        type=str,
+        default=None,
+        help=(
+            "Record python allocation peaks and RSS of each stage and tile, and peak RSS"
+            " of child processes, to this csv (slows the run)"
+        ),
+    )
+    return p
+
+
+def stats_arguments(p):
+    """Add lasStats.py arguments: sites and rereading of las files
+
+    Args:
+        p (ArgumentParser): parser or subcommand parser
+
+    Returns:
+        ArgumentParser: the same parser
+    """
+    p.add_argument(
+        "--studyarea",
+        dest="studyArea",
+        type=str,
+        default="Bonaly",
+        help=("Study area name, for all sites input 'all'"),
+    )
+    p.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=1,
+        help=("Number of las files read at once"),
+    )
+    p.add_argument(
+        "--refresh",
+        dest="refresh",
+        type=bool,
+        default=False,
+        help=("Reread every file, not only new or changed ones"),
+    )
+    return p
+
+
+def cube_arguments(p):
+    """Add alsCube.py arguments: sites and ALS reference source
+
+    Args:
+        p (ArgumentParser): parser or subcommand parser
+
+    Returns:
+        ArgumentParser: the same parser
+    """
+    p.add_argument(
+        "--studyarea",
+        dest="studyArea",
+        type=str,
+        default="Bonaly",
+        help=("Study area name, for all sites input 'all'"),
+    )
+    p.add_argument(
+        "--als_source",
+        dest="alsSource",
+        type=str,
+        default="text",
+        choices=["text", "hdf"],
+        help=("Read ALS reference from gediMetric text files or gediRat hdf5 files"),
+    )
+    return p
+
+
+def figure_arguments(p):
+    """Add figureShell.py arguments: which difference rasters to plot
+
+    Args:
+        p (ArgumentParser): parser or subcommand parser
+
+    Returns:
+        ArgumentParser: the same parser
+    """
+    p.add_argument(
+        "--studyarea",
+        dest="studyArea",
+        type=str,
+        default="Bonaly",
+        help=("Study area name, for all sites input 'all'"),
+    )
+    p.add_argument(
+        "--lassettings",
+        dest="lasSettings",
+        type=str,
+        default="400505",
+        help=("lastools settings of difference rasters, 'all' for every setting"),
+    )
+    p.add_argument(
+        "--tiles",
+        dest="tiles",
+        type=str,
+        default=None,
+        help=("Comma separated tiles (x_y) to plot, default all"),
+    )
+    p.add_argument(
+        "--photons",
+        dest="photons",
+        type=str,
+        default=None,
+        help=("Comma separated photon counts to plot, default all"),
+    )
+    p.add_argument(
+        "--noise",
+        dest="noise",
+        type=str,
+        default=None,
+        help=("Comma separated noise levels to plot, default all"),
+    )
+    p.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=1,
+        help=("Number of processes making figures"),
+    )
+    p.add_argument(
+        "--fast",
+        dest="fast",
+        type=bool,
+        default=False,
+        help=("Draw previews with numpy colour tables instead of matplotlib"),
+    )
+    return p
+
+
+def error_arguments(p):
+    """Add errorMaps.py arguments: sites and scenario grouping
+
+    Args:
+        p (ArgumentParser): parser or subcommand parser
+
+    Returns:
+        ArgumentParser: the same parser
+    """
+    p.add_argument(
+        "--studyarea",
+        dest="studyArea",
+        type=str,
+        default="Bonaly",
+        help=("Study area name, for all sites input 'all'"),
+    )
+    p.add_argument(
+        "--lassettings",
+        dest="lasSettings",
+        type=str,
+        default="all",
+        help=("lastools settings of difference rasters, 'all' for every setting"),
+    )
+    p.add_argument(
+        "--group_by",
+        dest="groupBy",
+        type=str,
+        default="lassettings,photon_model,photons,noise,interpolation",
+        help=(
+            "Comma separated scenario axes kept apart, others are pooled."
+            " From lassettings, photon_model, photons, noise, interpolation"
+        ),
+    )
+    return p
+
+
+def zonal_arguments(p):
+    """Add zonalStats.py arguments: sites and bin widths
+
+    Args:
+        p (ArgumentParser): parser or subcommand parser
+
+    Returns:
+        ArgumentParser: the same parser
+    """
+    p.add_argument(
+        "--studyarea",
+        dest="studyArea",
+        type=str,
+        default="Bonaly",
+        help=("Study area name, for all sites input 'all'"),
+    )
+    p.add_argument(
+        "--lassettings",
+        dest="lasSettings",
+        type=str,
+        default="all",
+        help=("lastools settings of difference rasters, 'all' for every setting"),
+    )
+    p.add_argument(
+        "--slope_step",
+        dest="slopeStep",
+        type=float,
+        default=5,
+        help=("Width of slope bins (degrees)"),
+    )
+    p.add_argument(
+        "--cc_step",
+        dest="ccStep",
+        type=float,
+        default=0.05,
+        help=("Width of canopy cover bins (fraction)"),
+    )
+    return p
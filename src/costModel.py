@@ -0,0 +1,128 @@
+"""Runtime estimates of tile jobs from cheap features, learned from recorded runtimes, for longest-job-first dispatch"""
+
+import os
+import json
+import numpy as np
+from scipy.optimize import nnls
+
+# Runtimes of finished jobs, one json line per job, shared by every script
+HISTORY = "data/runtimes.jsonl"
+
+# Seconds per unit of each feature until enough runtimes have been recorded.
+# Only the order of estimates matters for dispatch, so rough values are enough.
+PRIORS = {
+    # gediRat holds and grids every las point
+    "gediRat": {"points": 2e-6, "file_size": 0},
+    # photon counting runs once per waveform, scenario and realization
+    "photons": {"waveforms": 1e-3},
+    # mapLidar reads sim points, interpolation grows with no-data pixels
+    "dtm": {"sim_points": 1e-5, "nodata_cells": 1e-3},
+}
+
+
+def record_runtime(kind, features, seconds, history=HISTORY):
+    """Append the runtime of a finished job to the history
+
+    Args:
+        kind (str): job type, a key of PRIORS
+        features (dict): feature name: value
+        seconds (float): wall time of the job
+        history (str): runtime history file
+    """
+    os.makedirs(os.path.dirname(history) or ".", exist_ok=True)
+    line = json.dumps({"kind": kind, "features": features, "seconds": seconds})
+    # Single appended lines are not interleaved between processes
+    with open(history, "a") as file:
+        file.write(line + "\n")
+
+
+class CostModel(object):
+    """
+    Linear runtime model per job type, fitted to recorded runtimes
+    """
+
+    def __init__(self, history=HISTORY):
+        self.records = {}
+        if os.path.exists(history):
+            with open(history) as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Line cut short by a killed job
+                        continue
+                    self.records.setdefault(record["kind"], []).append(record)
+        self.fits = {}
+
+    def coefficients(self, kind):
+        """Intercept and seconds per unit of each feature
+
+        Args:
+            kind (str): job type
+
+        Returns:
+            float, dict: intercept and feature coefficients
+        """
+        if kind in self.fits:
+            return self.fits[kind]
+
+        names = list(PRIORS[kind])
+        records = [
+            record
+            for record in self.records.get(kind, [])
+            if all(name in record["features"] for name in names)
+        ]
+        # Priors until there are more runtimes than unknowns
+        if len(records) < len(names) + 2:
+            self.fits[kind] = 0.0, dict(PRIORS[kind])
+            return self.fits[kind]
+
+        features = np.array(
+            [[1.0] + [record["features"][name] for name in names] for record in records]
+        )
+        seconds = np.array([record["seconds"] for record in records])
+        # Scale columns so large features (bytes, points) do not dominate the solve
+        scale = np.abs(features).max(axis=0)
+        scale[scale == 0] = 1
+        # Runtime cannot fall as a feature grows, so coefficients are fitted non-negative
+        fitted = nnls(features / scale, seconds)[0] / scale
+        self.fits[kind] = float(fitted[0]), dict(zip(names, map(float, fitted[1:])))
+        return self.fits[kind]
+
+    def estimate(self, kind, features):
+        """Estimated runtime (seconds) of a job
+
+        Args:
+            kind (str): job type
+            features (dict): feature name: value
+
+        Returns:
+            float: estimated seconds
+        """
+        intercept, coefficients = self.coefficients(kind)
+        return intercept + sum(
+            coefficient * features.get(name, 0)
+            for name, coefficient in coefficients.items()
+        )
+
+    def longest_first(self, kind, jobs, features):
+        """Order jobs by estimated runtime, longest first, to shorten the makespan
+
+        Args:
+            kind (str): job type
+            jobs (list): job dictionaries
+            features (function): returns the feature dict of a job
+
+        Returns:
+            list: the jobs, each with 'features' and 'cost' (estimated seconds) added
+        """
+        for job in jobs:
+            job["features"] = features(job)
+            job["cost"] = self.estimate(kind, job["features"])
+        n_fitted = len(self.records.get(kind, []))
+        print(
+            f"{len(jobs)} {kind} jobs, estimated {sum(job['cost'] for job in jobs):.0f}s"
+            f" in total from {n_fitted} recorded runtimes"
+        )
+        # sorted is stable, equal estimates keep their original order
+        return sorted(jobs, key=lambda job: job["cost"], reverse=True)
@@ -1,7 +1,8 @@
 """ Shell script to create DTMs and assess accuracy of simulated data"""
 
+import os
+import json
 import time
-import subprocess
 import argparse
 from glob import glob
 import rasterio
@@ -9,11 +10,24 @@ import regex
 import numpy as np
 import pandas as pd
 import numpy.ma as ma
-from sklearn.metrics import mean_squared_error, r2_score
-from scipy.interpolate import griddata
 import lasBounds
-from plotting import two_plots
-from interpretMetric import read_text_file, metric_functions
+import workQueue
+from alsCube import AlsCube
+from scenarioStore import ScenarioStore, store_name
+from haloFill import HaloFill
+import resolutionPyramid
+from resolutionPyramid import NATIVE_RES
+import memoryReport
+import commands
+from commands import LAS_SETTINGS
+from toolCache import ToolCache, run_command
+from costModel import CostModel, record_runtime
+from interpretMetric import read_text_file, read_hdf_file, metric_functions
+
+# Fill method using the middle of the canopy rather than interpolation
+CANOPY_MIDDLE = "canopy_middle"
+# Every nth pixel of existing DTMs is read when estimating a tile's no-data count
+FEATURE_STEP = 4
 
 
 def gediCommands():
@@ -23,36 +37,7 @@ def gediCommands():
     p = argparse.ArgumentParser(
         description=("Script to create DTMs and assess accuracy of simulated data")
     )
-
-    p.add_argument(
-        "--studyarea",
-        dest="studyArea",
-        type=str,
-        default="Bonaly",
-        help=("Study area name, for all sites input 'all'"),
-    )
-
-    p.add_argument(
-        "--interpolate",
-        dest="interpolate",
-        type=bool,
-        default=False,
-        help=("Whether to interpolate values of nodata points"),
-    )
-    p.add_argument(
-        "--int_method",
-        dest="intpMethod",
-        type=str,
-        default="linear",
-        help=("No-data interpolation method; can be 'linear', 'nearest' or 'cubic'"),
-    )
-    p.add_argument(
-        "--lassettings",
-        dest="lasSettings",
-        type=str,
-        default="400505",
-        help=("Choose input based on lastools settings applied to find gound"),
-    )
+    commands.dtm_arguments(p)
 
     cmdargs = p.parse_args()
     return cmdargs
@@ -63,19 +48,24 @@ class DtmCreation(object):
     LVIS data handler
     """
 
-    def __init__(self):
-        pass
+    def __init__(self, cache=None):
+        # ToolCache of mapLidar outputs, None to always run mapLidar
+        self.cache = cache
 
-    def createDTM(self, folder, las_settings):
+    def createDTM(self, folder, las_settings, tiles=None, missing_only=False):
         """Run maplidar command to create DTMs from simulated waveforms
 
         Args:
             folder (str): study site name for folder path
             las_settings (str): lasground settings for folder path
+            tiles (list): only create DTMs for these tiles (x_y), default all
+            missing_only (bool): skip sim files that already have a DTM, for resumed runs
         """
         # Set location of sim files
         simPath = f"data/{folder}/sim_ground{las_settings}"
         sim_list = glob(simPath + "/*.las")
+        if tiles is not None:
+            sim_list = [file for file in sim_list if lasBounds.tileKey(file) in tiles]
 
         # Create simulated data DTM
         for idx, sim_file in enumerate(sim_list):
@@ -87,9 +77,11 @@ class DtmCreation(object):
             # find epsg code for study area
             epsg = lasBounds.findEPSG(folder)
             outname = f"data/{folder}/sim_dtm/{las_settings}/{clip_file}_{las_settings}"
+            if missing_only and os.path.exists(f"{outname}.tif"):
+                continue
 
             # run mapLidar command
-            create_dtm = subprocess.run(
+            returncode = run_command(
                 [
                     "mapLidar",
                     "-input",
@@ -103,10 +95,12 @@ class DtmCreation(object):
                     "-output",
                     f"{outname}",
                 ],
-                check=True,
+                sim_file,
+                outname,
+                self.cache,
             )
 
-            print("The exit code was: %d" % create_dtm.returncode)
+            print("The exit code was: %d" % returncode)
 
     def read_metric_text(self, metric_file, folder):
         """Interpret txt file produced by gediMetric, summarising key values from ALS data (ground, canopy and slope)
@@ -118,38 +112,63 @@ class DtmCreation(object):
         Returns:
             array: geolocated array of ALS values
         """
-        clip_metric = lasBounds.clipNames(metric_file, ".txt")
-        outname = f"data/{folder}/als_metric/{clip_metric}"
-        epsg = lasBounds.findEPSG(folder)
         # Interpret text file
+        return self.als_arrays(
+            read_text_file(metric_file), lasBounds.tileKey(metric_file), folder
+        )
+
+    def read_metric_hdf(self, wave_file, folder):
+        """Compute key values from ALS data (ground, canopy and slope) directly from gediRat waveforms
+
+        Args:
+            wave_file (str): path to gediRat hdf5 file
+            folder (str): study area
+
+        Returns:
+            array: geolocated array of ALS values
+        """
+        return self.als_arrays(
+            read_hdf_file(wave_file), lasBounds.tileKey(wave_file), folder
+        )
+
+    def als_arrays(self, metric_values, tile, folder):
+        """Convert per-waveform ALS values into arrays and tifs
+
+        Args:
+            metric_values (tuple): coordinates, ground, canopy, slope and top height values
+            tile (str): tile coordinates (x_y), tifs are named by lasBounds.alsRaster
+            folder (str): study area
+
+        Returns:
+            array: geolocated array of ALS values
+        """
+        epsg = lasBounds.findEPSG(folder)
         coordinates, ground_values, canopy_values, slope_values, top_height = (
-            read_text_file(metric_file)
+            metric_values
         )
         # Convert text file values into arrays, make plots, and tifs
         als_ground = metric_functions(
             coordinates,
             ground_values,
-            outname=f"{outname}_ground",
+            outname=lasBounds.alsRaster(folder, tile, "ground", extension=""),
             epsg=epsg,
         )
         als_canopy = metric_functions(
             coordinates,
             canopy_values,
-            outname=f"{outname}_canopy",
+            outname=lasBounds.alsRaster(folder, tile, "canopy", extension=""),
             epsg=epsg,
         )
         als_slope = metric_functions(
             coordinates,
             slope_values,
-            outname=f"{outname}_slope",
+            outname=lasBounds.alsRaster(folder, tile, "slope", extension=""),
             epsg=epsg,
         )
         als_t_height = metric_functions(
             coordinates,
             top_height,
-            cmap="Greens",
-            caption="Top height (m)",
-            outname=f"{outname}_t_height",
+            outname=lasBounds.alsRaster(folder, tile, "t_height", extension=""),
             epsg=epsg,
         )
 
@@ -189,7 +208,7 @@ class DtmCreation(object):
         Args:
             als_array (array): 1st array
             sim_array (array): 2nd array
-            edge_buffer (int): Width of the edge buffer to exclude (default is 1 pixel).
+            edge_buffer (int): Width of the edge buffer to exclude (default is 1 pixel), 0 for none.
 
         Returns:
             rmse, r2, bias, data_count, result: metrics and difference array
@@ -198,9 +217,10 @@ class DtmCreation(object):
         valid_mask = (als_array != -999) & (sim_array != 0)
 
         # Exclude edge buffer
-        edge_mask = np.zeros_like(sim_array, dtype=bool)
-        edge_mask[edge_buffer:-edge_buffer, edge_buffer:-edge_buffer] = True
-        valid_mask &= edge_mask
+        if edge_buffer > 0:
+            edge_mask = np.zeros_like(sim_array, dtype=bool)
+            edge_mask[edge_buffer:-edge_buffer, edge_buffer:-edge_buffer] = True
+            valid_mask &= edge_mask
 
         # Filter out no data values
         valid_als = als_array[valid_mask]
@@ -216,6 +236,9 @@ class DtmCreation(object):
         if data_count == 0:
             raise ValueError("No data points found")
 
+        # sklearn takes over a second to import, only loaded once scoring starts
+        from sklearn.metrics import mean_squared_error, r2_score
+
         # Find rmse, r2, and bias
         rmse = np.sqrt(mean_squared_error(flat_als, flat_sim))
         r2 = r2_score(flat_als, flat_sim)
@@ -280,64 +303,229 @@ class DtmCreation(object):
         Returns:
             array: array with no-data filled
         """
+        # If interpolation = False, no data is approximately half way through canopy
+        method = int_meth if interpolation == True else CANOPY_MIDDLE
+        filled, no_data_count = self.fill_methods(array, [method], no_data)
+        return filled[method], no_data_count
+
+    def fill_methods(self, array, methods, no_data, context=None):
+        """Fill no-data gaps in sim_dtm with several methods, sharing geometry between them
+
+        Args:
+            array (array): Array containing no-data points (0 value)
+            methods (list): 'linear', 'cubic', 'nearest' and/or 'canopy_middle'
+            no_data (float): value used to fill 0 values for 'canopy_middle'
+            context (tuple): extra (row, col) points and values outside the array, e.g. a
+                halo from neighbouring tiles
+
+        Returns:
+            dict: filled array for each method, and count of no-data pixels
+        """
         # count no data pixels
         no_data_count = np.sum(array == 0)
 
-        if interpolation == True:
-            # Identify 0 values to be replaced
-            mask = array != 0
+        # Identify 0 values to be replaced
+        mask = array != 0
+
+        # Grid of indices to perform interpolation at
+        x, y = np.indices(array.shape)
+        points = np.column_stack((x[mask], y[mask]))
+        values = array[mask]
+        if context is not None:
+            points = np.concatenate((points, context[0]))
+            values = np.concatenate((values, context[1]))
+
+        # Triangulation is shared by linear and cubic, as in griddata
+        triangulation = None
+        filled = {}
+        for method in methods:
+            if method == CANOPY_MIDDLE:
+                # replace 0 values with appropriate no data for each tile
+                filled[method] = np.where(array == 0, no_data, array)
+                continue
+
+            # scipy is only needed when gaps are interpolated
+            from scipy.spatial import Delaunay
+            from scipy.interpolate import (
+                CloughTocher2DInterpolator,
+                LinearNDInterpolator,
+                NearestNDInterpolator,
+            )
 
-            # Grid of indices to perform interpolation at
-            x, y = np.indices(array.shape)
+            if method == "nearest":
+                interpolator = NearestNDInterpolator(points, values)
+            elif method in ("linear", "cubic"):
+                if triangulation is None:
+                    triangulation = Delaunay(points)
+                if method == "linear":
+                    interpolator = LinearNDInterpolator(
+                        triangulation, values, fill_value=0
+                    )
+                else:
+                    interpolator = CloughTocher2DInterpolator(
+                        triangulation, values, fill_value=0
+                    )
+            else:
+                raise ValueError(f"Unknown interpolation method {method}")
 
             # Apply interpolation functions to 0 values
-            array_interpolated = griddata(
-                (x[mask], y[mask]),
-                array[mask],
-                (x, y),
-                method=f"{int_meth}",
-                fill_value=0,
-            )
+            filled[method] = interpolator(x, y)
 
-            return array_interpolated, no_data_count
-        # If interpolation = False, no data is approximately half way through canopy
-        else:
+        return filled, no_data_count
+
+    @staticmethod
+    def fill_list(interpolation, int_meth):
+        """List no-data fill methods from command line options
 
-            # replace 0 values with appropriate no data for each tile
-            array = np.where(array == 0, no_data, array)
-            return array, no_data_count
+        Args:
+            interpolation (bool): Whether to interpolate and fill no data points
+            int_meth (str or list): method, comma separated methods, or 'all'
+
+        Returns:
+            list: fill methods
+        """
+        if interpolation != True:
+            return [CANOPY_MIDDLE]
+        if isinstance(int_meth, str):
+            if int_meth == "all":
+                return ["linear", "cubic", "nearest", CANOPY_MIDDLE]
+            return int_meth.split(",")
+        return list(int_meth)
+
+    @staticmethod
+    def summary_name(folder, las_settings, method):
+        """Name of summary csv for a fill method, canopy_middle keeps the uninterpolated name
+
+        Args:
+            folder (str): Study site name
+            las_settings (str): lasground.new setings of input sim_ground files
+            method (str): no-data fill method
+
+        Returns:
+            str: csv path
+        """
+        if method == CANOPY_MIDDLE:
+            return f"data/{folder}/summary_{folder}_{las_settings}.csv"
+        return f"data/{folder}/summary_{folder}_{las_settings}_{method}.csv"
 
     #################################################################################################
 
-    def compareDTM(self, folder, interpolation, int_meth, las_settings):
+    def compareDTM(
+        self,
+        folder,
+        interpolation,
+        int_meth,
+        las_settings,
+        als_source="text",
+        tiles=None,
+        write=True,
+        checkpoint=True,
+        resume=False,
+        store=None,
+        halo=0,
+        workers=1,
+        resolutions=(NATIVE_RES,),
+        drop_realizations=True,
+    ):
         """Assess accuracy of simulated DTMs
 
         Args:
             folder (str): Study site name
             interpolation (bool): Whether to interpolate and fill no data points
-            int_meth (str): If interpolating, which method to use
+            int_meth (str or list): If interpolating, which method(s) to use
             las_settings (str): lasground.new setings of input sim_ground files
+            als_source (str): 'text' for gediMetric files, 'hdf' for gediRat waveforms, 'cube' for alsCube
+            tiles (list): only assess these tiles (x_y), default all
+            write (bool): whether to write summary csv files
+            checkpoint (bool): whether to log results as each sim file is scored
+            resume (bool): skip sim files already in the log from a previous run
+            store (ScenarioStore): write differences into the site's chunked store, not tifs
+            halo (int): interpolate each tile with this many pixels of its neighbours, 0 for
+                tiles in isolation
+            workers (int): processes filling tiles in parallel when using a halo
+            resolutions (list): also score coarser levels (multiples of 30 m) aggregated
+                from the same reads
+            drop_realizations (bool): remove the files of realizations above 0 once
+                scored, after every tile when neighbours are read for halos
+
+        Returns:
+            dataframe: accuracy results
         """
+        methods = self.fill_list(interpolation, int_meth)
+        factors = resolutionPyramid.level_factors(resolutions)
+
         # Define file paths
-        als_metric_path = f"data/{folder}/pts_metric"
-        als_metric_list = glob(als_metric_path + "/*.txt")
+        if als_source == "hdf":
+            als_metric_list = glob(f"data/{folder}/sim_waves/*.h5")
+            read_als = self.read_metric_hdf
+        elif als_source == "cube":
+            # Tile views of the prebuilt ALS cube, no parsing or tif writing
+            cube = AlsCube(folder)
+            als_metric_list = list(cube.tiles)
+
+            def read_als(tile, folder):
+                return cube.tile(tile)
+
+        else:
+            als_metric_path = f"data/{folder}/pts_metric"
+            als_metric_list = glob(als_metric_path + "/*.txt")
+            read_als = self.read_metric_text
 
         sim_path = f"data/{folder}/sim_dtm/{las_settings}"
         sim_list = glob(sim_path + "/*.tif")
 
+        # Tile edges are filled from neighbours, so no edge ring is left out
+        halo_fill = None
+        edge_buffer = 1
+        if halo > 0:
+            halo_fill = HaloFill(sim_list, halo, workers)
+            edge_buffer = 0
+
         # Pair up ALS and sim files for comparison
         matched_files = lasBounds.match_files(als_metric_list, sim_list)
+        if tiles is not None:
+            matched_files = {
+                als: sims
+                for als, sims in matched_files.items()
+                if lasBounds.tileKey(als) in tiles
+            }
 
         # Define regex patterns to extract info from file names
         rNPhotons = r"[p]+\d+"
         rNoise = r"[n]+\d+"
+        rRealization = r"_r(\d+)(?:_|$)"
+
+        # Scenarios missing from the store would only fail once their rows were scored
+        if store is not None:
+            sim_names = [sim for sims in matched_files.values() for sim in sims]
+            # The store has no photon model axis, native and gediMetric would share slots
+            if len({lasBounds.photonModel(sim) for sim in sim_names}) > 1:
+                raise ValueError(
+                    f"{folder} mixes native and gediMetric photon files, store one model per run"
+                )
+            store.check_labels(
+                lassettings=[las_settings],
+                interpolation=methods,
+                photons=[
+                    lasBounds.removeStrings(regex.findall(rNPhotons, sim)[0])
+                    for sim in sim_names
+                ],
+                noise=[
+                    lasBounds.removeStrings(regex.findall(rNoise, sim)[0])
+                    for sim in sim_names
+                ],
+            )
 
         # Open lists to be appended to results
         results = {
             "Folder": [],
             "File": [],
+            "Interpolation": [],
             "nPhotons": [],
             "Noise": [],
+            "Photon_model": [],
+            "Realization": [],
+            "Resolution": [],
             "RMSE": [],
             "R2": [],
             "Bias": [],
@@ -349,31 +537,90 @@ class DtmCreation(object):
             "Data_count": [],
         }
 
+        # Log scored sim files as they finish so a crashed run can resume
+        checkpoint_log = None
+        done = {}
+        if checkpoint:
+            checkpoint_log = self.checkpoint_name(
+                folder, las_settings, methods, factors
+            )
+            if resume:
+                done = self.read_checkpoint(checkpoint_log)
+                print(f"resuming from {checkpoint_log}, {len(done)} files done")
+                for rows in done.values():
+                    for row in rows:
+                        # Logs written before these columns were added
+                        lasBounds.append_results(
+                            results,
+                            **{
+                                "Photon_model": lasBounds.photonModel(row["File"]),
+                                "Realization": 0,
+                                "Resolution": NATIVE_RES,
+                                **row,
+                            },
+                        )
+            else:
+                open(checkpoint_log, "w").close()
+
         # Multiple sim files for each als
+        scored_realizations = []
         for als_metric, matched_sim in matched_files.items():
-            for sim_tif in matched_sim:
-                sim_open = rasterio.open(sim_tif)
-
-                # Save file name for results
-                clip_match = lasBounds.clipNames(sim_tif, ".tif")
-                file_name_saved = clip_match
-
-                # extract noise and photon count vals
-                nPhotons = regex.findall(pattern=rNPhotons, string=sim_tif)[0]
-                noise = regex.findall(pattern=rNoise, string=sim_tif)[0]
-                nPhotons = lasBounds.removeStrings(nPhotons)
-                noise = lasBounds.removeStrings(noise)
-
-                # convert matching files to arrays
-                simArray = sim_open.read(1)
-
-                # Extract values from als files
-                als_read, als_canopy, als_slope, als_height = self.read_metric_text(
+            matched_sim = [
+                sim_tif
+                for sim_tif in matched_sim
+                if lasBounds.clipNames(sim_tif, ".tif") not in done
+            ]
+            if not matched_sim:
+                continue
+
+            with memoryReport.stage(
+                "tile",
+                site=folder,
+                lassettings=las_settings,
+                tile=lasBounds.tileKey(als_metric),
+            ):
+                # Extract values from als files, once for all sim files and methods
+                als_read, als_canopy, als_slope, als_height = read_als(
                     als_metric, folder
                 )
                 # find nodata value
                 canopy_middle = self.find_nodata(als_read, als_height)
-                try:
+                # Coarser ALS references, once for all sim files
+                als_levels = {
+                    factor: resolutionPyramid.als_level(
+                        als_read, als_canopy, als_slope, als_height, factor
+                    )
+                    for factor in factors
+                }
+                if halo_fill is not None:
+                    prefilled = halo_fill.fill(
+                        matched_sim, als_read.shape, methods, canopy_middle
+                    )
+
+                for sim_tif in matched_sim:
+                    sim_open = rasterio.open(sim_tif)
+
+                    # Save file name for results
+                    clip_match = lasBounds.clipNames(sim_tif, ".tif")
+                    file_name_saved = clip_match
+
+                    # extract noise and photon count vals
+                    nPhotons = regex.findall(pattern=rNPhotons, string=sim_tif)[0]
+                    noise = regex.findall(pattern=rNoise, string=sim_tif)[0]
+                    nPhotons = lasBounds.removeStrings(nPhotons)
+                    noise = lasBounds.removeStrings(noise)
+                    # Monte Carlo realization, files without one are a single run
+                    realization = regex.findall(pattern=rRealization, string=clip_match)
+                    realization = int(realization[0]) if realization else 0
+                    # Native and gediMetric noise levels differ, so they are kept apart
+                    photon_model = lasBounds.photonModel(clip_match)
+
+                    # convert matching files to arrays
+                    context = None
+                    if halo_fill is not None:
+                        simArray, filled, noData, context = prefilled[sim_tif]
+                    else:
+                        simArray = sim_open.read(1)
 
                     if (
                         # Check array has correct shape
@@ -383,34 +630,11 @@ class DtmCreation(object):
                         # Check array contains over 100 waves
                         and np.count_nonzero(simArray) > 100
                     ):
-                        # fill no-data
-                        sim_read, noData = self.fill_nodata(
-                            simArray, interpolation, int_meth, canopy_middle
-                        )
-                        rmse, rSquared, bias, lenData, difference = self.calc_metrics(
-                            als_read, sim_read
-                        )
-                        # Save and plot tiff of difference with 0 values hidden
-                        masked_diference = ma.masked_where(difference == 0, difference)
-
-                        diff_outname = (
-                            f"data/{folder}/diff_dtm/{las_settings}/{clip_match}.tif"
-                        )
-                        self.rasterio_write(
-                            data=difference,
-                            outname=diff_outname,
-                            template_raster=sim_open,
-                            nodata=0,
-                        )
-
-                        image_name = f"figures/difference/{folder}/CC{clip_match}.png"
-                        image_title = f"Absolute error for {nPhotons} photons and {noise} noise ({folder})"
-                        two_plots(
-                            masked_diference,
-                            als_canopy,
-                            image_name,
-                            image_title,
-                        )
+                        # fill no-data with every method from a single read
+                        if halo_fill is None:
+                            filled, noData = self.fill_methods(
+                                simArray, methods, canopy_middle
+                            )
                         # extract metrics from als arrays
                         mean_cc, stdDev_cc = self.canopy_cover_stats(als_canopy)
                         mean_slope, stdDev_slope = self.canopy_cover_stats(als_slope)
@@ -418,69 +642,591 @@ class DtmCreation(object):
                         print(
                             f"{clip_match} contains under 100 waves or has mismatched array shapes"
                         )
-                        (
-                            rmse,
-                            rSquared,
-                            bias,
-                            noData,
-                            lenData,
-                            mean_cc,
-                            stdDev_cc,
-                            mean_slope,
-                            stdDev_slope,
-                        ) = (
-                            -999,
-                            -999,
-                            -999,
-                            -999,
-                            -999,
-                            -999,
-                            -999,
-                            -999,
-                            -999,
-                        )
+                        filled = None
+
+                    tile_rows = []
+                    for method in methods:
+                        # Keep original output names when only one method is run
+                        suffix = "" if len(methods) == 1 else f"_{method}"
+                        try:
+                            if filled is not None:
+                                rmse, rSquared, bias, lenData, difference = (
+                                    self.calc_metrics(
+                                        als_read, filled[method], edge_buffer
+                                    )
+                                )
+                                # Save tiff of difference, figures are made later by figureShell
+                                # Only the first realization is kept, others are summarised below
+                                if realization == 0 and store is not None:
+                                    store.write_tile(
+                                        las_settings,
+                                        method,
+                                        nPhotons,
+                                        noise,
+                                        difference,
+                                        sim_open.bounds,
+                                    )
+                                elif realization == 0:
+                                    diff_outname = f"data/{folder}/diff_dtm/{las_settings}/{clip_match}{suffix}.tif"
+                                    self.rasterio_write(
+                                        data=difference,
+                                        outname=diff_outname,
+                                        template_raster=sim_open,
+                                        nodata=0,
+                                    )
+                                noData_saved = noData
+                            else:
+                                (
+                                    rmse,
+                                    rSquared,
+                                    bias,
+                                    noData_saved,
+                                    lenData,
+                                    mean_cc,
+                                    stdDev_cc,
+                                    mean_slope,
+                                    stdDev_slope,
+                                ) = (
+                                    -999,
+                                    -999,
+                                    -999,
+                                    -999,
+                                    -999,
+                                    -999,
+                                    -999,
+                                    -999,
+                                    -999,
+                                )
+
+                            # save results for this sim file
+                            tile_rows.append(
+                                dict(
+                                    Folder=folder,
+                                    File=file_name_saved,
+                                    Interpolation=method,
+                                    nPhotons=nPhotons,
+                                    Noise=noise,
+                                    Photon_model=photon_model,
+                                    Realization=realization,
+                                    Resolution=NATIVE_RES,
+                                    RMSE=rmse,
+                                    R2=rSquared,
+                                    Bias=bias,
+                                    Mean_Canopy_cover=mean_cc,
+                                    Std_dev_Canopy_cover=stdDev_cc,
+                                    Mean_slope=mean_slope,
+                                    Std_dev_slope=stdDev_slope,
+                                    NoData_count=noData_saved,
+                                    Data_count=lenData,
+                                )
+                            )
+
+                        except ValueError as e:
+                            print(f"{sim_tif} ({method}) ignored due to error: {e}")
+                            continue
+
+                    # Coarser levels of tiles scored at 30 m, without rereading files
+                    if filled is not None:
+                        for factor, als_arrays in als_levels.items():
+                            tile_rows += self.score_level(
+                                simArray,
+                                als_arrays,
+                                factor,
+                                methods,
+                                dict(
+                                    Folder=folder,
+                                    File=file_name_saved,
+                                    nPhotons=nPhotons,
+                                    Noise=noise,
+                                    Photon_model=photon_model,
+                                    Realization=realization,
+                                ),
+                                edge_buffer,
+                                context,
+                            )
+
+                    # save results to dictionary, and log them before the next file
+                    for row in tile_rows:
+                        lasBounds.append_results(results, **row)
+                    if checkpoint_log is not None:
+                        self.append_checkpoint(checkpoint_log, clip_match, tile_rows)
+
+                    # Only realization 0 is kept, later ones live on in the results
+                    sim_open.close()
+                    if realization > 0 and drop_realizations:
+                        scored_realizations.append(clip_match)
+                        if halo_fill is None:
+                            self.drop_realization(folder, las_settings, clip_match)
+
+        if halo_fill is not None:
+            halo_fill.close()
+            # Halos read neighbouring DTMs, so files go once every tile is filled
+            for clip_match in scored_realizations:
+                self.drop_realization(folder, las_settings, clip_match)
+        resultsDf = pd.DataFrame(results)
+        if write:
+            self.write_summaries(resultsDf, folder, las_settings, methods)
+        return resultsDf
+
+    @staticmethod
+    def drop_realization(folder, las_settings, clip_match):
+        """Remove the DTM and point files of a scored realization
+
+        The .pts file and the txt2las and lasnoise outputs are shared by every
+        lassettings, so they are only removed once no sim_ground folder has the file.
+
+        Args:
+            folder (str): study site
+            las_settings (str): lasground.new settings
+            clip_match (str): sim DTM name without extension
+        """
+        las_suffix = f"_{las_settings}"
+        base = (
+            clip_match[: -len(las_suffix)]
+            if clip_match.endswith(las_suffix)
+            else clip_match
+        )
+        outputs = [
+            f"data/{folder}/sim_dtm/{las_settings}/{clip_match}.tif",
+            f"data/{folder}/sim_ground{las_settings}/{base}.las",
+        ]
+        if not [
+            file
+            for file in glob(f"data/{folder}/sim_ground*/{base}.las")
+            if file not in outputs
+        ]:
+            outputs += [
+                f"data/{folder}/pts_metric/{base}.pts",
+                f"data/{folder}/sim_las/{base}.las",
+                f"data/{folder}/sim_cleaned/{base}.las",
+            ]
+        for file in outputs:
+            if os.path.exists(file):
+                os.remove(file)
+
+    def score_level(
+        self, sim_array, als_arrays, factor, methods, row, edge_buffer=1, context=None
+    ):
+        """Aggregate a sim DTM to a coarser level, fill its no-data and score it
 
-                    # save results to dictionary
-                    lasBounds.append_results(
-                        results,
-                        Folder=folder,
-                        File=file_name_saved,
-                        nPhotons=nPhotons,
-                        Noise=noise,
-                        RMSE=rmse,
-                        R2=rSquared,
-                        Bias=bias,
-                        Mean_Canopy_cover=mean_cc,
-                        Std_dev_Canopy_cover=stdDev_cc,
-                        Mean_slope=mean_slope,
-                        Std_dev_slope=stdDev_slope,
-                        NoData_count=noData,
-                        Data_count=lenData,
+        Args:
+            sim_array (array): sim DTM at 30 m
+            als_arrays (tuple): ALS ground, canopy, slope and top height at this level
+            factor (int): block size in 30 m pixels
+            methods (list): no-data fill methods
+            row (dict): file and scenario columns of the result rows
+            edge_buffer (int): coarse pixels left out at the tile edge, 0 with a halo
+            context (tuple): halo (row, col) points and values at 30 m, None for none
+
+        Returns:
+            list: result rows for each fill method
+        """
+        als_ground, als_canopy, als_slope, als_height = als_arrays
+        level_sim = resolutionPyramid.sim_level(sim_array, factor)
+        # Halo points moved to the pixel grid of this level
+        if context is not None:
+            context = ((context[0] + 0.5) / factor - 0.5, context[1])
+        canopy_middle = self.find_nodata(als_ground, als_height)
+        try:
+            filled, no_data = self.fill_methods(
+                level_sim, methods, canopy_middle, context
+            )
+        except (RuntimeError, ValueError):
+            # Coarse levels may have too few points to triangulate (QhullError), which
+            # only loses the methods that need a triangulation
+            filled, no_data = {}, np.sum(level_sim == 0)
+            for method in methods:
+                try:
+                    method_filled, _ = self.fill_methods(
+                        level_sim, [method], canopy_middle, context
                     )
+                except (RuntimeError, ValueError) as e:
+                    # Qhull messages run over many lines
+                    reason = str(e).splitlines()[0]
+                    print(
+                        f"{row['File']} ({method}, {factor * NATIVE_RES} m) not filled: {reason}"
+                    )
+                    continue
+                filled.update(method_filled)
+        mean_cc, stdDev_cc = self.canopy_cover_stats(als_canopy)
+        mean_slope, stdDev_slope = self.canopy_cover_stats(als_slope)
+
+        rows = []
+        for method in methods:
+            if method not in filled:
+                continue
+            try:
+                rmse, rSquared, bias, lenData, _ = self.calc_metrics(
+                    als_ground, filled[method], edge_buffer
+                )
+            except ValueError as e:
+                print(f"{row['File']} ({method}, {factor * NATIVE_RES} m) ignored: {e}")
+                continue
+            rows.append(
+                dict(
+                    row,
+                    Interpolation=method,
+                    Resolution=factor * NATIVE_RES,
+                    RMSE=rmse,
+                    R2=rSquared,
+                    Bias=bias,
+                    Mean_Canopy_cover=mean_cc,
+                    Std_dev_Canopy_cover=stdDev_cc,
+                    Mean_slope=mean_slope,
+                    Std_dev_slope=stdDev_slope,
+                    NoData_count=no_data,
+                    Data_count=lenData,
+                )
+            )
+        return rows
+
+    @staticmethod
+    def checkpoint_name(folder, las_settings, methods, factors=()):
+        """Name of the result log for a site, setting, set of fill methods and levels"""
+        levels = "".join(f"_{factor * NATIVE_RES}m" for factor in factors)
+        return f"data/{folder}/checkpoint_{folder}_{las_settings}_{'-'.join(methods)}{levels}.jsonl"
+
+    @staticmethod
+    def append_checkpoint(checkpoint_log, clip_match, rows):
+        """Append results of one sim file to the log and flush them to disk
+
+        Args:
+            checkpoint_log (str): log file path
+            clip_match (str): sim file name
+            rows (list): result rows for each fill method
+        """
+        line = json.dumps({"File": clip_match, "rows": rows}, default=float)
+        with open(checkpoint_log, "a") as log:
+            log.write(line + "\n")
+            log.flush()
+            os.fsync(log.fileno())
 
-                except ValueError as e:
-                    print(f"{sim_tif} ignored due to error: {e}")
+    @staticmethod
+    def read_checkpoint(checkpoint_log):
+        """Read results logged by a previous run
+
+        Args:
+            checkpoint_log (str): log file path
+
+        Returns:
+            dict: sim file name: result rows
+        """
+        done = {}
+        if not os.path.exists(checkpoint_log):
+            return done
+        # Cut a line left unfinished by a crash, new entries would be appended onto it
+        with open(checkpoint_log, "rb+") as log:
+            data = log.read()
+            if data and not data.endswith(b"\n"):
+                log.truncate(data.rfind(b"\n") + 1)
+        with open(checkpoint_log) as log:
+            for line in log:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line may be cut short by a crash, that file is rerun
                     continue
+                done[entry["File"]] = entry["rows"]
+        return done
 
-        resultsDf = pd.DataFrame(results)
-        if interpolation == True:
-            outCsv = f"data/{folder}/summary_{folder}_{las_settings}_{int_meth}.csv"
-        else:
-            outCsv = f"data/{folder}/summary_{folder}_{las_settings}.csv"
+    def write_summaries(self, resultsDf, folder, las_settings, methods):
+        """Write accuracy results to summary csv files
+
+        Args:
+            resultsDf (dataframe): results from compareDTM
+            folder (str): Study site name
+            las_settings (str): lasground.new setings of input sim_ground files
+            methods (list): no-data fill methods
+        """
+        # Realizations are not independent tiles, summaries keep the first of each
+        if resultsDf["Realization"].max() > 0:
+            self.write_realizations(resultsDf, folder, las_settings)
+        resultsDf = resultsDf[resultsDf["Realization"] == 0]
+
+        # Every level in one table, other summaries keep to 30 m for analyseResults
+        if (resultsDf["Resolution"] != NATIVE_RES).any():
+            outCsv = f"data/{folder}/pyramid_{folder}_{las_settings}.csv"
+            resultsDf.to_csv(outCsv, index=False)
+            print("Results written to: ", outCsv)
+        resultsDf = resultsDf[resultsDf["Resolution"] == NATIVE_RES]
+
+        # One summary per method, read by analyseResults
+        for method in methods:
+            outCsv = self.summary_name(folder, las_settings, method)
+            resultsDf[resultsDf["Interpolation"] == method].to_csv(outCsv, index=False)
+            print("Results written to: ", outCsv)
+
+        if len(methods) > 1:
+            outCsv = f"data/{folder}/summary_{folder}_{las_settings}_methods.csv"
+            resultsDf.to_csv(outCsv, index=False)
+            print("Results written to: ", outCsv)
+
+    def write_realizations(self, resultsDf, folder, las_settings):
+        """Add results to every realization's rows so far, and write their spread per tile
+
+        Realizations are simulated and scored one per run, so rows of earlier runs are
+        read back. A rescored file replaces its earlier rows.
+
+        Args:
+            resultsDf (dataframe): results from compareDTM
+            folder (str): Study site name
+            las_settings (str): lasground.new setings of input sim_ground files
+        """
+        outCsv = f"data/{folder}/realizations_{folder}_{las_settings}.csv"
+        if os.path.exists(outCsv):
+            # Photon and noise values are parsed from names as strings
+            previous = pd.read_csv(outCsv, dtype={"nPhotons": str, "Noise": str})
+            rescored = previous["File"].isin(resultsDf["File"])
+            resultsDf = pd.concat([previous[~rescored], resultsDf], ignore_index=True)
         resultsDf.to_csv(outCsv, index=False)
-        print("Results written to: ", outCsv)
+        print("Every realization written to: ", outCsv)
 
+        outCsv = f"data/{folder}/realization_spread_{folder}_{las_settings}.csv"
+        self.realization_summary(resultsDf).to_csv(outCsv, index=False)
+        print("Realization spread written to: ", outCsv)
 
-if __name__ == "__main__":
+    @staticmethod
+    def realization_summary(resultsDf):
+        """Mean and spread of each tile's accuracy over Monte Carlo realizations
+
+        Args:
+            resultsDf (dataframe): results from compareDTM
+
+        Returns:
+            dataframe: one row per tile, fill method and photon/noise scenario
+        """
+        scored = resultsDf[resultsDf["RMSE"] != -999].copy()
+        # Tile and scenario name without the realization
+        scored["File"] = scored["File"].str.replace(r"_r\d+(?=_|$)", "", regex=True)
+
+        grouped = scored.groupby(
+            [
+                "Folder",
+                "File",
+                "Interpolation",
+                "Resolution",
+                "Photon_model",
+                "nPhotons",
+                "Noise",
+            ],
+            sort=True,
+        )
+        summary = grouped[["RMSE", "Bias", "Data_count"]].agg(["mean", "std"])
+        summary.columns = [f"{metric}_{stat}" for metric, stat in summary.columns]
+        summary.insert(0, "Realizations", grouped.size())
+        return summary.reset_index()
+
+    def queue_jobs(
+        self,
+        sites,
+        las_list,
+        interpolation,
+        int_meth,
+        als_source,
+        store=False,
+        halo=0,
+        resolutions=(NATIVE_RES,),
+    ):
+        """Job grid of site x lassettings x tile, fill methods share each job's reads
+
+        Args:
+            sites (list): study site names
+            las_list (list): lasground.new settings
+            interpolation (bool): Whether to interpolate and fill no data points
+            int_meth (str): If interpolating, which method(s) to use
+            als_source (str): 'text' for gediMetric files, 'hdf' for gediRat waveforms
+            store (bool): write differences into each site's chunked store
+            halo (int): halo width in pixels, neighbouring DTMs must exist before workers start
+            resolutions (list): resolutions scored, coarser levels are aggregated from 30 m
+
+        Returns:
+            dict: job id: job description
+        """
+        jobs = {}
+        # Sim files and DTMs of each tile, from one glob per site and lassettings
+        tile_files, dtm_files = {}, set()
+        for folder in sites:
+            for las_settings in las_list:
+                sim_list = glob(f"data/{folder}/sim_ground{las_settings}/*.las")
+                dtm_files.update(glob(f"data/{folder}/sim_dtm/{las_settings}/*.tif"))
+                for sim_file in sim_list:
+                    tile = lasBounds.tileKey(sim_file)
+                    if tile is not None:
+                        tile_files.setdefault((folder, las_settings, tile), []).append(
+                            sim_file
+                        )
+                tiles = sorted({lasBounds.tileKey(file) for file in sim_list} - {None})
+                for tile in tiles:
+                    jobs[f"{folder}_{las_settings}_{tile}"] = {
+                        "folder": folder,
+                        "las_settings": las_settings,
+                        "tile": tile,
+                        "interpolation": interpolation,
+                        "int_meth": int_meth,
+                        "als_source": als_source,
+                        "store": store,
+                        "halo": halo,
+                        "resolutions": list(resolutions),
+                    }
+
+        # Workers claim the longest estimated jobs first
+        ordered = CostModel().longest_first(
+            "dtm",
+            list(jobs.values()),
+            lambda job: self.tile_features(
+                job["folder"],
+                job["las_settings"],
+                tile_files[(job["folder"], job["las_settings"], job["tile"])],
+                dtm_files,
+            ),
+        )
+        return {
+            f"{job['folder']}_{job['las_settings']}_{job['tile']}": job
+            for job in ordered
+        }
+
+    @staticmethod
+    def tile_features(folder, las_settings, sim_files, dtm_files):
+        """Cost model features of a tile job, from las headers and any existing DTMs
+
+        Args:
+            folder (str): study site
+            las_settings (str): lasground.new settings
+            sim_files (list): sim las files of the tile
+            dtm_files (set): sim DTMs that exist
+
+        Returns:
+            dict: sim points and no-data pixels to fill, over all scenarios
+        """
+        sim_points, nodata_cells = 0, 0
+        for sim_file in sim_files:
+            sim_points += lasBounds.lasPointCount(sim_file)
+            clip_file = lasBounds.clipNames(sim_file, ".las")
+            sim_tif = (
+                f"data/{folder}/sim_dtm/{las_settings}/{clip_file}_{las_settings}.tif"
+            )
+            if sim_tif in dtm_files:
+                # A decimated read is enough for a runtime estimate
+                with rasterio.open(sim_tif) as raster:
+                    sample = raster.read(
+                        1,
+                        out_shape=(
+                            -(-raster.height // FEATURE_STEP),
+                            -(-raster.width // FEATURE_STEP),
+                        ),
+                    )
+                nodata_cells += int(np.sum(sample == 0)) * FEATURE_STEP**2
+            else:
+                # Before DTMs exist, every pixel of the tile is counted
+                bounds = lasBounds.lasMBR(sim_file)
+                nodata_cells += ((bounds[2] - bounds[0]) // 30 + 1) * (
+                    (bounds[3] - bounds[1]) // 30 + 1
+                )
+        return {"sim_points": sim_points, "nodata_cells": nodata_cells}
+
+    def run_queue_job(self, job):
+        """Create and assess the DTMs of one tile from the work queue
+
+        Args:
+            job (dict): job description from queue_jobs
+
+        Returns:
+            dataframe: accuracy results
+        """
+        t = time.perf_counter()
+        # Halo jobs read neighbouring DTMs, which are all created by queue init
+        if not job.get("halo"):
+            with memoryReport.stage(
+                "createDTM",
+                site=job["folder"],
+                lassettings=job["las_settings"],
+                tile=job["tile"],
+            ):
+                self.createDTM(job["folder"], job["las_settings"], tiles=[job["tile"]])
+        # Stores are created by queue init, workers only write chunks
+        store = ScenarioStore(store_name(job["folder"])) if job.get("store") else None
+        resultsDf = self.compareDTM(
+            job["folder"],
+            job["interpolation"],
+            job["int_meth"],
+            job["las_settings"],
+            job["als_source"],
+            tiles=[job["tile"]],
+            write=False,
+            checkpoint=False,
+            store=store,
+            halo=job.get("halo", 0),
+            resolutions=job.get("resolutions", [NATIVE_RES]),
+            # Other jobs read this tile's DTMs for their halos, files go at merge
+            drop_realizations=not job.get("halo"),
+        )
+        resultsDf["las_settings"] = job["las_settings"]
+        if "features" in job:
+            record_runtime("dtm", job["features"], time.perf_counter() - t)
+        return resultsDf
+
+    def merge_queue(self, queue_dir):
+        """Write summary csv files from the results of a work queue
+
+        Args:
+            queue_dir (str): shared queue directory
+        """
+        jobs, resultsDf = workQueue.read_results(queue_dir)
+        if resultsDf.empty:
+            print(f"No results found in {queue_dir}")
+            return
+
+        # Summaries cover every tile, one write per site and setting
+        merged = set()
+        for job in jobs.values():
+            folder, las_settings = job["folder"], job["las_settings"]
+            if (folder, las_settings) in merged:
+                continue
+            merged.add((folder, las_settings))
+
+            group = resultsDf[
+                (resultsDf["Folder"] == folder)
+                & (resultsDf["las_settings"].astype(str) == las_settings)
+            ]
+            methods = self.fill_list(job["interpolation"], job["int_meth"])
+            self.write_summaries(
+                group.drop(columns="las_settings"), folder, las_settings, methods
+            )
+            if job.get("halo"):
+                for clip_match in group.loc[group["Realization"] > 0, "File"].unique():
+                    self.drop_realization(folder, las_settings, clip_match)
+
+
+def main(cmdargs):
+    """Run DTM creation and accuracy assessment from parsed command line arguments
+
+    Args:
+        cmdargs (Namespace): arguments from gediCommands or the cli dtm subcommand
+    """
     t = time.perf_counter()
 
-    cmdargs = gediCommands()
     study_area = cmdargs.studyArea
     interpolation = cmdargs.interpolate
     int_meth = cmdargs.intpMethod
     las_settings = cmdargs.lasSettings
+    als_source = cmdargs.alsSource
+    queue_dir = cmdargs.queue
+    queue_action = cmdargs.queueAction
+    resume = cmdargs.resume
+    use_store = cmdargs.store
+    halo = cmdargs.halo
+    workers = cmdargs.workers
+    resolutions = [int(res) for res in cmdargs.resolutions.split(",")]
+    # Queue workers often share one command line, so each writes its own report
+    memoryReport.start(
+        cmdargs.memReport,
+        workQueue.worker_name() if queue_action == "work" else None,
+    )
+    cache = (
+        None if cmdargs.cache is None else ToolCache(cmdargs.cache, cmdargs.cacheQuota)
+    )
 
-    dtm_creator = DtmCreation()
+    dtm_creator = DtmCreation(cache)
 
     # Option to run on all sites
     if study_area == "all":
@@ -495,15 +1241,71 @@ if __name__ == "__main__":
             "wind_river",
         ]
         print(f"working on all sites ({study_sites})")
-        for site in study_sites:
-            dtm_creator.createDTM(site, las_settings)
-            dtm_creator.compareDTM(site, interpolation, int_meth, las_settings)
-
     # Run on specified site
     else:
+        study_sites = [study_area]
         print(f"working on {study_area}")
-        dtm_creator.createDTM(study_area, las_settings)
-        dtm_creator.compareDTM(study_area, interpolation, int_meth, las_settings)
+
+    # Share site, lassettings and tile jobs between workers through a directory
+    if queue_dir is not None:
+        if queue_action == "init":
+            las_list = LAS_SETTINGS if las_settings == "all" else [las_settings]
+            # Halos cross tiles, so every DTM exists before any worker fills a tile
+            if halo > 0:
+                for site in study_sites:
+                    for las in las_list:
+                        dtm_creator.createDTM(site, las)
+            jobs = dtm_creator.queue_jobs(
+                study_sites,
+                las_list,
+                interpolation,
+                int_meth,
+                als_source,
+                use_store,
+                halo,
+                resolutions,
+            )
+            # Create stores once, before any worker writes to them
+            if use_store:
+                methods = dtm_creator.fill_list(interpolation, int_meth)
+                for site in study_sites:
+                    ScenarioStore.create(site).clear(las_list, methods)
+            workQueue.init_queue(queue_dir, jobs)
+        elif queue_action == "merge" or workQueue.run_worker(
+            queue_dir, dtm_creator.run_queue_job
+        ):
+            dtm_creator.merge_queue(queue_dir)
+
+    else:
+        for site in study_sites:
+            # A resumed run only creates the DTMs a crash left unmade
+            with memoryReport.stage("createDTM", site=site, lassettings=las_settings):
+                dtm_creator.createDTM(site, las_settings, missing_only=resume)
+            store = ScenarioStore.create(site) if use_store else None
+            # A resumed run keeps the differences of the tiles it skips
+            if store is not None and not resume:
+                store.clear(
+                    [las_settings], dtm_creator.fill_list(interpolation, int_meth)
+                )
+            with memoryReport.stage("compareDTM", site=site, lassettings=las_settings):
+                dtm_creator.compareDTM(
+                    site,
+                    interpolation,
+                    int_meth,
+                    las_settings,
+                    als_source,
+                    resume=resume,
+                    store=store,
+                    halo=halo,
+                    workers=workers,
+                    resolutions=resolutions,
+                )
+
+    memoryReport.finish()
 
     t = time.perf_counter() - t
     print("time taken: ", t, " seconds")
+
+
+if __name__ == "__main__":
+    main(gediCommands())
@@ -0,0 +1,245 @@
+"""Stream difference rasters into per-pixel error statistics for each scenario, in bounded memory"""
+
+import os
+import time
+import argparse
+import numpy as np
+import rasterio
+import regex
+from rasterio.transform import from_origin
+import lasBounds
+import commands
+from commands import LAS_SETTINGS
+from scenarioStore import diff_source, read_diff, grid_window, ALIGN_TOLERANCE
+
+# Scenario axes that can be used to group difference rasters
+AXES = ["lassettings", "photon_model", "photons", "noise", "interpolation"]
+# Bands of each error map
+STATS = ["count", "mean", "std", "max_abs"]
+
+
+def errorCommands():
+    """
+    Read commandline arguments
+    """
+    p = argparse.ArgumentParser(
+        description=("Script to make per-pixel error maps from difference rasters")
+    )
+    commands.error_arguments(p)
+
+    cmdargs = p.parse_args()
+    return cmdargs
+
+
+def diff_scenario(diff_tif, las_settings):
+    """Scenario of a difference raster from its file name
+
+    Args:
+        diff_tif (str): difference raster path
+        las_settings (str): lastools settings folder of raster
+
+    Returns:
+        dict: value of each scenario axis
+    """
+    clip_diff = lasBounds.clipNames(diff_tif, ".tif")
+    nPhotons = lasBounds.removeStrings(regex.findall(r"[p]+\d+", clip_diff)[0])
+    noise = lasBounds.removeStrings(regex.findall(r"[n]+\d+", clip_diff)[0])
+
+    # Method suffix follows the lassettings when several methods were scored
+    method = clip_diff.split(f"_{las_settings}", 1)[-1].lstrip("_") or "single"
+    return {
+        "lassettings": las_settings,
+        "photon_model": lasBounds.photonModel(clip_diff),
+        "photons": nPhotons,
+        "noise": noise,
+        "interpolation": method,
+    }
+
+
+def site_grid(diff_list):
+    """Grid covering all difference rasters of a site, read from raster headers only
+
+    Args:
+        diff_list (list): difference raster paths
+
+    Returns:
+        dict: origin, resolution, shape and crs of site grid
+    """
+    left, top, right, bottom = np.inf, -np.inf, -np.inf, np.inf
+    for diff_tif in diff_list:
+        with rasterio.open(diff_tif) as diff_open:
+            bounds = diff_open.bounds
+            res = diff_open.res[0]
+            crs = diff_open.crs
+        left, right = min(left, bounds.left), max(right, bounds.right)
+        bottom, top = min(bottom, bounds.bottom), max(top, bounds.top)
+
+    return {
+        "left": left,
+        "top": top,
+        "res": res,
+        # Whole pixels, off-lattice tiles are resampled onto the grid when added
+        "shape": (
+            int(np.ceil((top - bottom) / res - ALIGN_TOLERANCE)),
+            int(np.ceil((right - left) / res - ALIGN_TOLERANCE)),
+        ),
+        "crs": crs,
+    }
+
+
+class ErrorAccumulator(object):
+    """
+    Running per-pixel count, mean, variance (Welford) and max absolute error on the site grid
+    """
+
+    def __init__(self, grid):
+        self.grid = grid
+        self.count = np.zeros(grid["shape"], dtype="int32")
+        self.mean = np.zeros(grid["shape"], dtype="float64")
+        self.m2 = np.zeros(grid["shape"], dtype="float64")
+        self.max_abs = np.zeros(grid["shape"], dtype="float32")
+
+    def add(self, diff_tif, store=None):
+        """Add one difference raster, 0 values are no-data
+
+        Args:
+            diff_tif (str): difference raster name from diff_source
+            store (ScenarioStore): store the difference is read from, None for tifs
+        """
+        difference, bounds = read_diff(diff_tif, store)
+
+        # Window of this tile within the site grid, cropped to the grid
+        difference, row, col = grid_window(self.grid, difference, bounds)
+        top, left = max(row, 0), max(col, 0)
+        bottom = min(row + difference.shape[0], self.grid["shape"][0])
+        right = min(col + difference.shape[1], self.grid["shape"][1])
+        if bottom <= top or right <= left:
+            return
+        difference = difference[
+            top - row : bottom - row, left - col : right - col
+        ].astype("float64")
+        window = (slice(top, bottom), slice(left, right))
+
+        valid = difference != 0
+        count = self.count[window]
+        mean = self.mean[window]
+        m2 = self.m2[window]
+        max_abs = self.max_abs[window]
+
+        # Welford update, only where the tile has data
+        count[valid] += 1
+        delta = difference[valid] - mean[valid]
+        mean[valid] += delta / count[valid]
+        m2[valid] += delta * (difference[valid] - mean[valid])
+        max_abs[valid] = np.maximum(max_abs[valid], np.abs(difference[valid]))
+
+    def write(self, outname):
+        """Write count, mean, standard deviation and max absolute error as a 4 band tif
+
+        Args:
+            outname (str): output file name
+        """
+        std = np.zeros(self.grid["shape"], dtype="float64")
+        has_data = self.count > 0
+        std[has_data] = np.sqrt(self.m2[has_data] / self.count[has_data])
+
+        bands = np.stack([self.count, self.mean, std, self.max_abs]).astype("float32")
+        bands[:, ~has_data] = -999
+
+        transform = from_origin(
+            self.grid["left"], self.grid["top"], self.grid["res"], self.grid["res"]
+        )
+        with rasterio.open(
+            outname,
+            "w",
+            driver="GTiff",
+            height=self.grid["shape"][0],
+            width=self.grid["shape"][1],
+            count=len(STATS),
+            dtype="float32",
+            crs=self.grid["crs"],
+            transform=transform,
+            nodata=-999,
+            compress="deflate",
+        ) as raster:
+            raster.write(bands)
+            raster.descriptions = tuple(STATS)
+        print(f"Error map written to {outname}")
+
+
+def error_maps(folder, las_list, group_by):
+    """Make an error map for each scenario group of a site
+
+    Args:
+        folder (str): study site
+        las_list (list): lastools settings to include
+        group_by (list): scenario axes kept apart
+    """
+    # Group raster names by scenario, only file names are held in memory
+    diff_list, store = diff_source(folder, las_list)
+    groups = {}
+    for diff_tif in diff_list:
+        scenario = diff_scenario(diff_tif, os.path.basename(os.path.dirname(diff_tif)))
+        key = tuple(scenario[axis] for axis in group_by)
+        groups.setdefault(key, []).append(diff_tif)
+
+    if not groups:
+        print(f"No difference rasters found for {folder}")
+        return
+
+    # Store differences are already on the store's site grid
+    grid = site_grid(diff_list) if store is None else store.grid
+    os.makedirs(f"data/{folder}/error_maps", exist_ok=True)
+
+    # One scenario's accumulators in memory at a time
+    for idx, (key, diff_list) in enumerate(sorted(groups.items())):
+        print(f"working on {folder} scenario {idx + 1} of {len(groups)}: {key}")
+        accumulator = ErrorAccumulator(grid)
+        for diff_tif in diff_list:
+            accumulator.add(diff_tif, store)
+
+        name = "_".join(f"{axis}{value}" for axis, value in zip(group_by, key))
+        accumulator.write(f"data/{folder}/error_maps/{folder}_{name or 'all'}.tif")
+
+
+def main(cmdargs):
+    """Write error maps from parsed command line arguments
+
+    Args:
+        cmdargs (Namespace): arguments from errorCommands
+    """
+    t = time.perf_counter()
+
+    study_area = cmdargs.studyArea
+    las_settings = cmdargs.lasSettings
+    group_by = [axis for axis in cmdargs.groupBy.split(",") if axis]
+    for axis in group_by:
+        if axis not in AXES:
+            raise ValueError(f"Unknown scenario axis {axis}, choose from {AXES}")
+
+    las_list = LAS_SETTINGS if las_settings == "all" else [las_settings]
+
+    if study_area == "all":
+        study_sites = [
+            "Bonaly",
+            "hubbard_brook",
+            "la_selva",
+            "nouragues",
+            "oak_ridge",
+            "paracou",
+            "robson_creek",
+            "wind_river",
+        ]
+        print(f"working on all sites ({study_sites})")
+    else:
+        study_sites = [study_area]
+
+    for site in study_sites:
+        error_maps(site, las_list, group_by)
+
+    t = time.perf_counter() - t
+    print("time taken: ", t, " seconds")
+
+
+if __name__ == "__main__":
+    main(errorCommands())
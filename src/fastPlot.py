@@ -0,0 +1,219 @@
+"""Matplotlib-free raster previews, same calls as plotting.one_plot and plotting.two_plots"""
+
+import zlib
+import struct
+import numpy as np
+import numpy.ma as ma
+
+# ColorBrewer control points of the matplotlib colormaps
+CMAP_POINTS = {
+    "Spectral": [
+        "#9e0142",
+        "#d53e4f",
+        "#f46d43",
+        "#fdae61",
+        "#fee08b",
+        "#ffffbf",
+        "#e6f598",
+        "#abdda4",
+        "#66c2a5",
+        "#3288bd",
+        "#5e4fa2",
+    ],
+    "Greens": [
+        "#f7fcf5",
+        "#e5f5e0",
+        "#c7e9c0",
+        "#a1d99b",
+        "#74c476",
+        "#41ab5d",
+        "#238b45",
+        "#006d2c",
+        "#00441b",
+    ],
+}
+
+# Colour of masked and no-data pixels, and of the background
+MASK_COLOUR = np.array([255, 255, 255], dtype=np.uint8)
+BACKGROUND = np.array([255, 255, 255], dtype=np.uint8)
+LUT_SIZE = 256
+
+
+def colour_lut(cmap):
+    """Build a lookup table of colours by interpolating colormap control points
+
+    Args:
+        cmap (str): 'Spectral' or 'Greens'
+
+    Returns:
+        array: (256, 3) uint8 colours
+    """
+    points = np.array(
+        [
+            [int(hex_code[i : i + 2], 16) for i in (1, 3, 5)]
+            for hex_code in CMAP_POINTS[cmap]
+        ]
+    )
+    positions = np.linspace(0, 1, len(points))
+    samples = np.linspace(0, 1, LUT_SIZE)
+    lut = np.column_stack(
+        [np.interp(samples, positions, points[:, band]) for band in range(3)]
+    )
+    return np.round(lut).astype(np.uint8)
+
+
+# Lookup tables are built once per process
+LUTS = {cmap: colour_lut(cmap) for cmap in CMAP_POINTS}
+
+
+def colour_map(data, cmap, vmin=None, vmax=None, nodata=None):
+    """Apply colormap to an array, masked, nan and no-data pixels are left blank
+
+    Args:
+        data (array): values, may be a masked array
+        cmap (str): colormap name
+        vmin (float): value at bottom of colormap, default data minimum
+        vmax (float): value at top of colormap, default data maximum
+        nodata (float): additional value to hide
+
+    Returns:
+        array: (rows, cols, 3) uint8 image, and the vmin, vmax used
+    """
+    values = ma.masked_invalid(ma.asarray(data, dtype="float64"))
+    if nodata is not None:
+        values = ma.masked_equal(values, nodata)
+    mask = ma.getmaskarray(values)
+
+    valid = values.compressed()
+    if vmin is None:
+        vmin = valid.min() if valid.size else 0
+    if vmax is None:
+        vmax = valid.max() if valid.size else 1
+    scale = (LUT_SIZE - 1) / (vmax - vmin) if vmax > vmin else 0
+
+    index = np.clip((values.filled(vmin) - vmin) * scale, 0, LUT_SIZE - 1)
+    image = LUTS[cmap][index.astype(np.intp)]
+    image[mask] = MASK_COLOUR
+    return image, vmin, vmax
+
+
+def colour_bar(cmap, width, height):
+    """Horizontal colour bar image
+
+    Args:
+        cmap (str): colormap name
+        width (int): bar width in pixels
+        height (int): bar height in pixels
+
+    Returns:
+        array: (height, width, 3) uint8 image
+    """
+    index = np.linspace(0, LUT_SIZE - 1, width).astype(np.intp)
+    return np.broadcast_to(LUTS[cmap][index], (height, width, 3))
+
+
+def panel(data, cmap, scale, vmin=None, vmax=None, nodata=None):
+    """Colour-mapped raster enlarged by scale, with a colour bar beneath
+
+    Args:
+        data (array): raster values
+        cmap (str): colormap name
+        scale (int): pixels per raster cell
+        vmin (float): value at bottom of colormap
+        vmax (float): value at top of colormap
+        nodata (float): additional value to hide
+
+    Returns:
+        array: panel image, and the vmin, vmax used
+    """
+    image, vmin, vmax = colour_map(data, cmap, vmin, vmax, nodata)
+    image = np.repeat(np.repeat(image, scale, axis=0), scale, axis=1)
+
+    bar_gap = max(scale, 4)
+    bar = colour_bar(cmap, image.shape[1], max(scale * 2, 8))
+    gap = np.broadcast_to(BACKGROUND, (bar_gap, image.shape[1], 3))
+    return np.concatenate([image, gap, bar]), vmin, vmax
+
+
+def png_chunk(chunk_type, data):
+    """Encode one png chunk with length and crc"""
+    body = chunk_type + data
+    return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+
+def write_png(image, outname, text=None):
+    """Encode an RGB image directly as png
+
+    Args:
+        image (array): (rows, cols, 3) uint8 image
+        outname (str): output file name
+        text (dict): keyword: value pairs stored as png text chunks
+    """
+    height, width = image.shape[:2]
+    # Each row starts with filter type 0 (none)
+    rows = np.concatenate(
+        [np.zeros((height, 1), dtype=np.uint8), image.reshape(height, width * 3)],
+        axis=1,
+    )
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+
+    chunks = [png_chunk(b"IHDR", header)]
+    for keyword, value in (text or {}).items():
+        chunks.append(
+            png_chunk(b"tEXt", f"{keyword}\0{value}".encode("latin-1", "replace"))
+        )
+    chunks.append(png_chunk(b"IDAT", zlib.compress(rows.tobytes(), 6)))
+    chunks.append(png_chunk(b"IEND", b""))
+
+    with open(outname, "wb") as file:
+        file.write(b"\x89PNG\r\n\x1a\n" + b"".join(chunks))
+
+
+def two_plots(data, data2, outname, title, scale=8, nodata=None):
+    """Plot 2 datasets side by side, used to quickly check results for each tile
+
+    Args:
+        data (array): Data set, shown with Spectral colormap
+        data2 (array): Canopy cover, shown with Greens colormap from 0 to 1
+        outname (str): output file name
+        title (str): stored in the png metadata
+        scale (int): pixels per raster cell
+        nodata (float): additional value to hide in both datasets
+    """
+    panel1, vmin, vmax = panel(data, "Spectral", scale, nodata=nodata)
+    panel2, _, _ = panel(data2, "Greens", scale, vmin=0, vmax=1, nodata=nodata)
+
+    # Pad panels to a common height and join with a gap
+    height = max(panel1.shape[0], panel2.shape[0])
+    panels = []
+    for image in (panel1, panel2):
+        pad = np.broadcast_to(BACKGROUND, (height - image.shape[0], image.shape[1], 3))
+        panels.append(np.concatenate([image, pad]))
+    gap = np.broadcast_to(BACKGROUND, (height, max(scale * 2, 8), 3))
+    image = np.concatenate([panels[0], gap, panels[1]], axis=1)
+
+    write_png(
+        image,
+        outname,
+        text={
+            "Title": title,
+            "Elevation difference (m)": f"{vmin:.2f} to {vmax:.2f}",
+            "Canopy Cover (%)": "0 to 1",
+        },
+    )
+
+
+def one_plot(data, outname, cmap, caption, scale=8, nodata=None):
+    """Plot a single dataset
+
+    Args:
+        data (array): Data to plot
+        outname (str): Output file name, without extension
+        cmap (str): 'Spectral' or 'Greens'
+        caption (str): colour bar label, stored in the png metadata
+        scale (int): pixels per raster cell
+        nodata (float): additional value to hide
+    """
+    image, vmin, vmax = panel(data, cmap, scale, nodata=nodata)
+    write_png(image, f"{outname}.png", text={caption: f"{vmin:.2f} to {vmax:.2f}"})
+    print(f"Figure saved to {outname}.png")
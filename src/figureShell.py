@@ -0,0 +1,194 @@
+"""Make difference figures from rasters written by dtmShell, separately from the accuracy assessment"""
+
+import time
+import argparse
+from multiprocessing import Pool
+import numpy as np
+import rasterio
+import regex
+import lasBounds
+import commands
+from plotting import two_plots
+import fastPlot
+from commands import LAS_SETTINGS
+from scenarioStore import ScenarioStore, diff_source, read_diff
+from alsCube import AlsCube, cube_exists
+
+
+def figureCommands():
+    """
+    Read commandline arguments
+    """
+    p = argparse.ArgumentParser(
+        description=("Script to plot elevation differences written by dtmShell")
+    )
+    commands.figure_arguments(p)
+
+    cmdargs = p.parse_args()
+    return cmdargs
+
+
+def split_option(option):
+    """Convert comma separated option into list, None means no filter"""
+    return None if option is None else option.split(",")
+
+
+def find_figures(folder, las_list, tiles=None, photons=None, noise=None, fast=False):
+    """List difference rasters to plot, with their canopy source and figure name
+
+    Canopy cover is read from the site's ALS cube when it holds the tile, as
+    `--als_source cube` runs never write the ALS canopy tifs.
+
+    Args:
+        folder (str): study site
+        las_list (list): lastools settings
+        tiles (list): tiles (x_y) to keep, None for all
+        photons (list): photon counts to keep, None for all
+        noise (list): noise levels to keep, None for all
+        fast (bool): use fastPlot instead of matplotlib
+
+    Returns:
+        list: figure jobs
+    """
+    diff_list, store = diff_source(folder, las_list)
+    cube = AlsCube(folder) if cube_exists(folder) else None
+
+    figure_jobs = []
+    for diff_tif in diff_list:
+        clip_diff = lasBounds.clipNames(diff_tif, ".tif")
+        tile = lasBounds.tileKey(diff_tif)
+
+        # extract noise and photon count vals
+        nPhotons = lasBounds.removeStrings(regex.findall(r"[p]+\d+", clip_diff)[0])
+        iNoise = lasBounds.removeStrings(regex.findall(r"[n]+\d+", clip_diff)[0])
+
+        if (
+            (tiles is not None and tile not in tiles)
+            or (photons is not None and nPhotons not in photons)
+            or (noise is not None and iNoise not in noise)
+        ):
+            continue
+
+        # None reads the tile's canopy band from the cube, which is opened per worker
+        figure_jobs.append(
+            {
+                "diff": diff_tif,
+                # Workers open the store themselves, None reads the tif
+                "store": None if store is None else store.path,
+                "folder": folder,
+                "tile": tile,
+                "canopy": (
+                    None
+                    if cube is not None and tile in cube
+                    else lasBounds.alsRaster(folder, tile, "canopy")
+                ),
+                "outname": f"figures/difference/{folder}/CC{clip_diff}.png",
+                "title": f"Absolute error for {nPhotons} photons and {iNoise} noise ({folder})",
+                "fast": fast,
+            }
+        )
+    return figure_jobs
+
+
+def plot_difference(figure_job):
+    """Plot difference raster next to ALS canopy cover
+
+    Args:
+        figure_job (dict): figure job from find_figures
+
+    Returns:
+        str: figure file name
+    """
+    # 0 values hidden, as written by dtmShell
+    store = None if figure_job["store"] is None else ScenarioStore(figure_job["store"])
+    difference, _ = read_diff(figure_job["diff"], store)
+    masked_difference = np.ma.masked_equal(difference, 0)
+    if figure_job["canopy"] is None:
+        cube = AlsCube(figure_job["folder"])
+        als_canopy = np.array(cube.band(figure_job["tile"], "canopy"))
+    else:
+        with rasterio.open(figure_job["canopy"]) as canopy_open:
+            als_canopy = canopy_open.read(1)
+
+    if figure_job["fast"]:
+        fastPlot.two_plots(
+            masked_difference,
+            als_canopy,
+            figure_job["outname"],
+            figure_job["title"],
+            nodata=-999,
+        )
+    else:
+        two_plots(
+            masked_difference, als_canopy, figure_job["outname"], figure_job["title"]
+        )
+    return figure_job["outname"]
+
+
+def make_figures(figure_jobs, workers):
+    """Make figures, in parallel if more than 1 worker
+
+    Args:
+        figure_jobs (list): figure jobs from find_figures
+        workers (int): number of processes
+    """
+    if workers > 1:
+        with Pool(workers) as pool:
+            done = pool.imap_unordered(plot_difference, figure_jobs)
+            for idx, outname in enumerate(done):
+                print(f"{idx + 1} of {len(figure_jobs)}: figure saved to {outname}")
+    else:
+        for idx, figure_job in enumerate(figure_jobs):
+            outname = plot_difference(figure_job)
+            print(f"{idx + 1} of {len(figure_jobs)}: figure saved to {outname}")
+
+
+def main(cmdargs):
+    """Make difference figures from parsed command line arguments
+
+    Args:
+        cmdargs (Namespace): arguments from figureCommands
+    """
+    t = time.perf_counter()
+
+    study_area = cmdargs.studyArea
+    las_settings = cmdargs.lasSettings
+
+    if study_area == "all":
+        study_sites = [
+            "Bonaly",
+            "hubbard_brook",
+            "la_selva",
+            "nouragues",
+            "oak_ridge",
+            "paracou",
+            "robson_creek",
+            "wind_river",
+        ]
+    else:
+        study_sites = [study_area]
+
+    if las_settings == "all":
+        las_list = LAS_SETTINGS
+    else:
+        las_list = [las_settings]
+
+    figure_jobs = []
+    for site in study_sites:
+        figure_jobs += find_figures(
+            site,
+            las_list,
+            tiles=split_option(cmdargs.tiles),
+            photons=split_option(cmdargs.photons),
+            noise=split_option(cmdargs.noise),
+            fast=cmdargs.fast,
+        )
+    print(f"making {len(figure_jobs)} figures")
+    make_figures(figure_jobs, cmdargs.workers)
+
+    t = time.perf_counter() - t
+    print("time taken: ", t, " seconds")
+
+
+if __name__ == "__main__":
+    main(figureCommands())
@@ -1,15 +1,25 @@
 """Using values from Lowe et al. (2024), estimate cost of global lidar system in USD """
 
+import os
+import time
 import argparse
 
+# Cost per satellite (kUS), data downlink is per year of operation
+PLATFORM_COST = 10000
+LAUNCH_COST = 1350
+OPTICS_COST = 844
+DATA_COST = 500  # approximate
 
-def readCommands():
-    """
-    Read commandline arguments
+
+def cost_arguments(p):
+    """Add cost arguments to a parser, shared with the cli cost subcommand
+
+    Args:
+        p (ArgumentParser): parser or subcommand parser
+
+    Returns:
+        ArgumentParser: the same parser
     """
-    p = argparse.ArgumentParser(
-        description=("Writes out properties of GEDI waveform files")
-    )
     p.add_argument(
         "--sat_count",
         dest="satCount",
@@ -17,16 +27,110 @@ def readCommands():
         default=1,
         help=("Number of satellites\nDefault 1"),
     )
+    p.add_argument(
+        "--trade_space",
+        dest="tradeSpace",
+        type=bool,
+        default=False,
+        help=(
+            "Evaluate every combination of the grids below and write the Pareto optimal ones"
+        ),
+    )
+    p.add_argument(
+        "--sat_counts",
+        dest="satCounts",
+        type=str,
+        default="1:100",
+        help=("Trade space satellite counts, 'start:stop[:step]' or comma separated"),
+    )
+    p.add_argument(
+        "--years",
+        dest="years",
+        type=str,
+        default="1:10",
+        help=("Trade space mission durations in years"),
+    )
+    p.add_argument(
+        "--platform_costs",
+        dest="platformCosts",
+        type=str,
+        default="8000,10000,12000",
+        help=("Trade space platform costs per satellite (kUS)"),
+    )
+    p.add_argument(
+        "--launch_costs",
+        dest="launchCosts",
+        type=str,
+        default="1000,1350,1700",
+        help=("Trade space launch costs per satellite (kUS)"),
+    )
+    p.add_argument(
+        "--optics_costs",
+        dest="opticsCosts",
+        type=str,
+        default="600,844,1100",
+        help=("Trade space optics costs per satellite at --ref_photons (kUS)"),
+    )
+    p.add_argument(
+        "--data_costs",
+        dest="dataCosts",
+        type=str,
+        default="400,500,600",
+        help=("Trade space data downlink costs per satellite and year (kUS)"),
+    )
+    p.add_argument(
+        "--bs_table",
+        dest="bsTable",
+        type=str,
+        default="data/beam_sensitivity/400505/summary_stats_bs4_o1.csv",
+        help=("Beam sensitivity summary from analyseResults.py"),
+    )
+    p.add_argument(
+        "--photon_model",
+        dest="photonModel",
+        type=str,
+        default="gediMetric",
+        help=(
+            "Photon model of the beam sensitivities, gediMetric or native\nDefault gediMetric"
+        ),
+    )
+    p.add_argument(
+        "--ref_photons",
+        dest="refPhotons",
+        type=float,
+        default=149,
+        help=(
+            "Photon count the optics costs are for, optics cost scales linearly with photons"
+        ),
+    )
+    p.add_argument(
+        "--trade_out",
+        dest="tradeOut",
+        type=str,
+        default="data/gls_trade_space.csv",
+        help=("Table of Pareto optimal configurations"),
+    )
+    return p
+
+
+def readCommands():
+    """
+    Read commandline arguments
+    """
+    p = argparse.ArgumentParser(
+        description=("Writes out properties of GEDI waveform files")
+    )
+    cost_arguments(p)
     cmdargs = p.parse_args()
     return cmdargs
 
 
 def sat_cost(count):
     """Total estimated cost for a years operations in USD"""
-    platform_cost = 10000 * count
-    launch_cost = 1350 * count
-    optics_cost = 844 * count
-    data_cost = 500 * count  # approximate
+    platform_cost = PLATFORM_COST * count
+    launch_cost = LAUNCH_COST * count
+    optics_cost = OPTICS_COST * count
+    data_cost = DATA_COST * count
     total_cost = platform_cost + launch_cost + optics_cost + data_cost
     initial_cost = ((total_cost - data_cost) / total_cost) * 100
     operational_costs = 100 - initial_cost
@@ -40,7 +144,221 @@ def sat_cost(count):
     )
 
 
-if __name__ == "__main__":
-    cmdargs = readCommands()
+def parse_grid(text):
+    """Values of a trade space axis
+
+    Args:
+        text (str): 'start:stop[:step]' (stop included) or comma separated values
+
+    Returns:
+        array: axis values
+    """
+    import numpy as np
+
+    if ":" in text:
+        start, stop, *step = (float(value) for value in text.split(":"))
+        step = step[0] if step else 1
+        values = np.arange(start, stop + step / 2, step)
+    else:
+        values = np.array([float(value) for value in text.split(",")])
+    # Whole numbers stay integers in the results table
+    return values.astype(int) if np.all(values == np.round(values)) else values
+
+
+def beam_table(bs_table, photon_model="gediMetric"):
+    """Canopy cover reached by each photon count and noise level, at every site
+
+    Args:
+        bs_table (str): beam sensitivity summary csv from analyseResults.py
+        photon_model (str): gediMetric or native, their noise levels differ
+
+    Returns:
+        dataframe: beam sensitivity indexed by noise, a column per photon count, the
+            lowest over sites and NaN where a combination was not assessed at every site
+    """
+    import pandas as pd
+
+    df = pd.read_csv(bs_table).dropna(subset=["beam_sensitivity"])
+    # Summaries written before the column existed are all from gediMetric
+    if "Photon_model" in df:
+        df = df[df["Photon_model"] == photon_model]
+    elif photon_model != "gediMetric":
+        df = df.iloc[0:0]
+    # A configuration has to work at every site, so the worst site sets its sensitivity
+    sensitivity = df.pivot_table(
+        index="Noise", columns="nPhotons", values="beam_sensitivity", aggfunc="min"
+    )
+    # The minimum over only some sites would overstate the sensitivity
+    n_sites = df.pivot_table(
+        index="Noise", columns="nPhotons", values="Folder", aggfunc="nunique"
+    )
+    return sensitivity.where(n_sites == df["Folder"].nunique())
+
+
+def pareto_front(cost, capacity, beam, sensitivity):
+    """Configurations not dominated by another of the same group
+
+    A configuration is dominated when another in its group costs no more, reaches at
+    least the same canopy cover and has at least as many satellite years. Each group
+    is sorted by cost, then for each beam setting a running maximum of capacity over
+    cheaper configurations with that sensitivity or more finds the dominated ones, so
+    no pairs are compared.
+
+    Args:
+        cost (array): total cost (groups, configurations), lower is better
+        capacity (array): satellite years of each configuration, higher is better
+        beam (array): beam setting of each configuration
+        sensitivity (array): beam sensitivity (groups, beam settings), higher is better
+
+    Returns:
+        array: boolean mask of Pareto optimal configurations, shaped like cost
+    """
+    import numpy as np
+
+    order = np.argsort(cost, axis=1)
+    sorted_cost = np.take_along_axis(cost, order, axis=1)
+    # Equal costs put the better configurations first, exact duplicates keep one
+    ties = (sorted_cost[:, 1:] == sorted_cost[:, :-1]).any(axis=1)
+    if ties.any():
+        order[ties] = np.lexsort(
+            (
+                -sensitivity[ties][:, beam],
+                -np.broadcast_to(capacity, cost.shape)[ties],
+                cost[ties],
+            ),
+            axis=1,
+        )
+    capacity, beam = capacity[order], beam[order]
+    beam_sensitivity = np.take_along_axis(sensitivity, beam, axis=1)
+
+    dominated = np.zeros(cost.shape, dtype=bool)
+    for idx in range(sensitivity.shape[1]):
+        candidates = np.where(
+            beam_sensitivity >= sensitivity[:, idx : idx + 1], capacity, -np.inf
+        )
+        best = np.maximum.accumulate(candidates, axis=1)
+        # Best of the configurations sorted before each one
+        before = np.concatenate(
+            (np.full((len(cost), 1), -np.inf), best[:, :-1]), axis=1
+        )
+        dominated |= (beam == idx) & (before >= capacity)
+
+    front = np.zeros(cost.shape, dtype=bool)
+    np.put_along_axis(front, order, ~dominated, axis=1)
+    return front
+
+
+def trade_space(cmdargs):
+    """Cost every combination of satellite count, duration, unit costs and beam setting
+
+    Args:
+        cmdargs (Namespace): arguments from readCommands or the cli cost subcommand
+
+    Returns:
+        dataframe: Pareto optimal configurations of each cost and noise scenario
+    """
+    # Imported here, the cli imports this module to build its parser
+    import numpy as np
+    import pandas as pd
+
+    beams = beam_table(cmdargs.bsTable, cmdargs.photonModel)
+    photons = beams.columns.to_numpy(dtype=float)
+    # Combinations not assessed never make the front
+    sensitivity = beams.to_numpy(dtype=float, copy=True)
+    missing = np.isnan(sensitivity)
+    sensitivity[missing] = -np.inf
+
+    # Unit costs and noise are assumptions, not design choices, so each of their
+    # combinations is a group with its own front. Group axes come first so every
+    # group is one row of the flattened grid.
+    axes = [
+        parse_grid(cmdargs.platformCosts),
+        parse_grid(cmdargs.launchCosts),
+        parse_grid(cmdargs.opticsCosts),
+        parse_grid(cmdargs.dataCosts),
+        np.arange(len(beams)),
+        parse_grid(cmdargs.satCounts),
+        parse_grid(cmdargs.years),
+        np.arange(len(photons)),
+    ]
+    shape = tuple(len(axis) for axis in axes)
+    n_groups, n_designs = int(np.prod(shape[:5])), int(np.prod(shape[5:]))
+    print(f"Evaluating {n_groups * n_designs} configurations")
+
+    # Each axis along its own dimension, broadcast to the full grid
+    platform, launch, optics, data, noise, count, years, beam = (
+        axis.reshape([-1 if dim == idx else 1 for dim in range(len(axes))])
+        for idx, axis in enumerate(axes)
+    )
+    # Brighter lasers need larger optics and power, scaled from the reference design
+    build_cost = count * (
+        platform + launch + optics * photons[beam] / cmdargs.refPhotons
+    )
+    total_cost = build_cost + count * years * data
+    total_cost = np.where(missing[noise, beam], np.inf, total_cost)
+
+    capacity = np.broadcast_to(count * years, (1,) * 5 + shape[5:]).ravel()
+    beam_idx = np.broadcast_to(beam, (1,) * 5 + shape[5:]).ravel()
+    group_sensitivity = np.broadcast_to(
+        sensitivity[noise[..., 0, 0, 0]], shape[:5] + (len(photons),)
+    ).reshape(n_groups, -1)
+    total_cost = total_cost.reshape(n_groups, n_designs)
+    front = pareto_front(total_cost, capacity, beam_idx, group_sensitivity)
+    front = np.flatnonzero(front & np.isfinite(total_cost))
+
+    index = np.unravel_index(front, shape)
+    results = pd.DataFrame(
+        {
+            "Sat_count": axes[5][index[5]],
+            "Years": axes[6][index[6]],
+            "Platform_cost": axes[0][index[0]],
+            "Launch_cost": axes[1][index[1]],
+            "Optics_cost": axes[2][index[2]],
+            "Data_cost": axes[3][index[3]],
+            "nPhotons": beams.columns.to_numpy()[index[7]],
+            "Noise": beams.index.to_numpy()[index[4]],
+            "Beam_sensitivity": sensitivity[index[4], index[7]],
+            "Sat_years": capacity[front % n_designs],
+            "Build_cost": np.broadcast_to(build_cost, shape).ravel()[front],
+            "Total_cost": total_cost.ravel()[front],
+        }
+    )
+    # Groups in grid order, each from its cheapest configuration
+    results = results.sort_values(
+        [
+            "Platform_cost",
+            "Launch_cost",
+            "Optics_cost",
+            "Data_cost",
+            "Noise",
+            "Total_cost",
+        ],
+        kind="stable",
+        ignore_index=True,
+    )
+    print(f"{len(results)} Pareto optimal configurations of {n_groups * n_designs}")
+    return results
+
+
+def main(cmdargs):
+    """Run the cost estimate from parsed command line arguments
+
+    Args:
+        cmdargs (Namespace): arguments from readCommands or the cli cost subcommand
+    """
+    if cmdargs.tradeSpace:
+        t = time.perf_counter()
+        results = trade_space(cmdargs)
+        os.makedirs(os.path.dirname(cmdargs.tradeOut) or ".", exist_ok=True)
+        results.to_csv(cmdargs.tradeOut, index=False)
+        print(f"Results written to: {cmdargs.tradeOut}")
+        t = time.perf_counter() - t
+        print("time taken: ", t, " seconds")
+        return
+
     count = cmdargs.satCount
     sat_cost(count)
+
+
+if __name__ == "__main__":
+    main(readCommands())
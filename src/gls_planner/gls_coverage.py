@@ -0,0 +1,567 @@
+"""Simulate ground tracks of a constellation of lidar satellites in circular orbits, to estimate revisit time and daily coverage of a global or site grid"""
+
+import os
+import time
+import argparse
+
+# Earth constants, km and seconds
+EARTH_RADIUS = 6371.0
+EARTH_MU = 398600.4418
+EARTH_J2 = 1.08263e-3
+EARTH_ROTATION = 7.2921159e-5
+KM_PER_DEGREE = 111.195
+DAY = 86400
+
+# Approximate centres (latitude, longitude) of the study sites
+SITES = {
+    "Bonaly": (55.89, -3.27),
+    "hubbard_brook": (43.94, -71.75),
+    "la_selva": (10.43, -84.01),
+    "nouragues": (4.08, -52.68),
+    "oak_ridge": (35.96, -84.29),
+    "paracou": (5.27, -52.92),
+    "robson_creek": (-17.12, 145.63),
+    "wind_river": (45.82, -121.95),
+}
+
+
+def coverage_arguments(p):
+    """Add coverage arguments to a parser, shared with the cli coverage subcommand
+
+    Args:
+        p (ArgumentParser): parser or subcommand parser
+
+    Returns:
+        ArgumentParser: the same parser
+    """
+    p.add_argument(
+        "--sat_count",
+        dest="satCount",
+        type=int,
+        default=1,
+        help=("Number of satellites\nDefault 1"),
+    )
+    p.add_argument(
+        "--planes",
+        dest="planes",
+        type=int,
+        default=0,
+        help=("Number of orbital planes, satellites spread evenly, 0 for one each"),
+    )
+    p.add_argument(
+        "--phasing",
+        dest="phasing",
+        type=int,
+        default=1,
+        help=("Walker phasing factor between satellites of neighbouring planes"),
+    )
+    p.add_argument(
+        "--altitude",
+        dest="altitude",
+        type=float,
+        default=420,
+        help=("Orbit altitude (km)"),
+    )
+    p.add_argument(
+        "--inclination",
+        dest="inclination",
+        type=float,
+        default=97,
+        help=("Orbit inclination (degrees)"),
+    )
+    p.add_argument(
+        "--beams",
+        dest="beams",
+        type=int,
+        default=8,
+        help=("Number of lidar beams, spread evenly across the swath"),
+    )
+    p.add_argument(
+        "--swath",
+        dest="swath",
+        type=float,
+        default=4.2,
+        help=("Across track distance between the outer beams (km)"),
+    )
+    p.add_argument(
+        "--days",
+        dest="days",
+        type=float,
+        default=1,
+        help=("Length of the simulation (days)"),
+    )
+    p.add_argument(
+        "--step",
+        dest="step",
+        type=float,
+        default=1,
+        help=("Time between ground track samples (seconds)"),
+    )
+    p.add_argument(
+        "--chunk",
+        dest="chunk",
+        type=float,
+        default=900,
+        help=("Seconds simulated at once, bounds memory"),
+    )
+    p.add_argument(
+        "--area",
+        dest="area",
+        type=str,
+        default="global",
+        help=("'global', a study site name or 'all' for each study site"),
+    )
+    p.add_argument(
+        "--cell",
+        dest="cell",
+        type=float,
+        default=1,
+        help=("Site grid cell size (km)"),
+    )
+    p.add_argument(
+        "--site_size",
+        dest="siteSize",
+        type=float,
+        default=10,
+        help=("Width of the square site grid (km)"),
+    )
+    p.add_argument(
+        "--global_cell",
+        dest="globalCell",
+        type=float,
+        default=0.5,
+        help=("Global grid cell size (degrees)"),
+    )
+    p.add_argument(
+        "--gap",
+        dest="gap",
+        type=float,
+        default=600,
+        help=("Hits of a cell further apart than this (seconds) are separate visits"),
+    )
+    p.add_argument(
+        "--coverage_out",
+        dest="coverageOut",
+        type=str,
+        default="data/coverage",
+        help=("Directory of daily coverage tables and revisit rasters"),
+    )
+    return p
+
+
+def readCommands():
+    """
+    Read commandline arguments
+    """
+    p = argparse.ArgumentParser(
+        description=("Simulates ground track coverage of a lidar constellation")
+    )
+    coverage_arguments(p)
+    cmdargs = p.parse_args()
+    return cmdargs
+
+
+class Constellation(object):
+    """
+    Walker constellation of satellites in circular orbits, with nodal precession
+    from J2 and ground tracks in an Earth fixed frame
+    """
+
+    def __init__(self, sat_count, planes, phasing, altitude, inclination):
+        # Imported here, the cli imports this module to build its parser
+        import numpy as np
+
+        planes = planes if planes > 0 else sat_count
+        if sat_count % planes != 0:
+            raise ValueError(f"{sat_count} satellites do not fill {planes} planes")
+        per_plane = sat_count // planes
+        plane, slot = np.divmod(np.arange(sat_count), per_plane)
+
+        self.inclination = np.radians(inclination)
+        self.raan = 2 * np.pi * plane / planes
+        self.anomaly = (
+            2 * np.pi * slot / per_plane + 2 * np.pi * phasing * plane / sat_count
+        )
+
+        radius = EARTH_RADIUS + altitude
+        self.motion = np.sqrt(EARTH_MU / radius**3)
+        self.precession = (
+            -1.5
+            * self.motion
+            * EARTH_J2
+            * (EARTH_RADIUS / radius) ** 2
+            * np.cos(self.inclination)
+        )
+        # Upper bound of ground speed, orbital plus Earth rotation (km/s)
+        self.ground_speed = self.motion * EARTH_RADIUS + EARTH_ROTATION * EARTH_RADIUS
+
+    def positions(self, sats, times, offsets=0.0):
+        """Latitude and longitude of beam footprints
+
+        Args:
+            sats (array): satellite index, broadcast with times
+            times (array): seconds from the start
+            offsets (array): across track beam offsets (km), broadcast with times
+
+        Returns:
+            array, array: latitude and longitude (degrees)
+        """
+        import numpy as np
+
+        u = self.anomaly[sats] + self.motion * times
+        raan = self.raan[sats] + self.precession * times
+        sin_i, cos_i = np.sin(self.inclination), np.cos(self.inclination)
+        cos_u, sin_u = np.cos(u), np.sin(u)
+        cos_raan, sin_raan = np.cos(raan), np.sin(raan)
+
+        # Satellite direction and orbit normal, inertial frame
+        x = cos_u * cos_raan - sin_u * cos_i * sin_raan
+        y = cos_u * sin_raan + sin_u * cos_i * cos_raan
+        z = sin_u * sin_i
+        angle = np.asarray(offsets) / EARTH_RADIUS
+        cos_a, sin_a = np.cos(angle), np.sin(angle)
+        x = x * cos_a + sin_i * sin_raan * sin_a
+        y = y * cos_a - sin_i * cos_raan * sin_a
+        z = z * cos_a + cos_i * sin_a
+
+        lat = np.degrees(np.arcsin(np.clip(z, -1, 1)))
+        # Earth turns beneath the orbit
+        lon = np.degrees(np.arctan2(y, x) - EARTH_ROTATION * times)
+        return lat, (lon + 180) % 360 - 180
+
+
+class CoverageGrid(object):
+    """
+    Latitude/longitude grid recording visits to each cell, updated one time window
+    at a time so memory depends on the grid, not the length of the simulation
+    """
+
+    def __init__(self, west, south, east, north, cell_lon, cell_lat, gap):
+        import numpy as np
+
+        self.west, self.north = west, north
+        self.cell_lon, self.cell_lat = cell_lon, cell_lat
+        self.n_cols = int(round((east - west) / cell_lon))
+        self.n_rows = int(round((north - south) / cell_lat))
+        self.bounds = west, south, east, north
+        self.gap = gap
+        n_cells = self.n_rows * self.n_cols
+
+        # Cell areas, so coverage fractions are not biased towards the poles
+        lat = north - (np.arange(self.n_rows) + 0.5) * cell_lat
+        self.area = np.repeat(np.cos(np.radians(lat)), self.n_cols)
+
+        self.last_hit = np.full(n_cells, -np.inf)
+        self.last_visit = np.full(n_cells, -np.inf)
+        self.first_visit = np.full(n_cells, np.inf)
+        self.visits = np.zeros(n_cells, dtype=np.int64)
+        self.revisit_sum = np.zeros(n_cells)
+        self.revisit_max = np.zeros(n_cells)
+        self.last_day = np.full(n_cells, -1, dtype=np.int64)
+        self.day_area = {}
+
+    def near(self, lat, lon, margin):
+        """Whether ground track samples are within a margin (degrees) of the grid"""
+        import numpy as np
+
+        west, south, east, north = self.bounds
+        if east - west >= 360:
+            return (lat >= south - margin) & (lat <= north + margin)
+        # Longitude margin widens towards the poles
+        lon_margin = margin / max(np.cos(np.radians(max(abs(south), abs(north)))), 0.1)
+        centre = (west + east) / 2
+        lon_distance = np.abs((lon - centre + 180) % 360 - 180)
+        return (
+            (lat >= south - margin)
+            & (lat <= north + margin)
+            & (lon_distance <= (east - west) / 2 + lon_margin)
+        )
+
+    def cells(self, lat, lon):
+        """Cell index of each footprint, -1 outside the grid"""
+        import numpy as np
+
+        rows = np.floor((self.north - lat) / self.cell_lat).astype(np.int64)
+        cols = np.floor(((lon - self.west) % 360) / self.cell_lon).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.n_rows) & (cols >= 0) & (cols < self.n_cols)
+        return np.where(inside, rows * self.n_cols + cols, -1)
+
+    def update(self, cells, times):
+        """Add the hits of one time window, windows must be added in time order
+
+        Args:
+            cells (array): cell index of each hit
+            times (array): time of each hit (seconds)
+        """
+        import numpy as np
+
+        if len(cells) == 0:
+            return
+        order = np.lexsort((times, cells))
+        cells, times = cells[order], times[order]
+        same_cell = np.concatenate(([False], cells[1:] == cells[:-1]))
+        last_of_cell = np.concatenate((cells[1:] != cells[:-1], [True]))
+
+        # A hit starts a new visit when the cell was last hit more than gap ago
+        previous = self.last_hit[cells]
+        previous[same_cell] = times[:-1][same_cell[1:]]
+        starts = times - previous > self.gap
+        self.last_hit[cells[last_of_cell]] = times[last_of_cell]
+
+        visit_cells, visit_times = cells[starts], times[starts]
+        if len(visit_cells):
+            same_visit_cell = np.concatenate(
+                ([False], visit_cells[1:] == visit_cells[:-1])
+            )
+            last_visit_of_cell = np.concatenate(
+                (visit_cells[1:] != visit_cells[:-1], [True])
+            )
+            previous_visit = self.last_visit[visit_cells]
+            previous_visit[same_visit_cell] = visit_times[:-1][same_visit_cell[1:]]
+            revisit = visit_times - previous_visit
+            repeat = np.isfinite(revisit)
+            np.add.at(self.revisit_sum, visit_cells[repeat], revisit[repeat])
+            np.maximum.at(self.revisit_max, visit_cells[repeat], revisit[repeat])
+            np.add.at(self.visits, visit_cells, 1)
+            np.minimum.at(self.first_visit, visit_cells, visit_times)
+            self.last_visit[visit_cells[last_visit_of_cell]] = visit_times[
+                last_visit_of_cell
+            ]
+
+        # Area covered each day, counting each cell once per day
+        days = (times // DAY).astype(np.int64)
+        new_day = np.concatenate(
+            ([True], (cells[1:] != cells[:-1]) | (days[1:] != days[:-1]))
+        )
+        new_day &= days != self.last_day[cells]
+        for day in np.unique(days[new_day]):
+            in_day = new_day & (days == day)
+            self.day_area[day] = self.day_area.get(day, 0.0) + float(
+                self.area[cells[in_day]].sum()
+            )
+        self.last_day[cells[last_of_cell]] = days[last_of_cell]
+
+    def daily(self, n_days):
+        """Fraction of the grid area covered each day and since the start
+
+        Args:
+            n_days (int): days simulated
+
+        Returns:
+            dataframe: one row per day
+        """
+        import numpy as np
+        import pandas as pd
+
+        total = self.area.sum()
+        visited = np.isfinite(self.first_visit)
+        first_day = (self.first_visit[visited] // DAY).astype(np.int64)
+        cumulative = np.cumsum(
+            np.bincount(first_day, weights=self.area[visited], minlength=n_days)
+        )[:n_days]
+        return pd.DataFrame(
+            {
+                "Day": np.arange(n_days),
+                "Fraction_covered": [
+                    self.day_area.get(day, 0.0) / total for day in range(n_days)
+                ],
+                "Cumulative_fraction": cumulative / total,
+            }
+        )
+
+    def revisit_hours(self):
+        """Mean time between visits of each cell (hours), NaN with fewer than two visits"""
+        import numpy as np
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.revisit_sum / (self.visits - 1)
+        mean[self.visits < 2] = np.nan
+        return mean.reshape(self.n_rows, self.n_cols) / 3600
+
+
+def area_grid(area, cmdargs):
+    """Empty coverage grid of the globe or of a square around a study site"""
+    if area == "global":
+        cell = cmdargs.globalCell
+        return CoverageGrid(-180, -90, 180, 90, cell, cell, cmdargs.gap)
+
+    import numpy as np
+
+    lat, lon = SITES[area]
+    # Equal sized cells in km, converted to degrees at the site's latitude
+    cell_lat = cmdargs.cell / KM_PER_DEGREE
+    cell_lon = cell_lat / np.cos(np.radians(lat))
+    n_cells = max(int(round(cmdargs.siteSize / cmdargs.cell)), 1)
+    return CoverageGrid(
+        lon - n_cells * cell_lon / 2,
+        lat - n_cells * cell_lat / 2,
+        lon + n_cells * cell_lon / 2,
+        lat + n_cells * cell_lat / 2,
+        cell_lon,
+        cell_lat,
+        cmdargs.gap,
+    )
+
+
+def window_hits(constellation, grid, start, end, cmdargs):
+    """Grid cells hit by beam footprints in one time window
+
+    Ground tracks are first sampled coarsely to find the satellites and times near
+    the grid, then only those are sampled every step, with sub-steps so the track
+    between samples is rasterised when cells are smaller than the distance travelled.
+
+    Args:
+        constellation (Constellation): satellites
+        grid (CoverageGrid): grid being covered
+        start, end (float): time window (seconds)
+        cmdargs (Namespace): arguments from readCommands
+
+    Returns:
+        array, array: cell index and time of each hit
+    """
+    import numpy as np
+
+    step = cmdargs.step
+    travel = constellation.ground_speed * step
+    cell_km = min(grid.cell_lat, grid.cell_lon) * KM_PER_DEGREE
+    n_sub = max(int(np.ceil(2 * travel / cell_km)), 1)
+    # Coarse samples only help when the grid is a small part of the globe
+    n_fine = 1 if grid.bounds[2] - grid.bounds[0] >= 360 else max(int(60 // step), 1)
+    coarse = step * n_fine
+
+    # Satellites and coarse times near the grid
+    coarse_times = np.arange(start, end, coarse)
+    sats = np.arange(len(constellation.raan))
+    lat, lon = constellation.positions(sats[:, None], coarse_times[None, :])
+    margin = (constellation.ground_speed * coarse + cmdargs.swath) / KM_PER_DEGREE
+    sat_idx, time_idx = np.nonzero(grid.near(lat, lon, margin))
+    if len(sat_idx) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+
+    # Every step of those coarse intervals, sub-steps and beams
+    times = coarse_times[time_idx][:, None] + np.arange(n_fine)[None, :] * step
+    times = times[:, :, None, None]
+    sub_times = times + (np.arange(n_sub) * step / n_sub)[None, None, :, None]
+    offsets = np.linspace(-cmdargs.swath / 2, cmdargs.swath / 2, cmdargs.beams)
+    if cmdargs.beams == 1:
+        offsets = np.zeros(1)
+    lat, lon = constellation.positions(
+        sat_idx[:, None, None, None], sub_times, offsets[None, None, None, :]
+    )
+    cells = grid.cells(lat, lon)
+    hit_times = np.broadcast_to(times, cells.shape)
+    hit = (cells >= 0) & (hit_times < end)
+    return cells[hit], hit_times[hit]
+
+
+def write_revisit(grid, outname):
+    """Write mean revisit time (hours) of each cell as a geotiff"""
+    # Imported here, the cli imports this module to build its parser
+    import numpy as np
+    import rasterio
+    from rasterio.transform import from_origin
+
+    revisit = np.nan_to_num(grid.revisit_hours(), nan=-999).astype("float32")
+    with rasterio.open(
+        outname,
+        "w",
+        driver="GTiff",
+        height=grid.n_rows,
+        width=grid.n_cols,
+        count=1,
+        dtype="float32",
+        crs="EPSG:4326",
+        transform=from_origin(grid.west, grid.north, grid.cell_lon, grid.cell_lat),
+        nodata=-999,
+    ) as raster:
+        raster.write(revisit, 1)
+
+
+def simulate_coverage(area, cmdargs):
+    """Simulate the constellation over a grid, in time windows of cmdargs.chunk seconds
+
+    Args:
+        area (str): 'global' or a study site
+        cmdargs (Namespace): arguments from readCommands or the cli coverage subcommand
+
+    Returns:
+        dataframe, dataframe: daily coverage, and one row of revisit statistics of the grid
+    """
+    import numpy as np
+    import pandas as pd
+
+    constellation = Constellation(
+        cmdargs.satCount,
+        cmdargs.planes,
+        cmdargs.phasing,
+        cmdargs.altitude,
+        cmdargs.inclination,
+    )
+    grid = area_grid(area, cmdargs)
+    duration = cmdargs.days * DAY
+    n_days = int(np.ceil(cmdargs.days))
+    print(
+        f"{area}: {cmdargs.satCount} satellites, {grid.n_rows}x{grid.n_cols} cells,"
+        f" {n_days} days"
+    )
+
+    for start in np.arange(0, duration, cmdargs.chunk):
+        if start // DAY != (start - cmdargs.chunk) // DAY:
+            print(f"working on {area} day {int(start // DAY) + 1} of {n_days}")
+        end = min(start + cmdargs.chunk, duration)
+        grid.update(*window_hits(constellation, grid, start, end, cmdargs))
+
+    daily = grid.daily(n_days)
+    revisit = grid.revisit_hours()
+    # Grid-wide statistics, NaN when no cell was visited twice
+    revisited = np.isfinite(revisit).any()
+    summary = pd.DataFrame(
+        {
+            "Area": [area],
+            "Satellites": [cmdargs.satCount],
+            "Days": [cmdargs.days],
+            "Cumulative_fraction": [daily["Cumulative_fraction"].iloc[-1]],
+            "Mean_daily_fraction": [daily["Fraction_covered"].mean()],
+            "Mean_revisit_hours": [np.nanmean(revisit) if revisited else np.nan],
+            "Median_revisit_hours": [np.nanmedian(revisit) if revisited else np.nan],
+            "Max_gap_hours": [grid.revisit_max.max() / 3600 if revisited else np.nan],
+        }
+    )
+    print(
+        f"{area}: {summary['Cumulative_fraction'].iloc[0]:.3f} of the grid covered,"
+        f" mean daily coverage {summary['Mean_daily_fraction'].iloc[0]:.3f},"
+        f" median revisit {summary['Median_revisit_hours'].iloc[0]:.1f} hours"
+    )
+
+    os.makedirs(cmdargs.coverageOut, exist_ok=True)
+    outname = f"{cmdargs.coverageOut}/coverage_{area}_{cmdargs.satCount}sats"
+    daily.to_csv(f"{outname}.csv", index=False)
+    summary.to_csv(f"{outname}_summary.csv", index=False)
+    write_revisit(grid, f"{outname}_revisit.tif")
+    print(f"Results written to: {outname}.csv and {outname}_summary.csv")
+    return daily, summary
+
+
+def main(cmdargs):
+    """Run the coverage simulation from parsed command line arguments
+
+    Args:
+        cmdargs (Namespace): arguments from readCommands or the cli coverage subcommand
+    """
+    t = time.perf_counter()
+
+    if cmdargs.area == "all":
+        areas = list(SITES)
+        print(f"working on all sites ({areas})")
+    else:
+        areas = [cmdargs.area]
+
+    for area in areas:
+        simulate_coverage(area, cmdargs)
+
+    t = time.perf_counter() - t
+    print("time taken: ", t, " seconds")
+
+
+if __name__ == "__main__":
+    main(readCommands())
@@ -0,0 +1,180 @@
+"""Fill no-data in each sim DTM tile with a halo of pixels from its neighbouring tiles, so interpolation sees across tile boundaries"""
+
+import os
+from multiprocessing import Pool
+import numpy as np
+import rasterio
+from rasterio.windows import Window, from_bounds
+import lasBounds
+
+
+def scenario_key(sim_tif):
+    """Sim DTM name without its tile coordinates, shared by every tile of a scenario"""
+    tile = lasBounds.tileKey(sim_tif)
+    return os.path.basename(sim_tif).replace(tile, "{tile}", 1)
+
+
+def tile_header(sim_tif):
+    """Bounds, transform and shape of a sim DTM, read without its data"""
+    with rasterio.open(sim_tif) as raster:
+        return raster.bounds, raster.transform, raster.shape
+
+
+def halo_context(sim_tif, header, neighbours, halo):
+    """Data pixels of neighbouring tiles within the halo, in the tile's pixel coordinates
+
+    Only the window of each neighbour overlapping the halo is read, so memory is bounded
+    by the halo rather than the site. Neighbour pixels inside the tile itself are left out,
+    the tile's own pixels take precedence where tiles overlap.
+
+    Args:
+        sim_tif (str): tile to be filled
+        header (tuple): bounds, transform and shape of the tile
+        neighbours (dict): sim DTM of the same scenario: header
+        halo (int): halo width in pixels
+
+    Returns:
+        array, array: (row, col) points and values
+    """
+    bounds, transform, shape = header
+    res = transform.a
+    margin = halo * res
+    points, values = [], []
+
+    for neighbour, (nb_bounds, nb_transform, nb_shape) in neighbours.items():
+        # Skip the tile itself and tiles beyond the halo
+        if neighbour == sim_tif or (
+            nb_bounds.left >= bounds.right + margin
+            or nb_bounds.right <= bounds.left - margin
+            or nb_bounds.bottom >= bounds.top + margin
+            or nb_bounds.top <= bounds.bottom - margin
+        ):
+            continue
+
+        # Window of the neighbour covering the halo, clipped to its extent
+        window = from_bounds(
+            bounds.left - margin,
+            bounds.bottom - margin,
+            bounds.right + margin,
+            bounds.top + margin,
+            transform=nb_transform,
+        )
+        row_off = max(int(np.floor(window.row_off)), 0)
+        col_off = max(int(np.floor(window.col_off)), 0)
+        row_end = min(int(np.ceil(window.row_off + window.height)), nb_shape[0])
+        col_end = min(int(np.ceil(window.col_off + window.width)), nb_shape[1])
+        if row_end <= row_off or col_end <= col_off:
+            continue
+        with rasterio.open(neighbour) as raster:
+            data = raster.read(
+                1, window=Window(col_off, row_off, col_end - col_off, row_end - row_off)
+            )
+
+        # Neighbour pixel centres in map coordinates, then in the tile's pixel grid
+        rows, cols = np.nonzero(data)
+        x = nb_transform.c + (cols + col_off + 0.5) * nb_transform.a
+        y = nb_transform.f + (rows + row_off + 0.5) * nb_transform.e
+        tile_rows = (transform.f - y) / res - 0.5
+        tile_cols = (x - transform.c) / res - 0.5
+        outside = (
+            (tile_rows < -0.5)
+            | (tile_rows >= shape[0] - 0.5)
+            | (tile_cols < -0.5)
+            | (tile_cols >= shape[1] - 0.5)
+        )
+        points.append(np.column_stack((tile_rows[outside], tile_cols[outside])))
+        values.append(data[rows, cols][outside])
+
+    if not points:
+        return np.empty((0, 2)), np.empty(0)
+    return np.concatenate(points), np.concatenate(values)
+
+
+def fill_tile(job):
+    """Read a sim DTM and fill its no-data with the halo as context, run by pool workers
+
+    Args:
+        job (dict): sim_tif, header, neighbours, halo, als_shape, methods and no_data
+
+    Returns:
+        str, array, dict, int, tuple: sim DTM, its data, filled array per method (None
+            if not assessed), no-data count and halo points and values
+    """
+    # Imported here, dtmShell imports this module
+    from dtmShell import DtmCreation
+
+    with rasterio.open(job["sim_tif"]) as raster:
+        sim_array = raster.read(1)
+
+    # Same checks as compareDTM, tiles that are not assessed are not filled
+    if not (
+        job["als_shape"] == sim_array.shape
+        and np.max(sim_array) > 0
+        and np.count_nonzero(sim_array) > 100
+    ):
+        return job["sim_tif"], sim_array, None, None, None
+
+    context = halo_context(
+        job["sim_tif"], job["header"], job["neighbours"], job["halo"]
+    )
+    filled, no_data_count = DtmCreation().fill_methods(
+        sim_array, job["methods"], job["no_data"], context
+    )
+    return job["sim_tif"], sim_array, filled, no_data_count, context
+
+
+class HaloFill(object):
+    """
+    Fills the sim DTM tiles of one lassettings in parallel blocks, each tile with a halo
+    of its neighbours from the same scenario
+    """
+
+    def __init__(self, sim_list, halo, workers=1):
+        self.halo = halo
+        # Headers of every tile, so halos can cross into tiles not being assessed
+        self.scenarios = {}
+        for sim_tif in sim_list:
+            if lasBounds.tileKey(sim_tif) is None:
+                continue
+            self.scenarios.setdefault(scenario_key(sim_tif), {})[sim_tif] = tile_header(
+                sim_tif
+            )
+        self.pool = Pool(workers) if workers > 1 else None
+
+    def fill(self, sim_tifs, als_shape, methods, no_data):
+        """Fill sim DTMs matched to one ALS tile
+
+        Args:
+            sim_tifs (list): sim DTMs
+            als_shape (tuple): shape of the ALS tile arrays
+            methods (list): fill methods
+            no_data (float): value used to fill 0 values for 'canopy_middle'
+
+        Returns:
+            dict: sim DTM: its data, filled array per method (None if not assessed),
+                no-data count and halo points and values, reused by coarser levels
+        """
+        jobs = []
+        for sim_tif in sim_tifs:
+            neighbours = self.scenarios[scenario_key(sim_tif)]
+            jobs.append(
+                {
+                    "sim_tif": sim_tif,
+                    "header": neighbours[sim_tif],
+                    "neighbours": neighbours,
+                    "halo": self.halo,
+                    "als_shape": als_shape,
+                    "methods": methods,
+                    "no_data": no_data,
+                }
+            )
+        if self.pool is None:
+            results = map(fill_tile, jobs)
+        else:
+            results = self.pool.imap(fill_tile, jobs)
+        return {sim_tif: result for sim_tif, *result in results}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
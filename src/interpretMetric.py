@@ -1,10 +1,16 @@
 """Functions to support DTM shell, extracts values from ALS text files"""
 
 import numpy as np
+import h5py
 import rasterio
 from rasterio.transform import from_origin
 import re
 
+# gediMetric no-data value, converted to -999 when gridded
+METRIC_NODATA = -1000000.0
+# Fraction of waveform peak marking the canopy top
+TOP_THRESHOLD = 0.01
+
 
 # Function to read the text file and extract data
 def read_text_file(file_path):
@@ -47,6 +53,96 @@ def read_text_file(file_path):
     return coordinates, ground_values, canopy_values, slope_values, top_height
 
 
+def wave_coordinates(hdf):
+    """Grid coordinates of each waveform, as given in gediMetric wave IDs
+
+    Args:
+        hdf (h5py.File): open gediRat hdf5 file
+
+    Returns:
+        array: integer x, y coordinates of each waveform
+    """
+    if "WAVEID" in hdf:
+        ids = hdf["WAVEID"][()]
+        coordinates = []
+        for wave_id in ids:
+            if not isinstance(wave_id, (bytes, str)):
+                wave_id = bytes(wave_id).rstrip(b"\x00")
+            if isinstance(wave_id, bytes):
+                wave_id = wave_id.decode()
+            match = re.search(r"(\d+)\.(\d+)$", wave_id.strip())
+            if match is None:
+                break
+            coordinates.append(list(map(int, match.groups())))
+        else:
+            return np.array(coordinates)
+
+    # Fall back on footprint centres if IDs are missing or unreadable
+    return np.column_stack([hdf["LON0"][()], hdf["LAT0"][()]]).astype(int)
+
+
+def wave_slope(coordinates, ground_values, resolution=30):
+    """Ground slope (degrees) of each waveform from the gridded ground elevation
+
+    Args:
+        coordinates (array): x, y of each waveform
+        ground_values (array): ground elevation of each waveform
+        resolution (int): grid spacing
+
+    Returns:
+        array: slope of each waveform
+    """
+    ground = np.where(ground_values == METRIC_NODATA, np.nan, ground_values)
+    raster_data, bounds = create_geo_array(coordinates, ground, resolution)
+    raster_data[raster_data == -999] = np.nan
+
+    grad_y, grad_x = np.gradient(raster_data, resolution)
+    slope = np.degrees(np.arctan(np.hypot(grad_x, grad_y)))
+
+    cols = (coordinates[:, 0] - bounds[0]) // resolution
+    rows = (bounds[3] - coordinates[:, 1]) // resolution
+    slope = slope[rows, cols]
+    return np.where(np.isnan(slope), METRIC_NODATA, slope)
+
+
+def read_hdf_file(file_path):
+    """Compute the gediMetric -ground reference values straight from a gediRat hdf5 file
+
+    Args:
+        file_path (str): gediRat hdf5 file, simulated with -ground
+
+    Returns:
+        coordinates, ground, canopy cover, slope and top height, as read_text_file
+    """
+    with h5py.File(file_path, "r") as hdf:
+        coordinates = wave_coordinates(hdf)
+        wave = np.clip(hdf["RXWAVE"][()].astype("float64"), 0, None)
+        ground_wave = np.clip(hdf["GRWAVE"][()].astype("float64"), 0, None)
+        z0 = hdf["Z0"][()].astype("float64")
+        z_end = hdf["ZEND"][()].astype("float64")
+        ground_values = hdf["ZG"][()].astype("float64")
+        slope_values = hdf["SLOPE"][()].astype("float64") if "SLOPE" in hdf else None
+
+    # Canopy cover is the fraction of energy not returned from the ground
+    energy = wave.sum(axis=1)
+    has_energy = energy > 0
+    canopy_values = np.full(energy.shape, METRIC_NODATA)
+    canopy_values[has_energy] = (
+        1 - ground_wave.sum(axis=1)[has_energy] / energy[has_energy]
+    )
+
+    # Top height is the first bin from the top above a fraction of the peak
+    res = (z0 - z_end) / wave.shape[1]
+    above = wave > (wave.max(axis=1, keepdims=True) * TOP_THRESHOLD)
+    top_bin = np.argmax(above, axis=1)
+    top_height = np.where(has_energy, z0 - top_bin * res, METRIC_NODATA)
+
+    if slope_values is None:
+        slope_values = wave_slope(coordinates, ground_values)
+
+    return coordinates, ground_values, canopy_values, slope_values, top_height
+
+
 def create_geo_array(coordinates, ground_values, resolution=30):
     """Create array of ALS values at coordinate locations"""
 
@@ -71,10 +167,9 @@ def create_geo_array(coordinates, ground_values, resolution=30):
     raster_data = np.full((height, width), -999, dtype="float32")
 
     # Populate the raster data with ground values
-    for (x, y), value in zip(coordinates, ground_values):
-        col = (x - min_x) // resolution
-        row = (max_y - y) // resolution
-        raster_data[row, col] = value
+    cols = (coordinates[:, 0] - min_x) // resolution
+    rows = (max_y - coordinates[:, 1]) // resolution
+    raster_data[rows, cols] = ground_values
 
     return raster_data, bounds
 
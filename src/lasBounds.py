@@ -3,6 +3,9 @@
 import laspy
 import regex
 
+# Tag of python photon counting outputs, their noise level is not gediMetric's -noiseMult
+NATIVE_TAG = "_native"
+
 
 def lasMBR(file):
     """Find minimum bounding rectangle of las file
@@ -14,17 +17,32 @@ def lasMBR(file):
         list: bounds
     """
     MBR = []
-    las = laspy.read(file)
+    # Only the header is needed, avoid reading every point
+    with laspy.open(file) as las:
+        header = las.header
 
     # Find min max coord values form las file header and append to list
     # index p. 2 gives Z bounds, not included here
-    for minXyz in las.header.min[0:2]:
+    for minXyz in header.min[0:2]:
         MBR.append(round(minXyz))
-    for maxXyz in las.header.max[0:2]:
+    for maxXyz in header.max[0:2]:
         MBR.append(round(maxXyz))
     return MBR
 
 
+def lasPointCount(file):
+    """Find number of points in las file from its header
+
+    Args:
+        file (str): las file path
+
+    Returns:
+        int: point count
+    """
+    with laspy.open(file) as las:
+        return las.header.point_count
+
+
 def removeStrings(str_int):
     """Remove letters from mixed string"""
 
@@ -69,7 +87,8 @@ def clipNames(name, suffix):
         str: clipped name
     """
     file = name.split("/")[-1]
-    clipped = file.rstrip(suffix)
+    # only drop the exact suffix, rstrip would also eat a tile's trailing 5s for '.h5'
+    clipped = file[: -len(suffix)] if suffix and file.endswith(suffix) else file
     return clipped
 
 
@@ -83,6 +102,46 @@ def append_results(results, **kwargs):
         results[key].append(value)
 
 
+def tileKey(name):
+    """Find tile coordinates (x_y) in file name
+
+    Args:
+        name (str): file path
+
+    Returns:
+        str: tile coordinates, None if not found
+    """
+    match = regex.search(r"(\d+_\d+)", clipNames(name, ""))
+    return match.group(1) if match else None
+
+
+def photonModel(name):
+    """Photon counting model of a file, from its name
+
+    Args:
+        name (str): file path
+
+    Returns:
+        str: 'native' for python photon counting, 'gediMetric' otherwise
+    """
+    return "native" if NATIVE_TAG in clipNames(name, "") else "gediMetric"
+
+
+def alsRaster(folder, tile, band, extension=".tif"):
+    """ALS reference raster of a tile, written by dtmShell and read by figureShell and zonalStats
+
+    Args:
+        folder (str): study site
+        tile (str): tile coordinates (x_y), from tileKey
+        band (str): 'ground', 'canopy', 'slope' or 't_height'
+        extension (str): file extension, '' for the output root passed to create_tiff
+
+    Returns:
+        str: raster path
+    """
+    return f"data/{folder}/als_metric/{tile}_{band}{extension}"
+
+
 def match_files(als_files, sim_files):
     """Match ALS and sim files based on bounds in file name
 
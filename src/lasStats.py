@@ -0,0 +1,241 @@
+"""Single streaming pass over each raw las tile, recording point, density, ground and return statistics in a per-site table"""
+
+import os
+import time
+import argparse
+from glob import glob
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+import laspy
+import lasBounds
+import commands
+
+# Points read at once, bounds memory whatever the tile size
+CHUNK_POINTS = 2_000_000
+# Cell size of density statistics, the gediRat grid step
+CELL = 30
+# ASPRS ground class
+GROUND_CLASS = 2
+COLUMNS = [
+    "File",
+    "Tile",
+    "File_size",
+    "Mtime_ns",
+    "Min_x",
+    "Min_y",
+    "Max_x",
+    "Max_y",
+    "Points",
+    "Header_points",
+    "Cells",
+    "Empty_cell_fraction",
+    "Density_mean",
+    "Density_median",
+    "Density_p5",
+    "Density_p95",
+    "Ground_fraction",
+    "Z_min",
+    "Z_max",
+    "Z_range",
+    "Mean_returns",
+    "Single_return_fraction",
+]
+
+
+def statsCommands():
+    """
+    Read commandline arguments
+    """
+    p = argparse.ArgumentParser(
+        description=("Script to record statistics of each raw las tile in one pass")
+    )
+    commands.stats_arguments(p)
+
+    cmdargs = p.parse_args()
+    return cmdargs
+
+
+def stats_name(folder):
+    """Statistics table of a site"""
+    return f"data/{folder}/las_stats_{folder}.csv"
+
+
+def las_stats(file):
+    """Statistics of one las file, streamed in chunks of points
+
+    Args:
+        file (str): las file path
+
+    Returns:
+        dict: one table row
+    """
+    bounds = lasBounds.lasMBR(file)
+    with laspy.open(file) as las:
+        header = las.header
+        min_x, min_y = header.mins[:2]
+        # Density cells on the same origin as the gediRat grid
+        n_cols = int((header.maxs[0] - min_x) // CELL) + 1
+        n_rows = int((header.maxs[1] - min_y) // CELL) + 1
+        cell_counts = np.zeros(n_rows * n_cols, dtype=np.int64)
+
+        n_points = n_ground = n_single = 0
+        returns_sum = 0
+        z_min, z_max = np.inf, -np.inf
+        for points in las.chunk_iterator(CHUNK_POINTS):
+            x, y, z = np.asarray(points.x), np.asarray(points.y), np.asarray(points.z)
+            n_points += len(z)
+            if len(z) == 0:
+                continue
+            z_min, z_max = min(z_min, z.min()), max(z_max, z.max())
+
+            # Count points per 30 m cell
+            cols = np.clip(((x - min_x) // CELL).astype(np.int64), 0, n_cols - 1)
+            rows = np.clip(((y - min_y) // CELL).astype(np.int64), 0, n_rows - 1)
+            cell_counts += np.bincount(rows * n_cols + cols, minlength=len(cell_counts))
+
+            n_ground += np.count_nonzero(
+                np.asarray(points.classification) == GROUND_CLASS
+            )
+            number_of_returns = np.asarray(points.number_of_returns)
+            n_single += np.count_nonzero(number_of_returns <= 1)
+            returns_sum += int(number_of_returns.sum())
+
+    # Density of cells containing points, empty cells are counted separately
+    density = cell_counts / CELL**2
+    occupied = density[cell_counts > 0]
+    if len(occupied) == 0:
+        occupied = np.zeros(1)
+
+    return {
+        "File": file,
+        "Tile": f"{bounds[0]}_{bounds[1]}",
+        "File_size": os.path.getsize(file),
+        "Mtime_ns": os.stat(file).st_mtime_ns,
+        "Min_x": bounds[0],
+        "Min_y": bounds[1],
+        "Max_x": bounds[2],
+        "Max_y": bounds[3],
+        "Points": n_points,
+        "Header_points": header.point_count,
+        "Cells": len(cell_counts),
+        "Empty_cell_fraction": float(np.mean(cell_counts == 0)),
+        "Density_mean": float(occupied.mean()),
+        "Density_median": float(np.median(occupied)),
+        "Density_p5": float(np.percentile(occupied, 5)),
+        "Density_p95": float(np.percentile(occupied, 95)),
+        "Ground_fraction": n_ground / n_points if n_points else 0.0,
+        "Z_min": float(z_min) if n_points else np.nan,
+        "Z_max": float(z_max) if n_points else np.nan,
+        "Z_range": float(z_max - z_min) if n_points else np.nan,
+        "Mean_returns": returns_sum / n_points if n_points else 0.0,
+        "Single_return_fraction": n_single / n_points if n_points else 0.0,
+    }
+
+
+def read_stats(folder):
+    """Read a site's statistics table, if it has been written
+
+    Args:
+        folder (str): study site
+
+    Returns:
+        dataframe: one row per las file indexed by file path, None if missing
+    """
+    if not os.path.exists(stats_name(folder)):
+        return None
+    return pd.read_csv(stats_name(folder), dtype={"Tile": str}).set_index("File")
+
+
+def current_row(stats, file):
+    """Whether a statistics table has an up to date row for a las file
+
+    Args:
+        stats (dataframe): table from read_stats, or None
+        file (str): las file path
+
+    Returns:
+        bool: True if the file's size and modification time match its row
+    """
+    # Tables from before Mtime_ns are reread, float times did not survive the csv
+    return (
+        stats is not None
+        and "Mtime_ns" in stats.columns
+        and file in stats.index
+        and stats.at[file, "File_size"] == os.path.getsize(file)
+        and stats.at[file, "Mtime_ns"] == os.stat(file).st_mtime_ns
+    )
+
+
+def site_stats(folder, workers=1, refresh=False):
+    """Write the statistics table of a site, reading only new or changed las files
+
+    Args:
+        folder (str): study site
+        workers (int): number of las files read at once
+        refresh (bool): reread every file
+
+    Returns:
+        dataframe: statistics table
+    """
+    file_list = sorted(glob(f"data/{folder}/raw_las/*.las"))
+    previous = None if refresh else read_stats(folder)
+
+    # Unchanged files keep their rows
+    rows, todo = [], []
+    for file in file_list:
+        if current_row(previous, file):
+            rows.append(previous.loc[file].to_dict() | {"File": file})
+        else:
+            todo.append(file)
+    print(f"{folder}: reading {len(todo)} of {len(file_list)} las files")
+
+    if workers > 1:
+        with Pool(workers) as pool:
+            rows += pool.map(las_stats, todo)
+    else:
+        for idx, file in enumerate(todo):
+            print(f"working on {folder} {idx + 1} of {len(todo)}: {file}")
+            rows.append(las_stats(file))
+
+    stats_df = pd.DataFrame(rows)
+    if not stats_df.empty:
+        stats_df = stats_df[COLUMNS].sort_values("File")
+    stats_df.to_csv(stats_name(folder), index=False)
+    print(f"Results written to: {stats_name(folder)}")
+    return stats_df
+
+
+def main(cmdargs):
+    """Write las statistics tables from parsed command line arguments
+
+    Args:
+        cmdargs (Namespace): arguments from statsCommands
+    """
+    t = time.perf_counter()
+
+    study_area = cmdargs.studyArea
+    if study_area == "all":
+        study_sites = [
+            "Bonaly",
+            "hubbard_brook",
+            "la_selva",
+            "nouragues",
+            "oak_ridge",
+            "paracou",
+            "robson_creek",
+            "wind_river",
+        ]
+        print(f"working on all sites ({study_sites})")
+    else:
+        study_sites = [study_area]
+
+    for site in study_sites:
+        site_stats(site, cmdargs.workers, cmdargs.refresh)
+
+    t = time.perf_counter() - t
+    print("time taken: ", t, " seconds")
+
+
+if __name__ == "__main__":
+    main(statsCommands())
@@ -0,0 +1,158 @@
+"""Opt-in memory accounting: python allocation peaks and process RSS around each stage and tile, written to a per-run report"""
+
+import os
+import csv
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Windows, RSS columns are left empty
+    resource = None
+
+MB = 1024**2
+COLUMNS = [
+    "stage",
+    "labels",
+    "seconds",
+    "traced_peak_mb",
+    "rss_start_mb",
+    "rss_end_mb",
+    "rss_peak_mb",
+    "children_rss_peak_mb",
+]
+
+# Active report, None when memory accounting is off so stages cost nothing
+_report = None
+
+
+def current_rss():
+    """Resident set size of this process (MB), None where it cannot be read"""
+    try:
+        with open("/proc/self/statm") as file:
+            pages = int(file.read().split()[1])
+        return round(pages * os.sysconf("SC_PAGE_SIZE") / MB, 2)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss(who="self"):
+    """Peak RSS (MB) of this process, or of its largest finished child process
+
+    Children are counted once they have been waited for, e.g. subprocess.run
+    calls and joined Pool workers.
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(
+        resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN
+    )
+    # ru_maxrss is in bytes on macOS and kilobytes on linux
+    return round(usage.ru_maxrss / (MB if sys.platform == "darwin" else 1024), 2)
+
+
+class MemoryReport(object):
+    """
+    Rows of memory use, one per stage, nested stages each get their own peak
+    """
+
+    def __init__(self, outname):
+        self.outname = outname
+        self.rows = []
+        # Peak of each open stage so far, kept when a nested stage resets the peak
+        self.open_peaks = []
+        tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name, **labels):
+        t = time.perf_counter()
+        rss_start = current_rss()
+        if self.open_peaks:
+            self.open_peaks[-1] = max(
+                self.open_peaks[-1], tracemalloc.get_traced_memory()[1]
+            )
+        self.open_peaks.append(0)
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            traced_peak = max(self.open_peaks.pop(), tracemalloc.get_traced_memory()[1])
+            # Enclosing stage peak covers this stage too
+            if self.open_peaks:
+                self.open_peaks[-1] = max(self.open_peaks[-1], traced_peak)
+            self.rows.append(
+                {
+                    "stage": name,
+                    "labels": " ".join(
+                        f"{key}={value}" for key, value in labels.items()
+                    ),
+                    "seconds": round(time.perf_counter() - t, 3),
+                    "traced_peak_mb": round(traced_peak / MB, 2),
+                    "rss_start_mb": rss_start,
+                    "rss_end_mb": current_rss(),
+                    "rss_peak_mb": peak_rss("self"),
+                    "children_rss_peak_mb": peak_rss("children"),
+                }
+            )
+
+    def write(self):
+        """Write the report csv and print the largest peak of each stage"""
+        tracemalloc.stop()
+        os.makedirs(os.path.dirname(self.outname) or ".", exist_ok=True)
+        with open(self.outname, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+        peaks = {}
+        for row in self.rows:
+            peaks[row["stage"]] = max(peaks.get(row["stage"], 0), row["traced_peak_mb"])
+        for name, peak in peaks.items():
+            print(f"{name}: python peak {peak} MB")
+        print(
+            f"process peak RSS {peak_rss('self')} MB,"
+            f" child process peak RSS {peak_rss('children')} MB"
+        )
+        print(f"Memory report written to {self.outname}")
+
+
+def start(outname, worker=None):
+    """Turn on memory accounting for this run
+
+    Args:
+        outname (str): report csv, None leaves accounting off
+        worker (str): name of this queue worker, added to the file name so workers
+            sharing a report path each write their own file
+    """
+    global _report
+    if outname is not None:
+        if worker is not None:
+            root, extension = os.path.splitext(outname)
+            outname = f"{root}_{worker}{extension}"
+        _report = MemoryReport(outname)
+
+
+@contextmanager
+def stage(name, **labels):
+    """Record memory use of a stage or tile, does nothing unless accounting is on
+
+    Args:
+        name (str): stage name
+        labels: site, tile, settings etc. of this stage
+    """
+    if _report is None:
+        yield
+    else:
+        with _report.stage(name, **labels):
+            yield
+
+
+def finish():
+    """Write the report of this run, if accounting is on"""
+    global _report
+    if _report is not None:
+        _report.write()
+        _report = None
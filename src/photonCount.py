@@ -0,0 +1,259 @@
+"""Python photon-counting simulation from gediRat waveforms, replaces repeated gediMetric -photonCount calls"""
+
+import time
+import zlib
+from multiprocessing import Pool
+import h5py
+import numpy as np
+import lasBounds
+from costModel import CostModel, record_runtime
+
+# Datasets written by gediRat -hdf
+WAVE_KEY = "RXWAVE"
+TOP_KEY = "Z0"
+BOTTOM_KEY = "ZEND"
+X_KEY = "LON0"
+Y_KEY = "LAT0"
+
+# Outputs are tagged, their noise level is not gediMetric's -noiseMult
+NATIVE_TAG = lasBounds.NATIVE_TAG
+# Approximate size of one photon line in a .pts file
+PTS_BYTES_PER_PHOTON = 32
+
+
+def read_waves(file):
+    """Read waveforms and their geolocation from a gediRat hdf5 file
+
+    Args:
+        file (str): hdf5 file path
+
+    Returns:
+        dict: waveforms, top and bottom elevations and coordinates
+    """
+    with h5py.File(file, "r") as hdf:
+        waves = {
+            "wave": np.asarray(hdf[WAVE_KEY][()], dtype="float64"),
+            "z0": np.asarray(hdf[TOP_KEY][()], dtype="float64"),
+            "zEnd": np.asarray(hdf[BOTTOM_KEY][()], dtype="float64"),
+            "x": np.asarray(hdf[X_KEY][()], dtype="float64"),
+            "y": np.asarray(hdf[Y_KEY][()], dtype="float64"),
+        }
+    return waves
+
+
+def wave_count(file):
+    """Number of waveforms in a gediRat hdf5 file, without reading them"""
+    with h5py.File(file, "r") as hdf:
+        return hdf[WAVE_KEY].shape[0]
+
+
+def wave_cdf(wave):
+    """Cumulative distribution of each waveform, offset by row so all rows can be searched at once
+
+    Args:
+        wave (array): waveforms (n waves, n bins)
+
+    Returns:
+        array: flattened, monotonic cdf and mask of waveforms with any energy
+    """
+    wave = np.clip(wave, 0, None)
+    energy = wave.sum(axis=1)
+    has_energy = energy > 0
+
+    cdf = np.cumsum(wave, axis=1)
+    cdf[has_energy] /= energy[has_energy, None]
+    # Empty waveforms never receive signal photons, flat cdf keeps array monotonic
+    cdf[~has_energy] = 1
+
+    # Row i occupies (i, i + 1], so one searchsorted covers every waveform
+    cdf += np.arange(wave.shape[0])[:, None]
+    return cdf.ravel(), has_energy
+
+
+def photon_points(waves, cdf, has_energy, n_photons, noise, rng):
+    """Draw signal and noise photons for every waveform
+
+    Args:
+        waves (dict): output of read_waves
+        cdf (array): flattened cdf from wave_cdf
+        has_energy (array): waveforms with any energy
+        n_photons (int): mean signal photons per waveform
+        noise (int): mean noise photons per waveform, Poisson distributed and spread
+            uniformly over the waveform window. This is not gediMetric's -noiseMult.
+        rng (Generator): seeded random number generator
+
+    Returns:
+        array: photon points, columns x, y, z, signal flag
+    """
+    n_waves, n_bins = waves["wave"].shape
+    res = (waves["z0"] - waves["zEnd"]) / n_bins
+
+    # Signal photons, Poisson number per waveform drawn from waveform shape
+    n_signal = rng.poisson(n_photons, n_waves) * has_energy
+    signal_wave = np.repeat(np.arange(n_waves), n_signal)
+    draw = rng.random(signal_wave.size) + signal_wave
+    signal_bin = np.searchsorted(cdf, draw, side="left") - signal_wave * n_bins
+    signal_bin = np.clip(signal_bin, 0, n_bins - 1)
+    signal_z = (
+        waves["z0"][signal_wave]
+        - (signal_bin + rng.random(signal_wave.size)) * res[signal_wave]
+    )
+
+    # Noise photons spread uniformly over the waveform window
+    n_noise = rng.poisson(noise, n_waves)
+    noise_wave = np.repeat(np.arange(n_waves), n_noise)
+    noise_z = waves["zEnd"][noise_wave] + rng.random(noise_wave.size) * (
+        waves["z0"][noise_wave] - waves["zEnd"][noise_wave]
+    )
+
+    wave_idx = np.concatenate([signal_wave, noise_wave])
+    points = np.column_stack(
+        [
+            waves["x"][wave_idx],
+            waves["y"][wave_idx],
+            np.concatenate([signal_z, noise_z]),
+            np.concatenate([np.ones(signal_wave.size), np.zeros(noise_wave.size)]),
+        ]
+    )
+    return points
+
+
+def write_pts(points, outroot):
+    """Write photons as a .pts text file readable by txt2las
+
+    One photon per line: x, y, z and 1 for signal or 0 for noise photons, after a
+    '#' header line. txt2las reads the first three columns, as for gediMetric .pts.
+
+    Args:
+        points (array): photon points from photon_points
+        outroot (str): output file path without extension
+    """
+    np.savetxt(
+        f"{outroot}.pts",
+        points,
+        fmt=["%.2f", "%.2f", "%.3f", "%d"],
+        header="1 x, 2 y, 3 z, 4 signal",
+    )
+
+
+def photon_rng(seed, clip_file, n_photons, noise, realization=0):
+    """Random number generator seeded by run seed, tile, scenario and realization
+
+    Args:
+        seed (int): run seed
+        clip_file (str): tile name
+        n_photons (int): photon count
+        noise (int): noise level
+        realization (int): Monte Carlo realization, 0 gives the single-run stream
+
+    Returns:
+        Generator: reproducible generator for this tile and scenario
+    """
+    entropy = [seed, zlib.crc32(clip_file.encode()), n_photons, noise]
+    if realization:
+        entropy.append(realization)
+    return np.random.default_rng(entropy)
+
+
+def tile_photons(job):
+    """Simulate every scenario of one realization for one hdf5 file
+
+    Args:
+        job (dict): file, folder, photon counts, noise levels, seed, realization and whether to name it
+
+    Returns:
+        str: tile name
+    """
+    clipFile = lasBounds.clipNames(job["file"], ".h5")
+    t = time.perf_counter()
+
+    # Read and prepare waveforms once for all scenarios
+    waves = read_waves(job["file"])
+    cdf, has_energy = wave_cdf(waves["wave"])
+
+    # Realization suffix only when several are run, single runs keep their names
+    realization = job["realization"]
+    suffix = f"_r{realization}" if job["named"] else ""
+    for nPhotons in job["photon_counts"]:
+        for iNoise in job["noise_levels"]:
+            rng = photon_rng(job["seed"], clipFile, nPhotons, iNoise, realization)
+            points = photon_points(waves, cdf, has_energy, nPhotons, iNoise, rng)
+            outroot = (
+                f"data/{job['folder']}/pts_metric/"
+                f"{clipFile}_p{nPhotons}_n{iNoise}{NATIVE_TAG}{suffix}"
+            )
+            write_pts(points, outroot)
+            print(f"{len(points)} photons written to {outroot}.pts")
+
+    # Simulated waveforms of every scenario set the runtime
+    runs = len(job["photon_counts"]) * len(job["noise_levels"])
+    record_runtime(
+        "photons",
+        {"waveforms": waves["wave"].shape[0] * runs},
+        time.perf_counter() - t,
+    )
+    return clipFile
+
+
+def runPhotonCount(
+    file_list,
+    folder,
+    photon_counts,
+    noise_levels,
+    seed=0,
+    realizations=1,
+    workers=1,
+    realization=0,
+):
+    """Simulate photon counting for each hdf5 file, reading each file only once
+
+    Only one realization is written per run. lastools runs outside python, so each
+    realization goes through lasground and dtmShell.py, which scores it and removes
+    its files, before the next is simulated.
+
+    Args:
+        file_list (list): gediRat hdf5 files
+        folder (str): study site name
+        photon_counts (list): photon counts per waveform
+        noise_levels (list): noise photons per waveform
+        seed (int): seed for random number generation
+        realizations (int): independently seeded Monte Carlo runs of each scenario
+        workers (int): number of processes, above 1 files run in parallel
+        realization (int): realization simulated by this run, from 0 to realizations - 1
+    """
+    if not 0 <= realization < realizations:
+        raise ValueError(f"realization {realization} is not in 0 to {realizations - 1}")
+
+    waveforms = {file: wave_count(file) for file in file_list}
+    photons_per_wave = len(noise_levels) * sum(photon_counts) + len(
+        photon_counts
+    ) * sum(noise_levels)
+    pts_bytes = PTS_BYTES_PER_PHOTON * photons_per_wave * sum(waveforms.values())
+    print(
+        f"{folder}: realization {realization} of {realizations} writes about"
+        f" {pts_bytes / 1024**3:.1f} GB of .pts files"
+    )
+
+    base_job = {
+        "folder": folder,
+        "photon_counts": photon_counts,
+        "noise_levels": noise_levels,
+        "seed": seed,
+        "named": realizations > 1,
+        "realization": realization,
+    }
+    if workers > 1:
+        jobs = [dict(base_job, file=file) for file in file_list]
+        # Files with most waveforms start first, so the pool finishes together
+        runs = len(photon_counts) * len(noise_levels)
+        jobs = CostModel().longest_first(
+            "photons", jobs, lambda job: {"waveforms": waveforms[job["file"]] * runs}
+        )
+        with Pool(workers) as pool:
+            for idx, clipFile in enumerate(pool.imap_unordered(tile_photons, jobs)):
+                print(f"finished {folder} {idx + 1} of {len(jobs)}: {clipFile}")
+    else:
+        for idx, file in enumerate(file_list):
+            clipFile = lasBounds.clipNames(file, ".h5")
+            print(f"working on {folder} {idx + 1} of {len(file_list)}: {clipFile}")
+            tile_photons(dict(base_job, file=file))
@@ -0,0 +1,83 @@
+"""Coarser versions of 30 m sim DTMs and ALS references by block aggregation, ignoring no-data pixels"""
+
+import numpy as np
+
+# Resolution of gediRat grids, mapLidar DTMs and ALS references
+NATIVE_RES = 30
+# No-data of sim DTMs and of ALS arrays
+SIM_NODATA = 0
+ALS_NODATA = -999
+
+
+def level_factors(resolutions):
+    """Block sizes of the coarser levels of a list of resolutions
+
+    Args:
+        resolutions (list): resolutions in metres, multiples of 30
+
+    Returns:
+        list: factors above 1, the native level is always scored
+    """
+    factors = []
+    for resolution in resolutions:
+        if resolution % NATIVE_RES != 0:
+            raise ValueError(f"{resolution} m is not a multiple of {NATIVE_RES} m")
+        if resolution > NATIVE_RES:
+            factors.append(resolution // NATIVE_RES)
+    return sorted(set(factors))
+
+
+def block_reduce(array, factor, nodata, how="mean"):
+    """Aggregate factor x factor blocks, using only pixels with data
+
+    Edge blocks covering part of the array use the pixels they contain.
+
+    Args:
+        array (array): 2d array at native resolution
+        factor (int): block size in pixels
+        nodata (float): no-data value of input and output
+        how (str): 'mean' or 'max' of each block
+
+    Returns:
+        array: aggregated array, no-data where a block has no data
+    """
+    rows = -(-array.shape[0] // factor)
+    cols = -(-array.shape[1] // factor)
+    # Pad to whole blocks with no-data, then view as (rows, factor, cols, factor)
+    padded = np.full((rows * factor, cols * factor), nodata, dtype=array.dtype)
+    padded[: array.shape[0], : array.shape[1]] = array
+    blocks = padded.reshape(rows, factor, cols, factor)
+    valid = blocks != nodata
+    counts = valid.sum(axis=(1, 3))
+
+    if how == "max":
+        reduced = np.where(valid, blocks, -np.inf).max(axis=(1, 3))
+    else:
+        sums = np.where(valid, blocks, 0).sum(axis=(1, 3), dtype="float64")
+        reduced = sums / np.maximum(counts, 1)
+
+    return np.where(counts > 0, reduced, nodata).astype(array.dtype)
+
+
+def als_level(ground, canopy, slope, top_height, factor):
+    """ALS reference arrays at a coarser level
+
+    Args:
+        ground, canopy, slope, top_height (array): native ALS arrays
+        factor (int): block size in pixels
+
+    Returns:
+        tuple: ground, canopy, slope and top height arrays
+    """
+    return (
+        block_reduce(ground, factor, ALS_NODATA),
+        block_reduce(canopy, factor, ALS_NODATA),
+        block_reduce(slope, factor, ALS_NODATA),
+        # Top of canopy is the highest point of the block
+        block_reduce(top_height, factor, ALS_NODATA, how="max"),
+    )
+
+
+def sim_level(sim_array, factor):
+    """Sim DTM at a coarser level, the mean of ground pixels found in each block"""
+    return block_reduce(sim_array, factor, SIM_NODATA)
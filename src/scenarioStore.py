@@ -0,0 +1,608 @@
+"""Chunked store of difference rasters with dimensions (lassettings, interpolation, photons, noise, y, x), in the Zarr v2 directory layout"""
+
+import os
+import json
+import time
+import uuid
+import zlib
+import itertools
+from glob import glob
+import numpy as np
+import regex
+import lasBounds
+from commands import LAS_SETTINGS
+
+DIMS = ["lassettings", "interpolation", "photons", "noise", "y", "x"]
+METHODS = ["linear", "cubic", "nearest", "canopy_middle"]
+# One scenario and a 256 x 256 pixel block per chunk
+CHUNK_PIXELS = 256
+DTYPE = "<f4"
+# Difference rasters use 0 as no-data
+FILL_VALUE = 0
+# Chunk locks older than this are from dead writers
+LOCK_TIMEOUT = 60
+# Tiles this close to the site lattice and resolution are copied, not resampled
+ALIGN_TOLERANCE = 1e-6
+
+
+def store_name(folder):
+    """Store directory of a site"""
+    return f"data/{folder}/diff_store.zarr"
+
+
+def sim_files(folder):
+    """Ground-classified sim las files of every lassettings of a site"""
+    return glob(f"data/{folder}/sim_ground*/*.las")
+
+
+def scenario_values(folder):
+    """Photon counts and noise levels of a site, from sim file names
+
+    Args:
+        folder (str): study site
+
+    Returns:
+        list, list: sorted photon counts and noise levels
+    """
+    photons, noise = set(), set()
+    for sim_file in sim_files(folder):
+        clip_sim = lasBounds.clipNames(sim_file, ".las")
+        photons.add(
+            int(lasBounds.removeStrings(regex.findall(r"[p]+\d+", clip_sim)[0]))
+        )
+        noise.add(int(lasBounds.removeStrings(regex.findall(r"[n]+\d+", clip_sim)[0])))
+    return sorted(photons), sorted(noise)
+
+
+def sim_grid(folder, resolution=30):
+    """Grid covering every sim file of a site, from las headers, so it is known before DTMs exist
+
+    Args:
+        folder (str): study site
+        resolution (int): DTM resolution
+
+    Returns:
+        dict: origin, resolution, shape and crs of site grid
+    """
+    bounds = np.array([lasBounds.lasMBR(file) for file in sim_files(folder)])
+    # One pixel margin for DTM edges beyond the point bounds
+    left = float(bounds[:, 0].min() - resolution)
+    top = float(bounds[:, 3].max() + resolution)
+    right = bounds[:, 2].max() + resolution
+    bottom = bounds[:, 1].min() - resolution
+
+    return {
+        "left": left,
+        "top": top,
+        "res": resolution,
+        "shape": [
+            int(np.ceil((top - bottom) / resolution)),
+            int(np.ceil((right - left) / resolution)),
+        ],
+        "crs": f"EPSG:{lasBounds.findEPSG(folder)}",
+    }
+
+
+def lattice_offset(grid, shape, bounds):
+    """Position of a raster on a site grid, and whether it lies on the grid's lattice
+
+    Args:
+        grid (dict): left, top and res of the site grid
+        shape (tuple): raster rows and columns
+        bounds (BoundingBox): raster bounds
+
+    Returns:
+        float, float, bool: grid row and column of the raster's top left corner, and
+            whether the raster is on the lattice at the grid's resolution
+    """
+    res = grid["res"]
+    row = (grid["top"] - bounds.top) / res
+    col = (bounds.left - grid["left"]) / res
+    res_x = (bounds.right - bounds.left) / shape[1]
+    res_y = (bounds.top - bounds.bottom) / shape[0]
+    aligned = (
+        abs(row - round(row)) < ALIGN_TOLERANCE
+        and abs(col - round(col)) < ALIGN_TOLERANCE
+        and abs(res_x - res) < ALIGN_TOLERANCE
+        and abs(res_y - res) < ALIGN_TOLERANCE
+    )
+    return row, col, aligned
+
+
+def grid_window(grid, data, bounds):
+    """Place a raster on a site grid, resampling it if it is off the grid's lattice
+
+    Rasters on the lattice are returned unchanged. Others are resampled bilinearly onto
+    the grid pixels they cover, rather than shifted by up to half a pixel.
+
+    Args:
+        grid (dict): left, top, res and crs of the site grid
+        data (array): raster, 0 is no-data
+        bounds (BoundingBox): raster bounds
+
+    Returns:
+        array, int, int: raster on the grid lattice and its grid row and column, which
+            may lie outside the grid
+    """
+    res = grid["res"]
+    row, col, aligned = lattice_offset(grid, data.shape, bounds)
+    if aligned:
+        return data, int(round(row)), int(round(col))
+
+    # Only imported for misaligned rasters, reading the store does not need rasterio
+    from rasterio.transform import from_bounds, from_origin
+    from rasterio.warp import reproject, Resampling
+
+    first_row, first_col = int(np.floor(row)), int(np.floor(col))
+    last_row = int(np.ceil(row + (bounds.top - bounds.bottom) / res))
+    last_col = int(np.ceil(col + (bounds.right - bounds.left) / res))
+    resampled = np.full(
+        (last_row - first_row, last_col - first_col), FILL_VALUE, dtype=DTYPE
+    )
+    reproject(
+        source=np.asarray(data, dtype=DTYPE),
+        destination=resampled,
+        src_transform=from_bounds(*bounds, data.shape[1], data.shape[0]),
+        dst_transform=from_origin(
+            grid["left"] + first_col * res, grid["top"] - first_row * res, res, res
+        ),
+        src_crs=grid["crs"],
+        dst_crs=grid["crs"],
+        src_nodata=FILL_VALUE,
+        dst_nodata=FILL_VALUE,
+        resampling=Resampling.bilinear,
+    )
+    return resampled, first_row, first_col
+
+
+def diff_source(folder, las_list):
+    """Difference rasters of a site, from its tifs, or from its store when it has no tifs
+
+    Store differences are named as the tifs a run without --store would have written,
+    with the method suffix, so readers parse scenarios from names either way.
+
+    Args:
+        folder (str): study site
+        las_list (list): lastools settings
+
+    Returns:
+        list, ScenarioStore: difference raster names, and the store they are read from
+            or None for tifs
+    """
+    diff_list = [
+        diff_tif
+        for las_settings in las_list
+        for diff_tif in sorted(glob(f"data/{folder}/diff_dtm/{las_settings}/*.tif"))
+    ]
+    if diff_list or not os.path.exists(f"{store_name(folder)}/.zarray"):
+        return diff_list, None
+
+    store = ScenarioStore(store_name(folder))
+    for las_settings in las_list:
+        if las_settings not in store.labels["lassettings"]:
+            continue
+        written = store.written(las_settings)
+        # Each difference was written on the grid of its sim DTM, which is kept
+        for sim_tif in sorted(glob(f"data/{folder}/sim_dtm/{las_settings}/*.tif")):
+            clip_sim = lasBounds.clipNames(sim_tif, ".tif")
+            photons = regex.findall(r"[p]+\d+", clip_sim)
+            noise = regex.findall(r"[n]+\d+", clip_sim)
+            if not photons or not noise:
+                continue
+            scenario = (
+                int(lasBounds.removeStrings(photons[0])),
+                int(lasBounds.removeStrings(noise[0])),
+            )
+            diff_list += [
+                f"data/{folder}/diff_dtm/{las_settings}/{clip_sim}_{method}.tif"
+                for method in METHODS
+                if (method,) + scenario in written
+            ]
+    return diff_list, store
+
+
+def read_diff(diff_tif, store=None):
+    """Read a difference raster named by diff_source
+
+    Args:
+        diff_tif (str): difference raster name
+        store (ScenarioStore): store the difference is read from, None for tifs
+
+    Returns:
+        array, BoundingBox: difference, 0 is no-data, and its bounds
+    """
+    import rasterio
+
+    if store is None:
+        with rasterio.open(diff_tif) as diff_open:
+            return diff_open.read(1), diff_open.bounds
+
+    # Names are {sim DTM}_{method}.tif in data/{site}/diff_dtm/{lassettings}
+    las_dir, name = os.path.split(diff_tif)
+    las_settings = os.path.basename(las_dir)
+    folder = os.path.basename(os.path.dirname(os.path.dirname(las_dir)))
+    clip_diff = lasBounds.clipNames(name, ".tif")
+    method = next(method for method in METHODS if clip_diff.endswith(f"_{method}"))
+    clip_sim = clip_diff[: -len(f"_{method}")]
+    with rasterio.open(f"data/{folder}/sim_dtm/{las_settings}/{clip_sim}.tif") as sim:
+        shape, bounds = sim.shape, sim.bounds
+    photons = lasBounds.removeStrings(regex.findall(r"[p]+\d+", clip_sim)[0])
+    noise = lasBounds.removeStrings(regex.findall(r"[n]+\d+", clip_sim)[0])
+    data = store.read_tile(las_settings, method, photons, noise, bounds, shape)
+    return data, bounds
+
+
+class ScenarioStore(object):
+    """
+    Chunked scenario array on local disk, readable by zarr and xarray
+
+    Chunks are separate files, so workers writing different scenarios or blocks never
+    touch the same file. Writers sharing a chunk take a lock file around each update.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(f"{path}/.zarray") as file:
+            meta = json.load(file)
+        with open(f"{path}/.zattrs") as file:
+            attrs = json.load(file)
+        self.shape = meta["shape"]
+        self.chunks = meta["chunks"]
+        self.labels = {dim: attrs[dim] for dim in DIMS[:4]}
+        self.grid = attrs["grid"]
+
+    @classmethod
+    def create(cls, folder, chunk_pixels=CHUNK_PIXELS):
+        """Create an empty store for a site, or open it if it exists
+
+        Args:
+            folder (str): study site
+            chunk_pixels (int): height and width of chunks
+
+        Returns:
+            ScenarioStore: the store
+        """
+        path = store_name(folder)
+        if os.path.exists(f"{path}/.zarray"):
+            return cls(path)
+
+        photons, noise = scenario_values(folder)
+        grid = sim_grid(folder)
+        # Every lassettings and method, unwritten chunks take no space
+        labels = {
+            "lassettings": LAS_SETTINGS,
+            "interpolation": METHODS,
+            "photons": photons,
+            "noise": noise,
+        }
+        shape = [len(values) for values in labels.values()] + grid["shape"]
+        meta = {
+            "zarr_format": 2,
+            "shape": shape,
+            "chunks": [1, 1, 1, 1, chunk_pixels, chunk_pixels],
+            "dtype": DTYPE,
+            "compressor": {"id": "zlib", "level": 5},
+            "fill_value": FILL_VALUE,
+            "order": "C",
+            "filters": None,
+            "dimension_separator": ".",
+        }
+        attrs = dict(labels, _ARRAY_DIMENSIONS=DIMS, grid=grid)
+
+        os.makedirs(path, exist_ok=True)
+        write_bytes(f"{path}/.zattrs", json.dumps(attrs, indent=1).encode())
+        write_bytes(f"{path}/.zarray", json.dumps(meta, indent=1).encode())
+        print(f"Store of shape {shape} created at {path}")
+        return cls(path)
+
+    def label_index(self, dim, value):
+        """Index of a label along a scenario dimension"""
+        labels = self.labels[dim]
+        # Photon and noise labels are numbers, file names give strings
+        if dim in ("photons", "noise"):
+            value = int(value)
+        if value not in labels:
+            raise ValueError(f"{value} is not in store {dim} {labels}, rebuild store")
+        return labels.index(value)
+
+    def check_labels(self, **labels):
+        """Check scenarios are in the store before any are scored, the store cannot grow
+
+        Args:
+            labels: lassettings, interpolation, photons, noise as lists of labels
+
+        Raises:
+            ValueError: if any label is missing from the store
+        """
+        missing = {}
+        for dim, values in labels.items():
+            if dim in ("photons", "noise"):
+                values = [int(value) for value in values]
+            values = sorted(set(values) - set(self.labels[dim]))
+            if values:
+                missing[dim] = values
+        if missing:
+            raise ValueError(
+                f"{self.path} has no labels for {missing}, it was created before these"
+                " scenarios existed. Remove it so it is recreated with every scenario"
+            )
+
+    def chunk_file(self, chunk_idx):
+        return f"{self.path}/" + ".".join(str(idx) for idx in chunk_idx)
+
+    def read_chunk(self, chunk_idx):
+        """Read one chunk, unwritten chunks are filled with no-data"""
+        try:
+            with open(self.chunk_file(chunk_idx), "rb") as file:
+                data = np.frombuffer(zlib.decompress(file.read()), dtype=DTYPE)
+            return data.reshape(self.chunks).copy()
+        except FileNotFoundError:
+            return np.full(self.chunks, FILL_VALUE, dtype=DTYPE)
+
+    def write_chunk(self, chunk_idx, data):
+        write_bytes(self.chunk_file(chunk_idx), zlib.compress(data.tobytes(), 5))
+
+    def chunk_indices(self):
+        """Indices of every chunk written, locks and metadata files are skipped"""
+        for name in os.listdir(self.path):
+            chunk_idx = name.split(".")
+            if len(chunk_idx) == len(DIMS) and all(idx.isdigit() for idx in chunk_idx):
+                yield tuple(int(idx) for idx in chunk_idx)
+
+    def written(self, lassettings):
+        """Scenarios of a lassettings with any chunk written
+
+        Args:
+            lassettings (str): lastools settings
+
+        Returns:
+            set: (interpolation, photons, noise) labels
+        """
+        las_idx = self.label_index("lassettings", lassettings)
+        return {
+            tuple(self.labels[dim][idx] for dim, idx in zip(DIMS[1:4], chunk_idx[1:4]))
+            for chunk_idx in self.chunk_indices()
+            if chunk_idx[0] == las_idx
+        }
+
+    def clear(self, lassettings, methods):
+        """Remove every chunk of the scenarios a run is about to write
+
+        Tiles only overwrite the pixels where they have data, so differences of an
+        earlier run would otherwise survive wherever the new tiles have none.
+
+        Args:
+            lassettings (list): lastools settings of the run
+            methods (list): fill methods of the run
+        """
+        scenarios = {
+            (
+                self.label_index("lassettings", las_settings),
+                self.label_index("interpolation", method),
+            )
+            for las_settings in lassettings
+            for method in methods
+        }
+        removed = [
+            chunk_idx
+            for chunk_idx in self.chunk_indices()
+            if chunk_idx[:2] in scenarios
+        ]
+        for chunk_idx in removed:
+            os.remove(self.chunk_file(chunk_idx))
+        if removed:
+            print(f"{len(removed)} chunks of an earlier run removed from {self.path}")
+
+    def write_tile(self, lassettings, method, photons, noise, data, bounds):
+        """Write one difference raster into its scenario and window of the site grid
+
+        Tiles off the site's 30 m lattice are resampled bilinearly onto it, rather than
+        shifted by up to half a pixel.
+
+        Args:
+            lassettings (str): lastools settings
+            method (str): fill method
+            photons (str): photon count
+            noise (str): noise level
+            data (array): difference raster, 0 is no-data
+            bounds (BoundingBox): raster bounds
+        """
+        scenario = (
+            self.label_index("lassettings", lassettings),
+            self.label_index("interpolation", method),
+            self.label_index("photons", photons),
+            self.label_index("noise", noise),
+        )
+        data, row, col = grid_window(self.grid, data, bounds)
+
+        # Crop any part of the tile outside the site grid
+        top, left = max(row, 0), max(col, 0)
+        bottom = min(row + data.shape[0], self.shape[4])
+        right = min(col + data.shape[1], self.shape[5])
+        if bottom <= top or right <= left:
+            print(f"tile outside site grid, not stored: {bounds}")
+            return
+        data = data[top - row : bottom - row, left - col : right - col]
+        row, col = top, left
+        rows, cols = self.chunks[4:]
+
+        # Update each chunk the tile overlaps
+        for chunk_row in range(row // rows, (row + data.shape[0] - 1) // rows + 1):
+            for chunk_col in range(col // cols, (col + data.shape[1] - 1) // cols + 1):
+                chunk_idx = scenario + (chunk_row, chunk_col)
+                # Overlap in site grid coordinates
+                top, left = max(row, chunk_row * rows), max(col, chunk_col * cols)
+                bottom = min(row + data.shape[0], (chunk_row + 1) * rows)
+                right = min(col + data.shape[1], (chunk_col + 1) * cols)
+                tile_window = data[top - row : bottom - row, left - col : right - col]
+
+                with ChunkLock(self.chunk_file(chunk_idx)):
+                    chunk = self.read_chunk(chunk_idx)
+                    window = chunk[
+                        0,
+                        0,
+                        0,
+                        0,
+                        top - chunk_row * rows : bottom - chunk_row * rows,
+                        left - chunk_col * cols : right - chunk_col * cols,
+                    ]
+                    # Neighbouring tiles may overlap, keep their data where this tile has none
+                    has_data = tile_window != FILL_VALUE
+                    window[has_data] = tile_window[has_data]
+                    self.write_chunk(chunk_idx, chunk)
+
+    def read_tile(self, lassettings, method, photons, noise, bounds, shape):
+        """Read one difference raster back from the store, on the grid it was written from
+
+        Tiles off the site's lattice are resampled bilinearly back onto their own grid.
+        Where neighbouring tiles overlap, the store holds the tile written last.
+
+        Args:
+            lassettings (str): lastools settings
+            method (str): fill method
+            photons (str): photon count
+            noise (str): noise level
+            bounds (BoundingBox): raster bounds
+            shape (tuple): raster rows and columns
+
+        Returns:
+            array: difference raster, 0 is no-data
+        """
+        res = self.grid["res"]
+        row, col, aligned = lattice_offset(self.grid, shape, bounds)
+        first_row = int(np.floor(row + ALIGN_TOLERANCE))
+        first_col = int(np.floor(col + ALIGN_TOLERANCE))
+        last_row = int(
+            np.ceil(row + (bounds.top - bounds.bottom) / res - ALIGN_TOLERANCE)
+        )
+        last_col = int(
+            np.ceil(col + (bounds.right - bounds.left) / res - ALIGN_TOLERANCE)
+        )
+
+        # Grid pixels the tile covers, no-data beyond the site grid
+        window = np.full(
+            (last_row - first_row, last_col - first_col), FILL_VALUE, dtype=DTYPE
+        )
+        top, left = max(first_row, 0), max(first_col, 0)
+        bottom, right = min(last_row, self.shape[4]), min(last_col, self.shape[5])
+        if bottom > top and right > left:
+            window[
+                top - first_row : bottom - first_row,
+                left - first_col : right - first_col,
+            ] = self.read(
+                lassettings=lassettings,
+                interpolation=method,
+                photons=photons,
+                noise=noise,
+                y=slice(top, bottom),
+                x=slice(left, right),
+            )[
+                0, 0, 0, 0
+            ]
+        if aligned:
+            return window
+
+        from rasterio.transform import from_bounds, from_origin
+        from rasterio.warp import reproject, Resampling
+
+        data = np.full(shape, FILL_VALUE, dtype=DTYPE)
+        reproject(
+            source=window,
+            destination=data,
+            src_transform=from_origin(
+                self.grid["left"] + first_col * res,
+                self.grid["top"] - first_row * res,
+                res,
+                res,
+            ),
+            dst_transform=from_bounds(*bounds, shape[1], shape[0]),
+            src_crs=self.grid["crs"],
+            dst_crs=self.grid["crs"],
+            src_nodata=FILL_VALUE,
+            dst_nodata=FILL_VALUE,
+            resampling=Resampling.bilinear,
+        )
+        return data
+
+    def read(self, **selection):
+        """Read a block of the store, selected by label or pixel range
+
+        Args:
+            selection: lassettings, interpolation, photons, noise as a label or list of
+                labels (default all), y and x as slices of the site grid (default all)
+
+        Returns:
+            array: (lassettings, interpolation, photons, noise, y, x) block
+        """
+        index = []
+        for dim in DIMS[:4]:
+            values = selection.get(dim, self.labels[dim])
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            index.append([self.label_index(dim, value) for value in values])
+        for dim, size in zip(DIMS[4:], self.shape[4:]):
+            start, stop, _ = selection.get(dim, slice(None)).indices(size)
+            index.append(range(start, stop))
+
+        block = np.full([len(idx) for idx in index], FILL_VALUE, dtype=DTYPE)
+        rows, cols = self.chunks[4:]
+        row_range, col_range = index[4], index[5]
+        if len(row_range) == 0 or len(col_range) == 0:
+            return block
+        chunk_rows = range(row_range[0] // rows, (row_range[-1]) // rows + 1)
+        chunk_cols = range(col_range[0] // cols, (col_range[-1]) // cols + 1)
+
+        # Only chunks overlapping the selection are read
+        for positions in itertools.product(*(range(len(idx)) for idx in index[:4])):
+            scenario = tuple(idx[pos] for idx, pos in zip(index[:4], positions))
+            for chunk_row, chunk_col in itertools.product(chunk_rows, chunk_cols):
+                chunk_idx = scenario + (chunk_row, chunk_col)
+                if not os.path.exists(self.chunk_file(chunk_idx)):
+                    continue
+                chunk = self.read_chunk(chunk_idx)[0, 0, 0, 0]
+                top = max(row_range[0], chunk_row * rows)
+                bottom = min(row_range[-1] + 1, (chunk_row + 1) * rows)
+                left = max(col_range[0], chunk_col * cols)
+                right = min(col_range[-1] + 1, (chunk_col + 1) * cols)
+                block[positions][
+                    top - row_range[0] : bottom - row_range[0],
+                    left - col_range[0] : right - col_range[0],
+                ] = chunk[
+                    top - chunk_row * rows : bottom - chunk_row * rows,
+                    left - chunk_col * cols : right - chunk_col * cols,
+                ]
+        return block
+
+
+def write_bytes(path, data):
+    """Write a file so that readers only ever see the complete contents"""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+class ChunkLock(object):
+    """
+    Exclusive lock file around the read-modify-write of one chunk
+    """
+
+    def __init__(self, chunk_file):
+        self.lock_file = f"{chunk_file}.lock"
+
+    def __enter__(self):
+        while True:
+            try:
+                os.close(os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return self
+            except FileExistsError:
+                # Break locks left by writers that died mid-update
+                try:
+                    if time.time() - os.path.getmtime(self.lock_file) > LOCK_TIMEOUT:
+                        os.remove(self.lock_file)
+                except FileNotFoundError:
+                    pass
+                time.sleep(0.01)
+
+    def __exit__(self, *exc_info):
+        os.remove(self.lock_file)
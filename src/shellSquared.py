@@ -2,7 +2,22 @@
 
 import subprocess
 import time
-from dtmShell import gediCommands
+import argparse
+import commands
+from commands import LAS_SETTINGS
+
+
+def gediCommands():
+    """
+    Read commandline arguments, the same as dtmShell
+    """
+    p = argparse.ArgumentParser(
+        description=("Script to run dtmShell with each lastools setting")
+    )
+    commands.dtm_arguments(p)
+
+    cmdargs = p.parse_args()
+    return cmdargs
 
 
 def run_dtmShell(folder, las_settings, interpolation, int_meth):
@@ -43,18 +58,7 @@ if __name__ == "__main__":
 
     if las_setting == "all":
         # Run dtmShell with all lassettings
-        las_settings = [
-            "40051",
-            "50051",
-            "60051",
-            "400501",
-            "500501",
-            "600501",
-            "400505",
-            "500505",
-            "600505",
-        ]
-        for setting in las_settings:
+        for setting in LAS_SETTINGS:
             run_dtmShell(study_area, setting, interpolation, int_meth)
     else:
         run_dtmShell(study_area, las_setting, interpolation, int_meth)
@@ -1,5 +1,7 @@
 import time
+import argparse
 import rasterio
+import rasterio.transform
 import numpy as np
 from matplotlib import pyplot as plt
 from glob import glob
@@ -8,27 +10,40 @@ from scipy import stats
 from scipy.stats import gaussian_kde
 from matplotlib.animation import FuncAnimation
 from lasBounds import append_results
+from alsCube import AlsCube, cube_exists
 from plotting import folder_colour
-from analyseResults import analysisCommands
+import commands
+import memoryReport
 
 
-def find_merged(folder):
+def slopeCommands():
+    """
+    Read commandline arguments
+    """
+    p = argparse.ArgumentParser(
+        description=("Script to compare results with slope and canopy cover")
+    )
+    commands.analysis_arguments(p)
+
+    cmdargs = p.parse_args()
+    return cmdargs
+
+
+def find_merged(folder, bands):
     """FInd merged rasters
 
     Args:
         folder (str): study site
+        bands (list): raster name endings, e.g. 'canopy' or 'diff_linear'
 
     Returns:
-        str: raster file names
+        list: raster file names, in the order of bands
     """
     file_path = f"data/{folder}/merged_rasters"
 
-    canopy_list = glob(file_path + f"/*canopy.tif")
-    slope_list = glob(file_path + f"/*slope.tif")
-    diff_l_list = glob(file_path + f"/*diff_linear.tif")
-    diff_c_list = glob(file_path + f"/*diff_cubic.tif")
-    print("reading files :", canopy_list, slope_list, diff_l_list, diff_c_list)
-    return canopy_list[0], slope_list[0], diff_l_list[0], diff_c_list[0]
+    tif_lists = [glob(file_path + f"/*{band}.tif") for band in bands]
+    print("reading files :", *tif_lists)
+    return [tif_list[0] for tif_list in tif_lists]
 
 
 def open_raster(tif):
@@ -45,10 +60,67 @@ def pad_array(arr, target_shape):
     return padded_arr
 
 
+def sample_raster(read_tif, transform, xs, ys):
+    """Values of a raster array at coordinates, 0 outside it"""
+    rows, cols = rasterio.transform.rowcol(transform, xs, ys)
+    rows, cols = np.asarray(rows), np.asarray(cols)
+    inside = (
+        (rows >= 0)
+        & (rows < read_tif.shape[0])
+        & (cols >= 0)
+        & (cols < read_tif.shape[1])
+    )
+    values = np.zeros(len(xs))
+    values[inside] = read_tif[rows[inside], cols[inside]]
+    return values
+
+
+def cube_slope_cc(folder):
+    """Canopy cover and slope from the site's ALS cube, with merged differences at each pixel
+
+    Cube tiles keep their own 30 m grids, so the merged difference rasters are
+    sampled at each tile's pixel centres rather than padded to a common shape.
+
+    Args:
+        folder (str): study site
+
+    Returns:
+        2d array: canopy, slope, linear and cubic differences
+    """
+    diffs = []
+    for diff_tif in find_merged(folder, ["diff_linear", "diff_cubic"]):
+        with rasterio.open(diff_tif) as diff_open:
+            diffs.append((diff_open.read(1), diff_open.transform))
+    cube = AlsCube(folder)
+    columns = []
+    for tile, window in cube.tiles.items():
+        canopy = cube.band(tile, "canopy")
+        rows, cols = np.indices(canopy.shape)
+        # Pixel centres of the ALS tifs written by interpretMetric.create_tiff
+        xs = window["bounds"][0] + cube.resolution * (cols.ravel() + 1)
+        ys = window["bounds"][3] - cube.resolution * (rows.ravel() + 1)
+        columns.append(
+            np.vstack(
+                [
+                    canopy.ravel(),
+                    cube.band(tile, "slope").ravel(),
+                ]
+                + [sample_raster(diff, transform, xs, ys) for diff, transform in diffs]
+            )
+        )
+    return np.hstack(columns)
+
+
 def slope_cc(folder):
     """Open tif files and return flat arrays"""
 
-    canopy_tif, slope_tif, diff_l_tif, diff_c_tif = find_merged(folder)
+    # ALS tifs are not written by cube runs
+    if cube_exists(folder):
+        return cube_slope_cc(folder)
+
+    canopy_tif, slope_tif, diff_l_tif, diff_c_tif = find_merged(
+        folder, ["canopy", "slope", "diff_linear", "diff_cubic"]
+    )
 
     read_canopy = open_raster(canopy_tif)
     read_slope = open_raster(slope_tif)
@@ -130,7 +202,8 @@ def plot_matrix(sites, plot_data):
     axes = axes.flatten()
 
     for site, ax in zip(sites, axes):
-        all_arrays = slope_cc(site)
+        with memoryReport.stage("slope_cc", site=site):
+            all_arrays = slope_cc(site)
         print(f"raster values for {site}")
         print(all_arrays[0])
 
@@ -223,7 +296,8 @@ def plot_matrix(sites, plot_data):
 
         # Calculate the point density
         xy = np.vstack([var_x, var_y])
-        z = gaussian_kde(xy)(xy)
+        with memoryReport.stage("gaussian_kde", site=site, points=xy.shape[1]):
+            z = gaussian_kde(xy)(xy)
 
         # Sort the points by density, so that the densest points are plotted last
         idx = z.argsort()
@@ -323,11 +397,16 @@ def plot3D(merged_array, site):
     print(f"Gif saved to {outname}")
 
 
-if __name__ == "__main__":
+def main(cmdargs):
+    """Run the slope and canopy cover plots from parsed command line arguments
+
+    Args:
+        cmdargs (Namespace): arguments from slopeCommands or the cli slope-cc subcommand
+    """
     t = time.perf_counter()
-    cmdargs = analysisCommands()
     site = cmdargs.studyArea
     plot_type = cmdargs.plotType
+    memoryReport.start(cmdargs.memReport)
     # types:
     # 1 = Slope
     # 2 = Canopy
@@ -345,15 +424,27 @@ if __name__ == "__main__":
             "wind_river",
         ]
         print(f"working on all sites ({study_sites})")
-        plot_matrix(study_sites, plot_type)
+        with memoryReport.stage("plot_matrix", sites="all"):
+            plot_matrix(study_sites, plot_type)
         for site_x in study_sites:
-            results_array = slope_cc(site_x)
-            plot3D(results_array, site_x)
+            with memoryReport.stage("slope_cc", site=site_x):
+                results_array = slope_cc(site_x)
+            with memoryReport.stage("plot3D", site=site_x):
+                plot3D(results_array, site_x)
 
     else:
-        results_array = plot_matrix([site], plot_type)
-        results_array = slope_cc(site)
-        plot3D(results_array, site)
+        with memoryReport.stage("plot_matrix", sites=site):
+            results_array = plot_matrix([site], plot_type)
+        with memoryReport.stage("slope_cc", site=site):
+            results_array = slope_cc(site)
+        with memoryReport.stage("plot3D", site=site):
+            plot3D(results_array, site)
+
+    memoryReport.finish()
 
     t = time.perf_counter() - t
     print("time taken: ", t, " seconds")
+
+
+if __name__ == "__main__":
+    main(slopeCommands())
@@ -0,0 +1,389 @@
+"""Expand a declarative parameter sweep into a job graph, running stages shared between sweep axes only once"""
+
+import os
+import json
+import time
+import argparse
+import itertools
+import tomllib
+import commands
+
+# Pipeline stages in run order, with the sweep axes each depends on and its input stages
+STAGES = [
+    ("gedirat", ("site",), ()),
+    ("metrictext", ("site",), ("gedirat",)),
+    ("photons", ("site", "photons", "noise"), ("gedirat",)),
+    ("lasground", ("site", "photons", "noise", "lassettings"), ("photons",)),
+    ("createdtm", ("site", "lassettings"), ("lasground",)),
+    ("comparedtm", ("site", "lassettings"), ("createdtm", "metrictext")),
+    (
+        "analyse",
+        ("site", "lassettings", "interpolation", "bs_thresh", "outliers"),
+        ("comparedtm",),
+    ),
+]
+
+# Stages run outside python (lastools batch files)
+EXTERNAL_STAGES = ["lasground"]
+
+# Axes a stage covers in full from the files on disk rather than through its own jobs,
+# so their values are recorded with the job and a change reruns it
+SHARED_AXES = {
+    "createdtm": ("photons", "noise"),
+    "comparedtm": ("photons", "noise", "interpolation"),
+}
+# Python photon counting reads each waveform file once for every photon/noise pair, so
+# it runs once per site rather than once per pair as gediMetric does
+PYTHON_PHOTON_AXES = {"photons": ("photons", "noise")}
+
+DEFAULT_AXES = {
+    "site": ["Bonaly"],
+    "photons": [149, 300, 500, 1000],
+    "noise": [0, 4, 8, 15, 104, 149],
+    "lassettings": ["400505"],
+    "interpolation": ["canopy_middle"],
+    "bs_thresh": [4],
+    "outliers": [1],
+}
+
+DEFAULT_OPTIONS = {
+    "als_source": "text",
+    # ALS reference read into the cube when als_source is 'cube'
+    "cube_source": "text",
+    "native": False,
+    "seed": 0,
+    "realizations": 1,
+    # Realization simulated by this sweep run, one per run when realizations > 1
+    "realization": 0,
+    "workers": 1,
+    "cache": None,
+    "cache_quota": 50,
+    "store": False,
+    "halo": 0,
+    "resolutions": [30],
+}
+
+
+def sweepCommands():
+    """
+    Read commandline arguments
+    """
+    p = argparse.ArgumentParser(
+        description=("Plan and run a parameter sweep from a TOML or YAML spec")
+    )
+    commands.sweep_arguments(p)
+
+    cmdargs = p.parse_args()
+    return cmdargs
+
+
+def read_spec(spec_file):
+    """Read sweep axes and options, filling in defaults
+
+    Args:
+        spec_file (str): TOML or YAML file with [axes] and [options] tables
+
+    Returns:
+        dict, dict: axes and options
+    """
+    if spec_file.endswith((".yaml", ".yml")):
+        # Optional dependency, only needed for YAML specs
+        import yaml
+
+        with open(spec_file) as file:
+            spec = yaml.safe_load(file)
+    else:
+        with open(spec_file, "rb") as file:
+            spec = tomllib.load(file)
+
+    axes = dict(DEFAULT_AXES)
+    for axis, values in spec.get("axes", {}).items():
+        if axis not in axes:
+            raise ValueError(f"Unknown sweep axis {axis}, choose from {list(axes)}")
+        axes[axis] = values if isinstance(values, list) else [values]
+    # Folder and file names treat lassettings as strings
+    axes["lassettings"] = [str(value) for value in axes["lassettings"]]
+
+    options = dict(DEFAULT_OPTIONS)
+    options.update(spec.get("options", {}))
+    return axes, options
+
+
+def node_id(stage, key):
+    """Readable unique name of a job"""
+    return "_".join([stage] + [f"{axis}{value}" for axis, value in key])
+
+
+def python_photons(options):
+    """Whether photons are counted in python rather than by gediMetric"""
+    return options["native"] or options["realizations"] > 1
+
+
+def stage_plan(options):
+    """Stages with the axes each has its own jobs for and the axes it covers in full
+
+    Args:
+        options (dict): run options
+
+    Returns:
+        list: stage, job axes, input stages and shared axes, in run order
+    """
+    shared_axes = dict(SHARED_AXES)
+    if python_photons(options):
+        shared_axes.update(PYTHON_PHOTON_AXES)
+    return [
+        (
+            stage,
+            tuple(
+                axis for axis in stage_axes if axis not in shared_axes.get(stage, ())
+            ),
+            inputs,
+            shared_axes.get(stage, ()),
+        )
+        for stage, stage_axes, inputs in STAGES
+    ]
+
+
+def plan(axes, options=DEFAULT_OPTIONS):
+    """Expand sweep axes into jobs, one per combination of the axes a stage depends on
+
+    Args:
+        axes (dict): axis name: values
+        options (dict): run options, python photon counting covers every pair in one job
+
+    Returns:
+        dict: job id: job with stage, axis values, shared axes and dependencies, in
+            run order
+    """
+    jobs = {}
+    for stage, stage_axes, inputs, shared in stage_plan(options):
+        for values in itertools.product(*(axes[axis] for axis in stage_axes)):
+            key = tuple(zip(stage_axes, values))
+            params = dict(key)
+            # Depend on jobs of input stages that agree on shared axes
+            deps = [
+                dep
+                for dep in jobs
+                if jobs[dep]["stage"] in inputs
+                and all(
+                    params[axis] == value
+                    for axis, value in jobs[dep]["params"].items()
+                    if axis in params
+                )
+            ]
+            job = node_id(stage, key)
+            jobs[job] = {
+                "stage": stage,
+                "params": params,
+                "shared": shared,
+                "deps": deps,
+            }
+    return jobs
+
+
+def plan_summary(jobs, axes, options=DEFAULT_OPTIONS):
+    """Print number of jobs per stage against running every stage for every combination
+
+    Args:
+        jobs (dict): job graph from plan
+        axes (dict): axis name: values
+        options (dict): run options
+    """
+    full_grid = 1
+    for values in axes.values():
+        full_grid *= len(values)
+    print(f"{len(jobs)} jobs, {full_grid * len(STAGES)} without sharing")
+    for stage, stage_axes, _, _ in stage_plan(options):
+        count = sum(1 for job in jobs.values() if job["stage"] == stage)
+        print(f"{stage}: {count} jobs (depends on {', '.join(stage_axes)})")
+
+
+def run_job(job, axes, options):
+    """Run one job of the sweep
+
+    Args:
+        job (dict): job from plan
+        axes (dict): axis name: values, interpolation methods share compareDTM jobs
+        options (dict): run options
+    """
+    stage, params = job["stage"], job["params"]
+    cache = None
+    if options["cache"] is not None:
+        from toolCache import ToolCache
+
+        cache = ToolCache(options["cache"], options["cache_quota"])
+
+    # Heavy modules are only imported for stages that need them
+    if stage == "gedirat":
+        import testShell
+
+        testShell.runGRat(params["site"], cache)
+
+    elif stage == "metrictext":
+        import testShell
+
+        if options["als_source"] == "text" or (
+            options["als_source"] == "cube" and options["cube_source"] == "text"
+        ):
+            testShell.metricText(params["site"], cache)
+        if options["als_source"] == "cube":
+            from alsCube import build_cube
+
+            build_cube(params["site"], options["cube_source"])
+
+    elif stage == "photons" and python_photons(options):
+        from glob import glob
+        import photonCount
+
+        # Every photon/noise pair from one read of each waveform file
+        photonCount.runPhotonCount(
+            glob(f"data/{params['site']}/sim_waves/*.h5"),
+            params["site"],
+            axes["photons"],
+            axes["noise"],
+            seed=options["seed"],
+            realizations=options["realizations"],
+            workers=options["workers"],
+            realization=options["realization"],
+        )
+
+    elif stage == "photons":
+        import testShell
+
+        testShell.runMetric(
+            params["site"],
+            params["noise"],
+            params["photons"],
+            options["native"],
+            options["seed"],
+            cache,
+            options["realizations"],
+            options["workers"],
+            options["realization"],
+        )
+
+    elif stage == "lasground":
+        print(
+            f"run lastools for {params['site']} p{params['photons']} n{params['noise']}"
+            f" into sim_ground{params['lassettings']} (see bat/)"
+        )
+
+    elif stage == "createdtm":
+        from dtmShell import DtmCreation
+
+        DtmCreation(cache).createDTM(params["site"], params["lassettings"])
+
+    elif stage == "comparedtm":
+        from dtmShell import DtmCreation
+        from scenarioStore import ScenarioStore
+
+        store = ScenarioStore.create(params["site"]) if options["store"] else None
+        # All interpolation methods share one read of each file
+        DtmCreation().compareDTM(
+            params["site"],
+            True,
+            axes["interpolation"],
+            params["lassettings"],
+            options["als_source"],
+            store=store,
+            halo=options["halo"],
+            workers=options["workers"],
+            resolutions=options["resolutions"],
+        )
+
+    elif stage == "analyse":
+        from analyseResults import read_csv
+        from dtmShell import CANOPY_MIDDLE
+
+        method = params["interpolation"]
+        read_csv(
+            params["site"],
+            params["lassettings"],
+            "" if method == CANOPY_MIDDLE else f"_{method}",
+            params["bs_thresh"],
+            params["outliers"],
+            study_sites=[params["site"]],
+        )
+
+
+def done_text(job, axes, options=DEFAULT_OPTIONS):
+    """Contents of a job's done marker, the values of the shared axes it ran with
+
+    Args:
+        job (dict): job from plan
+        axes (dict): axis name: values
+        options (dict): run options, python photon jobs also record their realization
+
+    Returns:
+        str: json of shared axis values, empty for stages without shared axes
+    """
+    shared = job.get("shared", ())
+    if not shared:
+        return ""
+    values = {axis: sorted(str(value) for value in axes[axis]) for axis in shared}
+    # Each realization is simulated by its own sweep run
+    if job["stage"] == "photons":
+        values["realization"] = options["realization"]
+    return json.dumps(values, sort_keys=True)
+
+
+def run_plan(jobs, axes, options, state_dir):
+    """Run jobs in order, each once, skipping jobs finished by an earlier run
+
+    A job is rerun when the shared axis values it ran with have changed, or when
+    one of its input jobs has been rerun.
+
+    Args:
+        jobs (dict): job graph from plan
+        axes (dict): axis name: values
+        options (dict): run options
+        state_dir (str): folder recording finished jobs
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    rerun = set()
+    for idx, (job_name, job) in enumerate(jobs.items()):
+        done_marker = f"{state_dir}/{job_name}.done"
+        text = done_text(job, axes, options)
+        stale_inputs = any(dep in rerun for dep in job["deps"])
+        if os.path.exists(done_marker) and not stale_inputs:
+            with open(done_marker) as marker:
+                if marker.read() == text:
+                    print(f"{idx + 1} of {len(jobs)}: {job_name} already done")
+                    continue
+        print(f"{idx + 1} of {len(jobs)}: working on {job_name}")
+        run_job(job, axes, options)
+
+        # External stages are not recorded, their outputs are made outside python,
+        # but they pass on reruns of their inputs
+        if job["stage"] not in EXTERNAL_STAGES:
+            with open(done_marker, "w") as marker:
+                marker.write(text)
+            rerun.add(job_name)
+        elif stale_inputs:
+            rerun.add(job_name)
+
+
+def main(cmdargs):
+    """Run the parameter sweep from parsed command line arguments
+
+    Args:
+        cmdargs (Namespace): arguments from sweepCommands or the cli sweep subcommand
+    """
+    t = time.perf_counter()
+
+    axes, options = read_spec(cmdargs.spec)
+    jobs = plan(axes, options)
+    plan_summary(jobs, axes, options)
+
+    if cmdargs.dryRun:
+        for job_name, job in jobs.items():
+            print(job_name, "<-", ", ".join(job["deps"]) or "-")
+    else:
+        run_plan(jobs, axes, options, cmdargs.state)
+
+    t = time.perf_counter() - t
+    print("time taken: ", t, " seconds")
+
+
+if __name__ == "__main__":
+    main(sweepCommands())
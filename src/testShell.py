@@ -1,11 +1,16 @@
 """Run gediSimulator to simulate full-waveforms from ALS files"""
 
+import os
 import time
+import asyncio
 import itertools
 import subprocess
 import argparse
 from glob import glob
 import lasBounds
+import commands
+from toolCache import ToolCache, output_files, run_command
+from costModel import CostModel, record_runtime
 
 
 def gediCommands():
@@ -13,40 +18,47 @@ def gediCommands():
     Read commandline arguments
     """
     p = argparse.ArgumentParser(description=("Test data fusion model for Bonaly"))
+    commands.simulate_arguments(p)
 
-    p.add_argument(
-        "--studyarea",
-        dest="studyArea",
-        type=str,
-        default="Bonaly",
-        help=("Study area name"),
-    )
+    cmdargs = p.parse_args()
+    return cmdargs
 
-    p.add_argument(
-        "--noise",
-        dest="noise",
-        type=int,
-        default="0",
-        help=("Level of noise to be added to waveform. -1 to add a set of options"),
-    )
 
-    p.add_argument(
-        "--pcount",
-        dest="pCount",
-        type=int,
-        default="100",
-        help=("Number of photon in simulated waveform. -1 to add a set of options"),
-    )
+def ratCommand(file, outname, bounds):
+    """Define framework for gediRat commands
 
-    cmdargs = p.parse_args()
-    return cmdargs
+    Args:
+        file (str): input las file
+        outname (str): output hdf5 file
+        bounds (list): minimum bounding rectangle of las file
+
+    Returns:
+        list: gediRat command arguments
+    """
+    return [
+        "gediRat",
+        "-input",
+        file,
+        "-ground",
+        "-gridBound",
+        str(bounds[0]),
+        str(bounds[2]),
+        str(bounds[1]),
+        str(bounds[3]),
+        "-gridStep",
+        "30",
+        "-output",
+        outname,
+        "-hdf",
+    ]
 
 
-def runGRat(folder):
+def runGRat(folder, cache=None):
     """Function to run gediRat (waveform simulation) on las files in a folder
 
     Args:
         folder (str): folder for specified study site
+        cache (ToolCache): output cache, None to always run gediRat
     """
 
     # Identify files in folders
@@ -60,30 +72,207 @@ def runGRat(folder):
         outname = f"data/{folder}/sim_waves/{bounds[0]}_{bounds[1]}.h5"
 
         # Run gediRat in command line
-        rat_files = subprocess.run(
-            [
-                "gediRat",
-                "-input",
-                file,
-                "-ground",
-                "-gridBound",
-                str(bounds[0]),
-                str(bounds[2]),
-                str(bounds[1]),
-                str(bounds[3]),
-                "-gridStep",
-                "30",
-                "-output",
-                outname,
-                "-hdf",
-            ],
-            check=True,
+        returncode = run_command(
+            ratCommand(file, outname, bounds), file, outname, cache
         )
 
-        print("The exit code was: %d" % rat_files.returncode)
+        print("The exit code was: %d" % returncode)
+
+
+# gediRat holds every point in memory, approximate cost per point plus fixed overhead
+RAT_BYTES_PER_POINT = 80
+RAT_BASE_BYTES = 200 * 1024**2
+
+
+def ratMemory(file, n_points=None):
+    """Estimate peak memory of gediRat from the point count in the las header
+
+    Args:
+        file (str): input las file
+        n_points (int): point count if already known, e.g. from lasStats
+
+    Returns:
+        int: estimated memory in bytes
+    """
+    if n_points is None:
+        n_points = lasBounds.lasPointCount(file)
+    return RAT_BASE_BYTES + RAT_BYTES_PER_POINT * n_points
+
+
+def ratJobs(sites):
+    """List gediRat jobs for every raw las tile of the given sites
+
+    Args:
+        sites (list): study site names
+
+    Returns:
+        list: dictionaries describing each job
+    """
+    # pandas is only needed to read las statistics tables
+    from lasStats import read_stats, current_row
+
+    jobs = []
+    for folder in sites:
+        # Bounds and point counts from lasStats, las headers are opened without it
+        stats = read_stats(folder)
+        for file in glob(f"data/{folder}/raw_las/*.las"):
+            # Rows of rewritten files are stale, even when the size is unchanged
+            if current_row(stats, file):
+                row = stats.loc[file]
+                bounds = [int(row[key]) for key in ("Min_x", "Min_y", "Max_x", "Max_y")]
+                n_points = int(row["Points"])
+            else:
+                bounds = lasBounds.lasMBR(file)
+                n_points = lasBounds.lasPointCount(file)
+            jobs.append(
+                {
+                    "folder": folder,
+                    "file": file,
+                    "bounds": bounds,
+                    "outname": f"data/{folder}/sim_waves/{bounds[0]}_{bounds[1]}.h5",
+                    "memory": ratMemory(file, n_points),
+                    "points": n_points,
+                }
+            )
+    return jobs
+
+
+class RatBudget(object):
+    """
+    Memory budget shared by concurrent gediRat jobs
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, amount):
+        """Wait until amount fits in the budget, then reserve it
+
+        Args:
+            amount (int): bytes requested
+
+        Returns:
+            int: bytes reserved
+        """
+        # Tiles larger than the whole budget run once everything else has finished
+        amount = min(amount, self.limit)
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.used + amount <= self.limit)
+            self.used += amount
+        return amount
+
+    async def release(self, amount):
+        """Return reserved bytes to the budget and wake waiting jobs"""
+        async with self.condition:
+            self.used -= amount
+            self.condition.notify_all()
 
 
-def metricCommand(input, outRoot, nPhotons, noise):
+async def runRatJob(job, workers, budget, cache=None):
+    """Run one gediRat job once a worker slot and enough memory are free
+
+    Args:
+        job (dict): job from ratJobs
+        workers (asyncio.Semaphore): limits number of running jobs
+        budget (RatBudget): limits estimated memory of running jobs
+        cache (ToolCache): output cache, None to always run gediRat
+
+    Returns:
+        dict: the finished job
+    """
+    command = ratCommand(job["file"], job["outname"], job["bounds"])
+    if cache is not None:
+        # Cache hits need neither a worker slot nor memory
+        key = cache.key(command, job["file"], job["outname"])
+        if cache.fetch(key, job["outname"]):
+            print(f"cache hit for {job['outname']}")
+            return job
+        # Stale outputs may be links into the cache, remove them before gediRat writes
+        for file in output_files(job["outname"]):
+            os.remove(file)
+        start = time.time()
+
+    async with workers:
+        reserved = await budget.acquire(job["memory"])
+        try:
+            t = time.perf_counter()
+            rat_process = await asyncio.create_subprocess_exec(*command)
+            try:
+                returncode = await rat_process.wait()
+            except asyncio.CancelledError:
+                # Another job failed, do not leave gediRat running on its own
+                rat_process.kill()
+                await rat_process.wait()
+                raise
+            t = time.perf_counter() - t
+        finally:
+            await budget.release(reserved)
+
+    # Match subprocess.run(check=True) behaviour
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+    # Runtimes of simulated tiles refine the cost model of later runs
+    record_runtime("gediRat", job["features"], t)
+    if cache is not None:
+        cache.store(key, job["outname"], since=start - 1)
+    return job
+
+
+async def scheduleGRat(sites, n_workers, mem_budget, cache=None):
+    """Run gediRat on all tiles of all sites concurrently
+
+    Args:
+        sites (list): study site names
+        n_workers (int): maximum number of jobs running at once
+        mem_budget (float): memory budget in GB
+        cache (ToolCache): output cache, None to always run gediRat
+    """
+    # Longest tiles start first, so no large tile is left running alone at the end
+    jobs = CostModel().longest_first(
+        "gediRat",
+        ratJobs(sites),
+        lambda job: {
+            "points": job["points"],
+            "file_size": os.path.getsize(job["file"]),
+        },
+    )
+    workers = asyncio.Semaphore(n_workers)
+    budget = RatBudget(int(mem_budget * 1024**3))
+    print(f"scheduling {len(jobs)} gediRat jobs on {n_workers} workers")
+
+    tasks = [
+        asyncio.create_task(runRatJob(job, workers, budget, cache)) for job in jobs
+    ]
+    try:
+        # Report jobs as they finish rather than in submission order
+        for idx, task in enumerate(asyncio.as_completed(tasks)):
+            job = await task
+            print(
+                f"finished {job['folder']} {idx + 1} of {len(jobs)}: {job['outname']}"
+                f" ({job['memory'] / 1024**2:.0f} MB, {job['cost']:.0f}s estimated)"
+            )
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Wait for cancelled jobs to stop their gediRat processes
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def runGRatAsync(sites, n_workers, mem_budget, cache=None):
+    """Run gediRat on las files of several sites with a memory-aware scheduler
+
+    Args:
+        sites (list): study site names
+        n_workers (int): maximum number of jobs running at once
+        mem_budget (float): memory budget in GB
+        cache (ToolCache): output cache, None to always run gediRat
+    """
+    asyncio.run(scheduleGRat(sites, n_workers, mem_budget, cache))
+
+
+def metricCommand(input, outRoot, nPhotons, noise, cache=None):
     """Define framework for gediMetric comands
 
     Args:
@@ -91,8 +280,9 @@ def metricCommand(input, outRoot, nPhotons, noise):
         outRoot (str): output file path
         nPhotons (int): number of photons per waveform
         noise (int): number of noise photons per waveform
+        cache (ToolCache): output cache, None to always run gediMetric
     """
-    gedi_metric = subprocess.run(
+    returncode = run_command(
         [
             "gediMetric",
             "-input",
@@ -107,16 +297,19 @@ def metricCommand(input, outRoot, nPhotons, noise):
             "-noiseMult",
             f"{noise}",
         ],
-        check=True,
+        input,
+        outRoot,
+        cache,
     )
-    print("The exit code was: %d" % gedi_metric.returncode)
+    print("The exit code was: %d" % returncode)
 
 
-def metricText(folder):
+def metricText(folder, cache=None):
     """Run gediMetric to get text file of metrics (slope, canopy cover, als ground)
 
     Args:
         folder (str): name of site to investigate
+        cache (ToolCache): output cache, None to always run gediMetric
     """
 
     filePath = f"data/{folder}/sim_waves"
@@ -125,7 +318,7 @@ def metricText(folder):
         clipFile = lasBounds.clipNames(file, ".h5")
         outname = f"data/{folder}/pts_metric/{clipFile}"
         # Define and run command
-        gedi_metric = subprocess.run(
+        returncode = run_command(
             [
                 "gediMetric",
                 "-input",
@@ -136,12 +329,24 @@ def metricText(folder):
                 "-ground",
                 "-noRHgauss",
             ],
-            check=True,
+            file,
+            outname,
+            cache,
         )
-        print("The exit code was: %d" % gedi_metric.returncode)
-
-
-def runMetric(folder, noise, photons):
+        print("The exit code was: %d" % returncode)
+
+
+def runMetric(
+    folder,
+    noise,
+    photons,
+    native=False,
+    seed=0,
+    cache=None,
+    realizations=1,
+    workers=1,
+    realization=0,
+):
     """Use gediMetric to convert hdf5 outputs of gedirat simulation into .pts files
         Also vary noise and photon count
 
@@ -149,6 +354,12 @@ def runMetric(folder, noise, photons):
         folder (str): name of study site
         noise (int): noise level. -1 will trigger multiple options
         photons (int): photon count per waveform. -1 will trigger multiple options
+        native (bool): simulate photons in python instead of gediMetric
+        seed (int): random seed for python photon counting
+        cache (ToolCache): output cache, None to always run gediMetric
+        realizations (int): seeded Monte Carlo realizations of each scenario
+        workers (int): number of python photon counting processes
+        realization (int): realization simulated by this run, when realizations > 1
     """
 
     # Find file names
@@ -165,6 +376,23 @@ def runMetric(folder, noise, photons):
     ]
     photon_count = [149, 300, 500, 1000]
 
+    # Read each hdf5 once and simulate all combinations in python
+    if native or realizations > 1:
+        # h5py is only needed for python photon counting
+        import photonCount
+
+        photonCount.runPhotonCount(
+            file_list,
+            folder,
+            photon_count if photons == -1 else [photons],
+            noise_levels if noise == -1 else [noise],
+            seed=seed,
+            realizations=realizations,
+            workers=workers,
+            realization=realization,
+        )
+        return
+
     # 4 different options to allow different combinations of variation for gediMetric command
     # All noises all photons options
     if noise == -1 and photons == -1:
@@ -175,7 +403,7 @@ def runMetric(folder, noise, photons):
             clipFile = lasBounds.clipNames(file, ".h5")
             print(f"working on {clipFile}, photons: {nPhotons} noise: {iNoise}")
             outroot = f"data/{folder}/pts_metric/{clipFile}_p{nPhotons}_n{iNoise}"
-            metricCommand(file, outroot, nPhotons, iNoise)
+            metricCommand(file, outroot, nPhotons, iNoise, cache)
 
     # All noises but only 1 photon value
     elif noise == -1 and photons != -1:
@@ -183,7 +411,7 @@ def runMetric(folder, noise, photons):
             clipFile = lasBounds.clipNames(file, ".h5")
             outroot = f"data/{folder}/pts_metric/{clipFile}_p{photons}_n{iNoise}"
             print(f"working on {clipFile}, photons: {photons} noise: {iNoise}")
-            metricCommand(file, outroot, photons, iNoise)
+            metricCommand(file, outroot, photons, iNoise, cache)
 
     # Only 1 noise level but all photon options
     elif noise != -1 and photons == -1:
@@ -191,7 +419,7 @@ def runMetric(folder, noise, photons):
             clipFile = lasBounds.clipNames(file, ".h5")
             outroot = f"data/{folder}/pts_metric/{clipFile}_p{nPhotons}_n{noise}"
             print(f"working on {clipFile}, photons: {nPhotons} noise: {noise}")
-            metricCommand(file, outroot, nPhotons, noise)
+            metricCommand(file, outroot, nPhotons, noise, cache)
 
     # 1 noise level and 1 photon count
     else:
@@ -201,16 +429,30 @@ def runMetric(folder, noise, photons):
             print(
                 f"working on {folder} of {len(file_list)}, photons: {photons} noise: {noise}"
             )
-            metricCommand(file, outroot, photons, noise)
+            metricCommand(file, outroot, photons, noise, cache)
 
 
-if __name__ == "__main__":
+def main(cmdargs):
+    """Run gediRat, gediMetric and photon counting from parsed command line arguments
+
+    Args:
+        cmdargs (Namespace): arguments from gediCommands or the cli simulate subcommand
+    """
     t = time.perf_counter()
 
-    cmdargs = gediCommands()
     study_area = cmdargs.studyArea
     set_noise = cmdargs.noise
     set_pCount = cmdargs.pCount
+    n_workers = cmdargs.workers
+    mem_budget = cmdargs.memBudget
+    native = cmdargs.native
+    seed = cmdargs.seed
+    als_source = cmdargs.alsSource
+    realizations = cmdargs.realizations
+    realization = cmdargs.realization
+    cache = (
+        None if cmdargs.cache is None else ToolCache(cmdargs.cache, cmdargs.cacheQuota)
+    )
 
     # process all sites
     if study_area == "all":
@@ -225,18 +467,50 @@ if __name__ == "__main__":
             "wind_river",
         ]
         print(f"working on all sites {study_sites}")
-        for site in study_sites:
-            runGRat(site)
-            metricText(site)
-            runMetric(site, set_noise, set_pCount)
 
     # Only process given site
     else:
+        study_sites = [study_area]
         print(f"working on {study_area}")
-        runGRat(study_area)
-        metricText(study_area)
-        runMetric(study_area, set_noise, set_pCount)
+
+    if n_workers > 1:
+        # Simulate tiles of every site together, then derive metrics per site
+        runGRatAsync(study_sites, n_workers, mem_budget, cache)
+        for site in study_sites:
+            if als_source == "text":
+                metricText(site, cache)
+            runMetric(
+                site,
+                set_noise,
+                set_pCount,
+                native,
+                seed,
+                cache,
+                realizations,
+                n_workers,
+                realization,
+            )
+    else:
+        for site in study_sites:
+            runGRat(site, cache)
+            if als_source == "text":
+                metricText(site, cache)
+            runMetric(
+                site,
+                set_noise,
+                set_pCount,
+                native,
+                seed,
+                cache,
+                realizations,
+                n_workers,
+                realization,
+            )
 
     # Test efficiency
     t = time.perf_counter() - t
     print("time taken: ", t, " seconds")
+
+
+if __name__ == "__main__":
+    main(gediCommands())
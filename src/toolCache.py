@@ -0,0 +1,261 @@
+"""Content-addressed cache of gediRat, gediMetric and mapLidar outputs, so unchanged inputs are not simulated twice"""
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import subprocess
+from glob import glob, escape
+
+# Linux ioctl cloning a file's extents (copy-on-write reflink)
+FICLONE = 0x40049409
+HASH_CHUNK = 1024**2
+
+
+def file_hash(file):
+    """sha256 of a file's contents, read in chunks"""
+    digest = hashlib.sha256()
+    with open(file, "rb") as data:
+        for chunk in iter(lambda: data.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def output_files(prefix, since=None):
+    """Files written for an output prefix, the prefix itself or prefix plus extensions
+
+    Args:
+        prefix (str): output file or output root passed to the tool
+        since (float): only files modified at or after this time
+
+    Returns:
+        list: file names
+    """
+    files = [
+        file
+        for file in glob(escape(prefix) + "*")
+        if file == prefix or file[len(prefix) :].startswith(".")
+    ]
+    if since is not None:
+        files = [file for file in files if os.path.getmtime(file) >= since]
+    return sorted(files)
+
+
+def link_file(source, dest):
+    """Materialise a cached file by hardlink, reflink, or copy as a last resort
+
+    Args:
+        source (str): file in cache
+        dest (str): output file name
+    """
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(source, dest)
+        return
+    except OSError:
+        # Cache on another filesystem
+        pass
+    try:
+        with open(source, "rb") as src, open(dest, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        shutil.copyfile(source, dest)
+
+
+class ToolCache(object):
+    """
+    Cache of tool outputs keyed by input contents, arguments and tool binary, with LRU eviction
+    """
+
+    def __init__(self, cache_dir, quota_gb=50):
+        self.cache_dir = cache_dir
+        self.quota = int(quota_gb * 1024**3)
+        self.hash_file = f"{cache_dir}/input_hashes.json"
+        os.makedirs(f"{cache_dir}/objects", exist_ok=True)
+
+        # Input hashes are remembered by size and modification time, large las files are hashed once
+        if os.path.exists(self.hash_file):
+            with open(self.hash_file) as hashes:
+                self.input_hashes = json.load(hashes)
+        else:
+            self.input_hashes = {}
+        self.tool_hashes = {}
+
+    def input_hash(self, file):
+        """Hash of an input file, reusing the stored hash if the file is unchanged"""
+        stat = os.stat(file)
+        path = os.path.abspath(file)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        known = self.input_hashes.get(path)
+        if known is not None and known["stamp"] == stamp:
+            return known["hash"]
+
+        digest = file_hash(file)
+        self.input_hashes[path] = {"stamp": stamp, "hash": digest}
+        tmp_name = f"{self.hash_file}.{os.getpid()}.tmp"
+        with open(tmp_name, "w") as hashes:
+            json.dump(self.input_hashes, hashes)
+        os.replace(tmp_name, self.hash_file)
+        return digest
+
+    def tool_version(self, tool):
+        """Hash of the tool binary, so rebuilt tools do not reuse old outputs"""
+        if tool not in self.tool_hashes:
+            binary = shutil.which(tool)
+            self.tool_hashes[tool] = file_hash(binary) if binary else tool
+        return self.tool_hashes[tool]
+
+    def key(self, command, input_file, output_prefix):
+        """Cache key of a tool run, independent of where input and output files live
+
+        Args:
+            command (list): tool command arguments
+            input_file (str): file read by the tool
+            output_prefix (str): output file or output root passed to the tool
+
+        Returns:
+            str: sha256 key
+        """
+        # Paths are replaced by placeholders, the input is identified by its contents
+        args = [
+            (
+                "{input}"
+                if arg == input_file
+                else "{output}" if arg == output_prefix else arg
+            )
+            for arg in command[1:]
+        ]
+        record = {
+            "tool": self.tool_version(command[0]),
+            "args": args,
+            "input": self.input_hash(input_file),
+        }
+        return hashlib.sha256(json.dumps(record).encode()).hexdigest()
+
+    def entry_dir(self, key):
+        return f"{self.cache_dir}/objects/{key[:2]}/{key}"
+
+    def fetch(self, key, output_prefix):
+        """Materialise cached outputs of a key
+
+        Args:
+            key (str): cache key
+            output_prefix (str): output file or output root passed to the tool
+
+        Returns:
+            bool: True if the outputs were in the cache
+        """
+        entry = self.entry_dir(key)
+        try:
+            with open(f"{entry}/entry.json") as meta:
+                suffixes = json.load(meta)["suffixes"]
+        except FileNotFoundError:
+            return False
+
+        os.makedirs(os.path.dirname(output_prefix) or ".", exist_ok=True)
+        for idx, suffix in enumerate(suffixes):
+            link_file(f"{entry}/{idx}", output_prefix + suffix)
+        # Entry modification time records last use for eviction
+        os.utime(entry)
+        return True
+
+    def store(self, key, output_prefix, since=None):
+        """Copy outputs of a finished run into the cache, then evict to the quota
+
+        Args:
+            key (str): cache key
+            output_prefix (str): output file or output root passed to the tool
+            since (float): only store files modified at or after this time
+        """
+        outputs = output_files(output_prefix, since)
+        if not outputs:
+            return
+        entry = self.entry_dir(key)
+        tmp_entry = f"{entry}.{os.getpid()}.tmp"
+        os.makedirs(tmp_entry, exist_ok=True)
+
+        # Copies rather than links, tools rewriting their outputs must not change the cache
+        size = 0
+        for idx, file in enumerate(outputs):
+            shutil.copyfile(file, f"{tmp_entry}/{idx}")
+            os.chmod(f"{tmp_entry}/{idx}", 0o444)
+            size += os.path.getsize(file)
+        with open(f"{tmp_entry}/entry.json", "w") as meta:
+            json.dump(
+                {
+                    "suffixes": [file[len(output_prefix) :] for file in outputs],
+                    "size": size,
+                },
+                meta,
+            )
+
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Another worker stored the same key first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits the quota"""
+        entries = []
+        for meta_file in glob(f"{self.cache_dir}/objects/*/*/entry.json"):
+            entry = os.path.dirname(meta_file)
+            try:
+                with open(meta_file) as meta:
+                    size = json.load(meta)["size"]
+                entries.append((os.path.getmtime(entry), size, entry))
+            except (OSError, ValueError):
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.quota:
+                break
+            print(f"cache over quota, removing {os.path.basename(entry)}")
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def run(self, command, input_file, output_prefix):
+        """Run a tool command, or reuse its outputs from the cache
+
+        Args:
+            command (list): tool command arguments
+            input_file (str): file read by the tool
+            output_prefix (str): output file or output root passed to the tool
+
+        Returns:
+            int: exit code, 0 for cache hits
+        """
+        key = self.key(command, input_file, output_prefix)
+        if self.fetch(key, output_prefix):
+            print(f"cache hit for {output_prefix}")
+            return 0
+
+        # Stale outputs may be links into the cache, remove them before the tool writes
+        for file in output_files(output_prefix):
+            os.remove(file)
+        start = time.time()
+        process = subprocess.run(command, check=True)
+        self.store(key, output_prefix, since=start - 1)
+        return process.returncode
+
+
+def run_command(command, input_file, output_prefix, cache=None):
+    """Run a tool command through the cache if one is given
+
+    Args:
+        command (list): tool command arguments
+        input_file (str): file read by the tool
+        output_prefix (str): output file or output root passed to the tool
+        cache (ToolCache): output cache, None to always run
+
+    Returns:
+        int: exit code
+    """
+    if cache is None:
+        return subprocess.run(command, check=True).returncode
+    return cache.run(command, input_file, output_prefix)
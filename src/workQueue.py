@@ -0,0 +1,276 @@
+"""File-based work queue, lets worker processes on one or more hosts share a job grid through a common directory"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+from glob import glob
+import pandas as pd
+
+# Queue directory layout
+JOB_DIR = "jobs"
+LOCK_DIR = "locks"
+RESULT_DIR = "results"
+FAILED_DIR = "failed"
+MERGE_LOCK = "merged.lock"
+
+
+def worker_name():
+    """Unique name of this worker process"""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def write_atomic(path, text):
+    """Write a file so that readers only ever see the complete contents
+
+    Args:
+        path (str): output file path
+        text (str): file contents
+    """
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as file:
+        file.write(text)
+        file.flush()
+        os.fsync(file.fileno())
+    # rename is atomic on local and network file systems
+    os.replace(tmp_path, path)
+
+
+def init_queue(queue_dir, jobs):
+    """Write the job grid to the queue directory
+
+    Args:
+        queue_dir (str): shared queue directory
+        jobs (dict): job id: job description (json serialisable)
+    """
+    for sub_dir in (JOB_DIR, LOCK_DIR, RESULT_DIR, FAILED_DIR):
+        os.makedirs(f"{queue_dir}/{sub_dir}", exist_ok=True)
+
+    # A new grid starts a new run, results and merge lock of the last one would be reused
+    old_files = (
+        glob(f"{queue_dir}/{JOB_DIR}/*.json")
+        + glob(f"{queue_dir}/{RESULT_DIR}/*.csv")
+        + glob(f"{queue_dir}/{FAILED_DIR}/*.txt")
+        + glob(f"{queue_dir}/{MERGE_LOCK}")
+    )
+    for old_file in old_files:
+        os.remove(old_file)
+
+    for job_id, job in jobs.items():
+        write_atomic(f"{queue_dir}/{JOB_DIR}/{job_id}.json", json.dumps(job))
+    print(f"{len(jobs)} jobs written to {queue_dir}")
+
+
+def read_jobs(queue_dir):
+    """Read all jobs in the queue
+
+    Args:
+        queue_dir (str): shared queue directory
+
+    Returns:
+        dict: job id: job description
+    """
+    jobs = {}
+    for job_file in sorted(glob(f"{queue_dir}/{JOB_DIR}/*.json")):
+        job_id = os.path.basename(job_file)[: -len(".json")]
+        with open(job_file) as file:
+            jobs[job_id] = json.load(file)
+    return jobs
+
+
+def job_finished(queue_dir, job_id):
+    """Whether a job has a result or has failed"""
+    return os.path.exists(f"{queue_dir}/{RESULT_DIR}/{job_id}.csv") or os.path.exists(
+        f"{queue_dir}/{FAILED_DIR}/{job_id}.txt"
+    )
+
+
+def lock_state(lock):
+    """Modification time and owner of a lock file
+
+    Args:
+        lock (str): lock file path
+
+    Returns:
+        float, str: mtime and worker name
+    """
+    mtime = os.path.getmtime(lock)
+    with open(lock) as file:
+        return mtime, file.read()
+
+
+def requeue_stale(queue_dir, timeout):
+    """Release locks of workers that have stopped sending heartbeats
+
+    Args:
+        queue_dir (str): shared queue directory
+        timeout (float): seconds without heartbeat before a worker is presumed dead
+    """
+    for lock in glob(f"{queue_dir}/{LOCK_DIR}/*.lock"):
+        try:
+            mtime, owner = lock_state(lock)
+        except FileNotFoundError:
+            continue
+        if time.time() - mtime <= timeout:
+            continue
+
+        # Only one worker can win the rename
+        tombstone = f"{lock}.{uuid.uuid4().hex}.stale"
+        try:
+            os.rename(lock, tombstone)
+        except FileNotFoundError:
+            continue
+        # The job may have been requeued and claimed again between the check and the
+        # rename, in which case the renamed lock is fresh and is put back
+        renamed_mtime, renamed_owner = lock_state(tombstone)
+        if renamed_owner != owner or time.time() - renamed_mtime <= timeout:
+            try:
+                # link fails rather than replace a lock claimed since the rename
+                os.link(tombstone, lock)
+            except FileExistsError:
+                pass
+            os.remove(tombstone)
+            continue
+        os.remove(tombstone)
+        print(f"requeued {os.path.basename(lock)[: -len('.lock')]}")
+
+
+def claim_job(queue_dir, jobs, worker):
+    """Claim the unfinished job without a lock with the highest estimated cost, so the
+    longest jobs start first
+
+    Args:
+        queue_dir (str): shared queue directory
+        jobs (dict): job id: job description
+        worker (str): name of this worker
+
+    Returns:
+        str: claimed job id, None if no job could be claimed
+    """
+    # Jobs without a cost estimate keep their order
+    for job_id in sorted(jobs, key=lambda job_id: -jobs[job_id].get("cost", 0)):
+        if job_finished(queue_dir, job_id):
+            continue
+        lock = f"{queue_dir}/{LOCK_DIR}/{job_id}.lock"
+        try:
+            # O_EXCL creation fails if another worker holds the job
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            continue
+        with os.fdopen(fd, "w") as file:
+            file.write(worker)
+        # Job may have finished between the check and the lock
+        if job_finished(queue_dir, job_id):
+            os.remove(lock)
+            continue
+        return job_id
+    return None
+
+
+class Heartbeat(object):
+    """
+    Keeps a job lock fresh from a background thread while the job runs
+    """
+
+    def __init__(self, lock, interval):
+        self.lock = lock
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.beat, daemon=True)
+
+    def beat(self):
+        """Touch the lock file until stopped"""
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.lock)
+            except FileNotFoundError:
+                # Lock was requeued by another worker, result is still written
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_worker(queue_dir, run_job, heartbeat=30, timeout=300, poll=10):
+    """Claim and run jobs until the queue is empty
+
+    Args:
+        queue_dir (str): shared queue directory
+        run_job (function): takes a job description, returns a results dataframe
+        heartbeat (float): seconds between lock updates
+        timeout (float): seconds without heartbeat before a job is requeued
+        poll (float): seconds to wait when all remaining jobs are claimed
+
+    Returns:
+        bool: whether this worker should merge the results
+    """
+    worker = worker_name()
+    jobs = read_jobs(queue_dir)
+    print(f"worker {worker} started on {len(jobs)} jobs")
+
+    while True:
+        requeue_stale(queue_dir, timeout)
+        job_id = claim_job(queue_dir, jobs, worker)
+
+        if job_id is None:
+            if all(job_finished(queue_dir, job_id) for job_id in jobs):
+                break
+            # Remaining jobs are held by other workers, wait in case they die
+            time.sleep(poll)
+            continue
+
+        lock = f"{queue_dir}/{LOCK_DIR}/{job_id}.lock"
+        print(f"{worker} working on {job_id}")
+        try:
+            with Heartbeat(lock, heartbeat):
+                result = run_job(jobs[job_id])
+            write_atomic(
+                f"{queue_dir}/{RESULT_DIR}/{job_id}.csv", result.to_csv(index=False)
+            )
+        except Exception as e:
+            print(f"{job_id} failed due to error: {e}")
+            write_atomic(f"{queue_dir}/{FAILED_DIR}/{job_id}.txt", f"{worker}: {e}\n")
+        finally:
+            try:
+                os.remove(lock)
+            except FileNotFoundError:
+                pass
+
+    # Exactly one worker merges once the queue has drained
+    try:
+        fd = os.open(f"{queue_dir}/{MERGE_LOCK}", os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    os.close(fd)
+    return True
+
+
+def read_results(queue_dir):
+    """Join the results of all finished jobs
+
+    Args:
+        queue_dir (str): shared queue directory
+
+    Returns:
+        dict, dataframe: jobs and their joined results
+    """
+    jobs = read_jobs(queue_dir)
+    dfs = []
+    for job_id in jobs:
+        result_file = f"{queue_dir}/{RESULT_DIR}/{job_id}.csv"
+        if os.path.exists(result_file):
+            dfs.append(pd.read_csv(result_file, dtype={"nPhotons": str, "Noise": str}))
+        elif os.path.exists(f"{queue_dir}/{FAILED_DIR}/{job_id}.txt"):
+            print(f"{job_id} failed, not included in results")
+        else:
+            print(f"{job_id} has not finished, not included in results")
+
+    results_df = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+    return jobs, results_df
@@ -0,0 +1,202 @@
+"""Error statistics of difference rasters in slope x canopy cover bins, for every scenario in one pass"""
+
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import rasterio
+import lasBounds
+import commands
+from commands import LAS_SETTINGS
+from errorMaps import AXES, diff_scenario
+from scenarioStore import diff_source, read_diff
+from alsCube import AlsCube, cube_exists
+
+# Sums kept for each bin
+SUMS = ["count", "sum", "sum_sq", "sum_abs"]
+
+
+def zonalCommands():
+    """
+    Read commandline arguments
+    """
+    p = argparse.ArgumentParser(
+        description=("Script to bin elevation error by slope and canopy cover")
+    )
+    commands.zonal_arguments(p)
+
+    cmdargs = p.parse_args()
+    return cmdargs
+
+
+def open_als(folder, tile, cube=None):
+    """Read ALS canopy cover and slope rasters of a tile
+
+    Args:
+        folder (str): study site
+        tile (str): tile coordinates (x_y)
+        cube (AlsCube): site ALS cube, used instead of the tifs when given
+
+    Returns:
+        array: canopy cover and slope
+    """
+    if cube is not None and tile in cube:
+        return cube.band(tile, "canopy"), cube.band(tile, "slope")
+    with rasterio.open(lasBounds.alsRaster(folder, tile, "canopy")) as canopy_open:
+        canopy = canopy_open.read(1)
+    with rasterio.open(lasBounds.alsRaster(folder, tile, "slope")) as slope_open:
+        slope = slope_open.read(1)
+    return canopy, slope
+
+
+def bin_sums(difference, canopy, slope, slope_edges, cc_edges):
+    """Sum errors into slope x canopy cover bins
+
+    Args:
+        difference (array): elevation difference, 0 is no-data
+        canopy (array): ALS canopy cover, negative is no-data
+        slope (array): ALS slope, negative is no-data
+        slope_edges (array): slope bin edges
+        cc_edges (array): canopy cover bin edges
+
+    Returns:
+        array: (4, slope bins, canopy cover bins) count, sum, sum of squares and sum of absolute error
+    """
+    n_slope, n_cc = len(slope_edges) - 1, len(cc_edges) - 1
+    valid = (difference != 0) & (canopy >= 0) & (slope >= 0)
+    error = difference[valid].astype("float64")
+
+    # Values above the last edge fall in the last bin
+    slope_idx = np.clip(np.digitize(slope[valid], slope_edges) - 1, 0, n_slope - 1)
+    cc_idx = np.clip(np.digitize(canopy[valid], cc_edges) - 1, 0, n_cc - 1)
+    flat_idx = slope_idx * n_cc + cc_idx
+
+    size = n_slope * n_cc
+    sums = np.stack(
+        [
+            np.bincount(flat_idx, minlength=size),
+            np.bincount(flat_idx, weights=error, minlength=size),
+            np.bincount(flat_idx, weights=error**2, minlength=size),
+            np.bincount(flat_idx, weights=np.abs(error), minlength=size),
+        ]
+    )
+    return sums.reshape(len(SUMS), n_slope, n_cc)
+
+
+def zonal_stats(folder, las_list, slope_step, cc_step):
+    """Accumulate binned error statistics for every scenario of a site
+
+    Args:
+        folder (str): study site
+        las_list (list): lastools settings to include
+        slope_step (float): width of slope bins
+        cc_step (float): width of canopy cover bins
+
+    Returns:
+        str: output csv file name
+    """
+    slope_edges = np.linspace(0, 90, int(round(90 / slope_step)) + 1)
+    cc_edges = np.linspace(0, 1, int(round(1 / cc_step)) + 1)
+
+    # Sort rasters by tile so each tile's ALS rasters are read once
+    diff_list, store = diff_source(folder, las_list)
+    diff_files = sorted(
+        (
+            lasBounds.tileKey(diff_tif),
+            os.path.basename(os.path.dirname(diff_tif)),
+            diff_tif,
+        )
+        for diff_tif in diff_list
+    )
+
+    cube = AlsCube(folder) if cube_exists(folder) else None
+    totals = {}
+    current_tile = None
+    for idx, (tile, las_settings, diff_tif) in enumerate(diff_files):
+        if tile != current_tile:
+            print(f"working on {folder} tile {tile} ({idx + 1} of {len(diff_files)})")
+            canopy, slope = open_als(folder, tile, cube)
+            current_tile = tile
+
+        difference, _ = read_diff(diff_tif, store)
+        if difference.shape != canopy.shape:
+            print(f"{diff_tif} ignored due to mismatched array shapes")
+            continue
+
+        scenario = diff_scenario(diff_tif, las_settings)
+        key = tuple(scenario[axis] for axis in AXES)
+        sums = bin_sums(difference, canopy, slope, slope_edges, cc_edges)
+        totals[key] = totals[key] + sums if key in totals else sums
+
+    # Convert sums to statistics for bins containing data
+    results = []
+    for key, sums in sorted(totals.items()):
+        count, total, total_sq, total_abs = sums
+        slope_idx, cc_idx = np.nonzero(count)
+        n = count[slope_idx, cc_idx]
+        bias = total[slope_idx, cc_idx] / n
+        mean_sq = total_sq[slope_idx, cc_idx] / n
+        scenario_df = pd.DataFrame(
+            {
+                "Folder": folder,
+                "Slope_min": slope_edges[slope_idx],
+                "Slope_max": slope_edges[slope_idx + 1],
+                "CC_min": cc_edges[cc_idx],
+                "CC_max": cc_edges[cc_idx + 1],
+                "Pixel_count": n.astype(int),
+                "Bias": bias,
+                "RMSE": np.sqrt(mean_sq),
+                "MAE": total_abs[slope_idx, cc_idx] / n,
+                "Std_dev": np.sqrt(np.maximum(mean_sq - bias**2, 0)),
+            }
+        )
+        for position, (axis, value) in enumerate(zip(AXES, key)):
+            scenario_df.insert(position + 1, axis, value)
+        results.append(scenario_df)
+
+    outCsv = f"data/{folder}/zonal_{folder}.csv"
+    if results:
+        pd.concat(results, ignore_index=True).to_csv(outCsv, index=False)
+        print("Results written to: ", outCsv)
+    else:
+        print(f"No difference rasters found for {folder}")
+    return outCsv
+
+
+def main(cmdargs):
+    """Write zonal statistics tables from parsed command line arguments
+
+    Args:
+        cmdargs (Namespace): arguments from zonalCommands
+    """
+    t = time.perf_counter()
+
+    study_area = cmdargs.studyArea
+    las_settings = cmdargs.lasSettings
+    las_list = LAS_SETTINGS if las_settings == "all" else [las_settings]
+
+    if study_area == "all":
+        study_sites = [
+            "Bonaly",
+            "hubbard_brook",
+            "la_selva",
+            "nouragues",
+            "oak_ridge",
+            "paracou",
+            "robson_creek",
+            "wind_river",
+        ]
+        print(f"working on all sites ({study_sites})")
+    else:
+        study_sites = [study_area]
+
+    for site in study_sites:
+        zonal_stats(site, las_list, cmdargs.slopeStep, cmdargs.ccStep)
+
+    t = time.perf_counter() - t
+    print("time taken: ", t, " seconds")
+
+
+if __name__ == "__main__":
+    main(zonalCommands())